@@ -1,16 +1,22 @@
 """需求分析Agent模块，负责文档解析与需求拆解"""
 
-from re import search
-from typing import Dict, List, Any, Optional
+import contextvars
+import threading
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any, Optional, Tuple
 from langchain.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
 from langchain.schema import HumanMessage, SystemMessage
 import json
 
-from config import OPENAI_API_KEY, OPENAI_API_BASE, OPENAI_MODEL
+from config import MODEL_PROFILES, ANALYZER_MAP_REDUCE_THRESHOLD, ANALYZER_SECTION_TOKENS, ANALYZER_MAX_WORKERS, ANALYSIS_CACHE
 from models.schema import RequirementAnalysis
+from models.analysis_cache import AnalysisCache, fingerprint
+from models.search import get_search_helper
+from utils import metrics, tracing
 from utils.logger import get_logger
-from models.search import SearchHelper
+from utils.history import get_history_builder, estimate_tokens
+from utils.llm import create_llm, create_escalation_llm, parse_json_object, prefers_small_model, invoke as invoke_llm
 
 # 获取日志记录器
 log = get_logger("analyzer_agent")
@@ -75,22 +81,146 @@ analyzer_prompt = PromptTemplate(
     input_variables=["requirement","history", "search_results"]
 )
 
+# 分段分析提示模板：长需求文档按章节拆分后并发分析，只输出结构化的模块表
+SECTION_PROMPT_TEMPLATE = """
+你是一个专业的项目需求分析师。下面是一份较长需求文档的第{index}/{total}部分，请只分析这一部分涉及的功能。
+
+只返回JSON，格式如下：
+{{
+  "mobile_modules": [{{"project_module": "项目模块", "function_module": "功能模块", "function_detail": "功能细分", "description": "功能描述"}}],
+  "pc_modules": [{{"module": "模块", "features": "功能要点", "description": "描述"}}],
+  "tech_stack": {{"前端": ["技术选型"], "后端": ["技术选型"]}},
+  "complexity_assessment": ["关键难点"]
+}}
+
+没有涉及的部分返回空数组。
+
+需求文档片段:
+{section}
+
+历史对话记录:
+{history}
+
+知识库参考信息:
+{search_results}
+"""
+
+section_prompt = PromptTemplate(
+    template=SECTION_PROMPT_TEMPLATE,
+    input_variables=["index", "total", "section", "history", "search_results"]
+)
+
+# 提示版本：提示模板变化时需求分析缓存自动失效
+PROMPT_VERSION = fingerprint(ANALYZER_PROMPT_TEMPLATE + SECTION_PROMPT_TEMPLATE)[:12]
+
+# 章节分隔：Markdown标题行或空行
+SECTION_BREAK_PATTERN = re.compile(r"\n(?=\s*#{1,6}\s)|\n\s*\n")
+
+def split_sections(text: str, max_tokens: int) -> List[str]:
+    """按标题和段落将长文本拆分为不超过max_tokens的片段，段落保持完整"""
+    sections: List[str] = []
+    current = ""
+    for block in SECTION_BREAK_PATTERN.split(text):
+        block = block.strip()
+        if not block:
+            continue
+        # 单个段落超长时按行拆分
+        pieces = [block] if estimate_tokens(block) <= max_tokens else block.splitlines()
+        for piece in pieces:
+            candidate = f"{current}\n\n{piece}" if current else piece
+            if current and estimate_tokens(candidate) > max_tokens:
+                sections.append(current)
+                current = piece
+            else:
+                current = candidate
+    if current:
+        sections.append(current)
+    return sections
+
+def merge_analyses(results: List[Dict[str, Any]]) -> RequirementAnalysis:
+    """合并各片段的分析结果，模块表按模块和功能去重"""
+    mobile_modules: Dict[tuple, Dict[str, str]] = {}
+    pc_modules: Dict[tuple, Dict[str, str]] = {}
+    tech_stack: Dict[str, List[str]] = {}
+    complexity: List[str] = []
+
+    for result in results:
+        for module in result.get("mobile_modules") or []:
+            if isinstance(module, dict):
+                key = (module.get("project_module"), module.get("function_module"), module.get("function_detail"))
+                mobile_modules.setdefault(key, {k: str(v) for k, v in module.items()})
+        for module in result.get("pc_modules") or []:
+            if isinstance(module, dict):
+                key = (module.get("module"), module.get("features"))
+                pc_modules.setdefault(key, {k: str(v) for k, v in module.items()})
+        for layer, technologies in (result.get("tech_stack") or {}).items():
+            merged = tech_stack.setdefault(layer, [])
+            for tech in technologies if isinstance(technologies, list) else [technologies]:
+                if tech not in merged:
+                    merged.append(str(tech))
+        for point in result.get("complexity_assessment") or []:
+            if point not in complexity:
+                complexity.append(str(point))
+
+    return RequirementAnalysis(
+        mobile_modules=list(mobile_modules.values()),
+        pc_modules=list(pc_modules.values()),
+        tech_stack=tech_stack,
+        complexity_assessment=complexity,
+    )
+
 class AnalyzerAgent:
     """需求分析Agent，负责文档解析与需求拆解"""
     
-    def __init__(self, model_name: str = OPENAI_MODEL):
+    def __init__(self, model_name: str = MODEL_PROFILES["analyzer"]):
         """初始化需求分析Agent"""
-        self.llm = ChatOpenAI(
-            model=model_name,
-            temperature=0.2  # 低温度以获得更确定的分析结果
-        )
+        self.llm = create_llm(model_name, temperature=0.2, streaming=True)  # 低温度以获得更确定的分析结果
+        # 片段分析结果无法解析时升级到大模型重试
+        self.escalation_llm = create_escalation_llm(model_name, temperature=0.2, streaming=True)
+        self.history_builder = get_history_builder("analyzer")
+        self.cache = AnalysisCache(f"{PROMPT_VERSION}:{model_name}") if ANALYSIS_CACHE else None
         log.info(f"需求分析Agent初始化完成，使用模型: {model_name}")
     
-    def analyze(self, requirement: str, history: str,formatted_results:str) -> str:
-        """分析需求"""
+    def analyze(self, requirement: str, history: List[Dict[str, Any]],formatted_results:str) -> str:
+        """分析需求，相同需求文本和检索上下文直接返回缓存的分析结果"""
+        if self.cache is None:
+            return self.analyze_requirement(requirement, history, formatted_results)[0]
+
+        try:
+            generation = get_search_helper().knowledge_base_generation()
+        except Exception as e:
+            log.warning(f"获取知识库版本失败，跳过需求分析缓存: {e}")
+            return self.analyze_requirement(requirement, history, formatted_results)[0]
+
+        key = self.cache.key(requirement, formatted_results)
+        cached = self.cache.get(key, generation)
+        if cached is not None:
+            log.info("命中需求分析缓存")
+            tracing.annotate(analysis_cache="hit")
+            metrics.cache_requests.inc(cache="analysis", result="hit")
+            return cached
+        tracing.annotate(analysis_cache="miss")
+        metrics.cache_requests.inc(cache="analysis", result="miss")
+
+        # 缓存键对应Agent配置的模型，改用小模型或部分片段失败的降级结果不写入缓存
+        downgraded = prefers_small_model()
+        result, complete = self.analyze_requirement(requirement, history, formatted_results)
+        if complete and not downgraded:
+            self.cache.put(key, generation, result)
+        else:
+            log.info("需求分析结果不完整或使用了小模型，不写入缓存")
+        return result
+
+    def analyze_requirement(self, requirement: str, history: List[Dict[str, Any]],formatted_results:str) -> Tuple[str, bool]:
+        """分析需求，超过阈值的长需求文档使用分段并发分析，返回分析结果以及结果是否完整"""
+        if estimate_tokens(requirement) > ANALYZER_MAP_REDUCE_THRESHOLD:
+            result = self.analyze_sections(requirement, history, formatted_results)
+            if result:
+                return result
+            log.warning("分段分析失败，退回整体分析")
         
-        # 准备提示
-        prompt_input = analyzer_prompt.format(requirement=requirement, history=history, search_results=formatted_results)
+        # 准备提示，历史对话按预算压缩
+        prompt_input = analyzer_prompt.format(requirement=requirement, history=self.history_builder.build(history), search_results=formatted_results)
         
         
         # 调用LLM进行分析 (使用单一消息而不是系统消息+用户消息)
@@ -99,11 +229,66 @@ class AnalyzerAgent:
         ]
         # log.info(f"发送到需求分析Agent的消息: {prompt_input[:100]}...")
         # llm绑定输出结构
-        response = self.llm.invoke(messages)
+        response = invoke_llm("analyzer", self.llm, messages)
         log.debug(f"需求分析Agent响应: {response}")
         
-        return response.content
+        return response.content, True
+
+    def analyze_sections(self, requirement: str, history: List[Dict[str, Any]], formatted_results: str) -> Optional[Tuple[str, bool]]:
+        """分段分析：拆分长需求文档，限制并发数分析各片段，再在本地合并模块表
+
+        返回合并结果以及是否所有片段都分析成功，全部失败时返回None。
+        """
+        sections = split_sections(requirement, ANALYZER_SECTION_TOKENS)
+        history_text = self.history_builder.build(history)
+        log.info(f"需求文档较长，拆分为 {len(sections)} 个片段并发分析")
+
+        def analyze_section(index: int, section: str) -> Optional[Dict[str, Any]]:
+            prompt_input = section_prompt.format(
+                index=index + 1,
+                total=len(sections),
+                section=section,
+                history=history_text,
+                search_results=formatted_results
+            )
+            try:
+                response = invoke_llm("analyzer", self.llm, [HumanMessage(content=prompt_input)],
+                                      validate=lambda content: parse_json_object(content) is not None,
+                                      escalation_llm=self.escalation_llm)
+            except Exception as e:
+                log.warning(f"片段 {index + 1} 分析失败: {e}")
+                return None
+            result = parse_json_object(response.content)
+            if result is None:
+                log.warning(f"片段 {index + 1} 分析结果解析失败")
+            return result
+
+        with ThreadPoolExecutor(max_workers=min(ANALYZER_MAX_WORKERS, len(sections)), thread_name_prefix="analyzer") as executor:
+            # 每个片段复制一份上下文，请求截止时间、降级开关和请求追踪在线程中仍然有效
+            futures = [
+                executor.submit(contextvars.copy_context().run, analyze_section, index, section)
+                for index, section in enumerate(sections)
+            ]
+            results = [future.result() for future in futures]
+
+        results = [result for result in results if result]
+        if not results:
+            return None
+        complete = len(results) == len(sections)
+        if not complete:
+            log.warning(f"{len(sections) - len(results)} 个片段分析失败，结果可能不完整")
+        return merge_analyses(results).format_to_markdown(), complete
     
     
-# 创建需求分析Agent实例
-analyzer_agent = AnalyzerAgent()
\ No newline at end of file
+# 共享的需求分析Agent，首次使用时创建
+_analyzer_agent: Optional[AnalyzerAgent] = None
+_analyzer_agent_lock = threading.Lock()
+
+def get_analyzer_agent() -> AnalyzerAgent:
+    """获取共享的需求分析Agent"""
+    global _analyzer_agent
+    if _analyzer_agent is None:
+        with _analyzer_agent_lock:
+            if _analyzer_agent is None:
+                _analyzer_agent = AnalyzerAgent()
+    return _analyzer_agent
@@ -1,14 +1,16 @@
 """入口模块，负责实时对话"""
 
+import threading
 import re
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
 from langchain.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
 from langchain.schema import HumanMessage, SystemMessage
 import json
 
-from config import OPENAI_MODEL
+from config import MODEL_PROFILES
 from utils.logger import get_logger
+from utils.llm import create_llm, create_escalation_llm, parse_json_object, invoke as invoke_llm, LLMUnavailableError
+from utils.history import get_history_builder
 from models.schema import IntentClassification
 
 # 获取日志记录器
@@ -19,35 +21,43 @@ ENTRYPOINT_SYSTEM_PROMPT = """
 你是智能客服，负责处理用户提出的各种问题。你的工作逻辑如下：
 1. 当用户提出通用性问题时，请直接根据已有知识回答问题。
 2. 当用户的问题不属于通用问题时，请根据用户的问题类型，调用相应的节点进行处理。
-3. 在调用各个节点时，请确保传递用户问题的关键信息，并严格按照调用顺序汇总各节点返回的结果后再给出最终回答。
-4. 每完成一个节点调用后，请仔细分析当前已完成的步骤和工具返回的结果，确定下一步应调用的节点，确保回答内容全面且准确。
+3. 在调用各个节点时，请确保传递用户问题的关键信息。
+4. 每完成一个节点调用后，请根据已调用节点的摘要（节点名称、状态、内容摘要、长度）确定下一步应调用的节点，确保回答内容全面且准确。
 5. 已经调用过的节点，请勿重复调用。
+6. 互不依赖的多个节点（如 company 和 requirement）可以在next_node中以列表形式同时调用；estimation 依赖 requirement 的结果，需要在 requirement 完成后调用。
 
 节点列表：
 1. 需求相关 (requirement): 用户询问或描述项目需求、功能规格、技术实现等
 2. 报价测算 (estimation): 用户询问项目报价、成本、工期、资源分配等
 3. 公司咨询 (company): 用户询问公司信息、团队能力、过往案例、服务流程等
-5. 结束 (__end__): 结束节点，当所有节点都调用完毕后，总结归纳，进入结束节点，结束对话。
+5. 结束 (__end__): 结束节点，当所有节点都调用完毕后进入结束节点，output留空，系统会根据各节点的完整结果汇总出最终回答。
 
-你需要返回一个JSON格式的结果，包含以下字段:
-- next_node: 下一个节点名称 (requirement/estimation/company/general/__end__)
-- inputs: 节点输入 (提取到的关键信息字符串)
-- output: 节点输出 (节点返回的结果字符串)
+你需要返回一个JSON格式的结果，按以下顺序包含以下字段:
+- next_node: 下一个节点名称 (requirement/estimation/company/general/__end__)，同时调用多个节点时为节点名称列表
 - is_final: 是否为最终响应 (True/False)
+- inputs: 节点输入 (提取到的关键信息字符串)
+- output: 通用问题的回答，调用过节点时留空
 
 示例结果：
 {
     "next_node": "estimation",
+    "is_final": "False",
     "inputs": "用户的问题",
-    "output": "节点返回的结果",
-    "is_final": "False" 
+    "output": ""
+}
+节点全部调用完毕示例结果：
+{
+    "next_node": "__end__",
+    "is_final": "False",
+    "inputs": "",
+    "output": ""
 }
 通用问题示例结果：
 {
     "next_node": "__end__",
+    "is_final": "True",
     "inputs": "用户的问题",
-    "output": "回答",
-    "is_final": "True"
+    "output": "回答"
 }
 
 请仅返回JSON格式的主路由结果，不要包含其他解释或前缀。
@@ -60,7 +70,7 @@ ENTRYPOINT_PROMPT_TEMPLATE = """
 历史对话上下文:
 {history}
 
-已经调用过的节点:
+已经调用过的节点（仅包含摘要）:
 {used_tools}
 """
 
@@ -69,32 +79,101 @@ entry_point_prompt = PromptTemplate(
     input_variables=["message", "history", "used_tools"]
 )
 
+# 模型不可用或输出无法解析时的回答
+FALLBACK_ANSWER = "抱歉，暂时无法处理您的请求，请稍后重试。"
+
+# 可被计划调用的节点
+PLAN_NODES = ["requirement", "estimation", "company"]
+
+# 一次性计划系统提示
+PLANNER_SYSTEM_PROMPT = """
+你是智能客服的任务规划器，负责一次性规划处理用户问题所需调用的全部节点。
+
+节点列表：
+1. 需求相关 (requirement): 用户询问或描述项目需求、功能规格、技术实现等
+2. 报价测算 (estimation): 用户询问项目报价、成本、工期、资源分配等
+3. 公司咨询 (company): 用户询问公司信息、团队能力、过往案例、服务流程等
+
+规划规则：
+1. 当用户提出通用性问题时，不需要调用任何节点，请直接在output中给出回答。
+2. 每个节点最多调用一次，按执行顺序排列，互不依赖的节点会被并行执行。
+3. 报价测算依赖需求拆解结果，如果同时需要需求拆解和报价测算，requirement必须排在estimation之前。
+
+你需要返回一个JSON格式的结果，按以下顺序包含以下字段:
+- steps: 节点调用计划列表，每一项包含 node (节点名称) 和 inputs (提取到的关键信息字符串)
+- output: 当steps为空时的直接回答，否则为空字符串
+
+示例结果：
+{
+    "steps": [
+        {"node": "requirement", "inputs": "社区信息公示平台需求"},
+        {"node": "estimation", "inputs": "社区信息公示平台报价"}
+    ],
+    "output": ""
+}
+通用问题示例结果：
+{
+    "steps": [],
+    "output": "回答"
+}
+
+请仅返回JSON格式的计划结果，不要包含其他解释或前缀。
+"""
+
+# 一次性计划提示模板
+PLANNER_PROMPT_TEMPLATE = """
+用户消息: {message}
+
+历史对话上下文:
+{history}
+"""
+
+planner_prompt = PromptTemplate(
+    template=PLANNER_PROMPT_TEMPLATE,
+    input_variables=["message", "history"]
+)
+
+# 最终汇总系统提示
+SYNTHESIS_SYSTEM_PROMPT = """
+你是智能客服，负责根据各节点的执行结果回答用户的问题。
+请严格按照节点的执行顺序汇总各节点返回的结果，给出全面且准确的最终回答。
+请直接输出回答内容，不要返回JSON。
+"""
+
+# 最终汇总提示模板
+SYNTHESIS_PROMPT_TEMPLATE = """
+用户消息: {message}
+
+历史对话上下文:
+{history}
+
+各节点执行结果:
+{tool_results}
+"""
+
+synthesis_prompt = PromptTemplate(
+    template=SYNTHESIS_PROMPT_TEMPLATE,
+    input_variables=["message", "history", "tool_results"]
+)
+
 class EntryPointAgent:
     """主路由Agent，负责实时对话意图识别"""
     
-    def __init__(self, model_name: str = OPENAI_MODEL):
-        """初始化主路由Agent"""
-        self.llm = ChatOpenAI(
-            model=model_name,
-            temperature=0.1  # 低温度以获得更确定的主路由结果
-        )
-        log.info(f"主路由Agent初始化完成，使用模型: {model_name}")
+    def __init__(self, model_name: str = MODEL_PROFILES["router"], synthesis_model_name: str = MODEL_PROFILES["synthesizer"]):
+        """初始化主路由Agent，路由和计划使用小模型，最终汇总使用汇总模型"""
+        self.llm = create_llm(model_name, temperature=0.1)  # 低温度以获得更确定的主路由结果
+        # 路由结果无法解析时升级到大模型重试
+        self.escalation_llm = create_escalation_llm(model_name, temperature=0.1)
+        self.synthesis_llm = create_llm(synthesis_model_name, temperature=0.1)
+        self.history_builder = get_history_builder("router")
+        log.info(f"主路由Agent初始化完成，使用模型: {model_name}，汇总模型: {synthesis_model_name}")
     
     def format_history(self, history: List[Dict[str, Any]]) -> str:
-        """格式化对话历史"""
-        if not history:
-            return "无历史对话"
-        
-        formatted_history = ""
-        for msg in history:
-            role = "用户" if msg.get("role") == "user" else "系统"
-            content = msg.get("content", "")
-            formatted_history += f"{role}- {content}\n"
-        
-        return formatted_history
+        """按预算格式化对话历史"""
+        return self.history_builder.build(history)
     
     def classify(self, message: str, history: List[Dict[str, Any]],tools_response: List[Dict]) -> Dict[str, Any]:
-        """主路由用户消息意图"""
+        """主路由用户消息意图，tools_response为已调用节点的紧凑描述，不含完整输出"""
         if history is None:
             history = []
         
@@ -113,14 +192,110 @@ class EntryPointAgent:
             SystemMessage(content=ENTRYPOINT_SYSTEM_PROMPT),
             HumanMessage(content=prompt_input)
         ]
-        response = self.llm.invoke(messages)
-
         try:
-            response_dict = json.loads(response.content)
-            return response_dict
-        except json.JSONDecodeError:
+            response = invoke_llm("router", self.llm, messages,
+                                  validate=lambda content: parse_json_object(content) is not None,
+                                  escalation_llm=self.escalation_llm)
+        except LLMUnavailableError as e:
+            log.error(f"主路由模型不可用: {e}")
+            return self.fallback_route(tools_response)
+
+        response_dict = parse_json_object(response.content)
+        if response_dict is None or "next_node" not in response_dict:
             log.error(f"主Agent响应无法解析为JSON: {response.content}")
-            return {}
+            return self.fallback_route(tools_response)
+        return response_dict
+
+    def fallback_route(self, tools_response: List[Dict]) -> Dict[str, Any]:
+        """路由失败时的结果：已调用过节点时进入汇总，否则直接返回致歉回答"""
+        if tools_response:
+            return {"next_node": "__end__", "is_final": "False", "inputs": "", "output": ""}
+        return {"next_node": "__end__", "is_final": "True", "inputs": "", "output": FALLBACK_ANSWER}
+
+    def plan(self, message: str, history: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """一次性规划完整的节点调用顺序"""
+        if history is None:
+            history = []
+
+        prompt_input = planner_prompt.format(
+            message=message,
+            history=self.format_history(history)
+        )
+        messages = [
+            SystemMessage(content=PLANNER_SYSTEM_PROMPT),
+            HumanMessage(content=prompt_input)
+        ]
+        try:
+            response = invoke_llm("router", self.llm, messages,
+                                  validate=lambda content: parse_json_object(content) is not None,
+                                  escalation_llm=self.escalation_llm)
+        except LLMUnavailableError as e:
+            log.error(f"计划模型不可用: {e}")
+            return {"steps": [], "output": FALLBACK_ANSWER}
+
+        result = parse_json_object(response.content)
+        if result is None:
+            log.error(f"计划响应无法解析为JSON: {response.content}")
+            return {"steps": [], "output": FALLBACK_ANSWER}
+
+        # 过滤未知节点和重复节点
+        steps = []
+        seen = set()
+        for step in result.get("steps") or []:
+            node = step.get("node") if isinstance(step, dict) else None
+            if node not in PLAN_NODES or node in seen:
+                continue
+            seen.add(node)
+            steps.append({"node": node, "inputs": step.get("inputs") or message})
+
+        # 报价测算依赖需求拆解结果
+        nodes = [step["node"] for step in steps]
+        if "requirement" in nodes and "estimation" in nodes and nodes.index("estimation") < nodes.index("requirement"):
+            steps.insert(nodes.index("estimation"), steps.pop(nodes.index("requirement")))
+
+        log.info(f"主路由Agent计划: {[step['node'] for step in steps]}")
+        return {"steps": steps, "output": result.get("output", "")}
+
+    def synthesize(self, message: str, history: List[Dict[str, Any]], tool_results: List[Dict]) -> str:
+        """汇总各节点的完整结果，生成最终回答"""
+        if history is None:
+            history = []
+
+        formatted_results = format_tool_results(tool_results)
+
+        prompt_input = synthesis_prompt.format(
+            message=message,
+            history=self.format_history(history),
+            tool_results=formatted_results
+        )
+        messages = [
+            SystemMessage(content=SYNTHESIS_SYSTEM_PROMPT),
+            HumanMessage(content=prompt_input)
+        ]
+        try:
+            response = invoke_llm("synthesizer", self.synthesis_llm, messages)
+        except LLMUnavailableError as e:
+            # 汇总模型不可用时直接返回各节点的完整结果
+            log.error(f"汇总模型不可用，直接返回节点结果: {e}")
+            return formatted_results
+        return response.content
+
+def format_tool_results(tool_results: List[Dict]) -> str:
+    """按节点拼接各工具节点的完整结果，用于汇总提示和汇总模型不可用时的回答"""
+    formatted_results = ""
+    for tool in tool_results:
+        formatted_results += f"[{tool.get('node')}]\n{tool.get('result', '')}\n\n"
+    return formatted_results.strip()
+
+# 共享的主路由Agent，首次使用时创建
+_entry_point_agent: Optional[EntryPointAgent] = None
+_entry_point_agent_lock = threading.Lock()
 
-# 创建主路由Agent实例
-entry_point_agent = EntryPointAgent()
\ No newline at end of file
+def get_entry_point_agent() -> EntryPointAgent:
+    """获取共享的主路由Agent"""
+    global _entry_point_agent
+    if _entry_point_agent is None:
+        with _entry_point_agent_lock:
+            if _entry_point_agent is None:
+                _entry_point_agent = EntryPointAgent()
+    return _entry_point_agent
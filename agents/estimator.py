@@ -1,18 +1,22 @@
 """成本测算Agent模块，负责工时模型和报价矩阵计算"""
 
-from typing import List
+import threading
+from typing import Dict, List, Any, Tuple, Optional
 from langchain.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
 from langchain.schema import HumanMessage, SystemMessage
 import json
 
-from config import OPENAI_MODEL
+from config import MODEL_PROFILES
 from utils.logger import get_logger
-from models.vector_store import VectorStoreManager
+from utils.history import get_history_builder
+from utils.llm import create_llm, create_escalation_llm, parse_json_object, invoke as invoke_llm
+from models.schema import CostEstimation
+from models.price_matrix import get_price_matrix
+from models.project_history import project_history, estimation_features
 
 # 获取日志记录器
 log = get_logger("estimator_agent")
-# todo 可以加一个根据需求提取对应功能点，然后查询对应功能点的报价矩阵，然后根据需求计算成本,还有其他问题，比如去掉某某功能多少钱，商城一般多少钱
+# todo 还有其他问题，比如去掉某某功能多少钱，商城一般多少钱
 # 成本测算系统提示
 ESTIMATOR_SYSTEM_PROMPT = """
 你是一个专业的项目成本测算专家。你的任务是根据项目需求分析结果，计算项目的成本和报价。
@@ -44,25 +48,177 @@ estimator_prompt = PromptTemplate(
     input_variables=["message", "history", "knowledge_results"]
 )
 
+# 功能匹配系统提示：LLM只负责把需求映射到报价矩阵的功能行，不做任何计算
+FEATURE_MAPPING_SYSTEM_PROMPT = """
+你是一个项目需求与报价矩阵的匹配专家。你的任务是把项目需求中的功能点映射到报价矩阵中的功能行。
+
+要求：
+1. 只能使用报价矩阵中存在的功能ID
+2. 同一功能需要多份时（如多个角色端、多套报表）填写数量，默认为1
+3. 报价矩阵中找不到对应功能的需求点放入unmatched
+4. 不要计算工时和价格
+
+只返回JSON，格式如下：
+{"features": [{"id": "F1", "quantity": 1}], "unmatched": ["功能点名称"]}
+"""
+
+FEATURE_MAPPING_PROMPT_TEMPLATE = """
+项目需求:
+{message}
+
+消息历史:
+{history}
+
+报价矩阵:
+{catalog}
+
+请返回匹配结果。
+"""
+
+feature_mapping_prompt = PromptTemplate(
+    template=FEATURE_MAPPING_PROMPT_TEMPLATE,
+    input_variables=["message", "history", "catalog"]
+)
+
+# 测算说明系统提示：数值由成本引擎计算，LLM只撰写风险评估和说明
+NARRATIVE_SYSTEM_PROMPT = """
+你是一个专业的项目成本测算专家。成本测算结果已经由报价矩阵计算完成，你的任务是为测算结果撰写简短的风险评估和说明。
+
+要求：
+1. 不要修改或重新计算任何数字
+2. 说明未匹配功能对报价的可能影响
+3. 有相似历史项目时，对比其实际成本说明本次报价的偏差
+4. 控制在5条要点以内
+"""
+
+NARRATIVE_PROMPT_TEMPLATE = """
+项目需求:
+{message}
+
+测算结果:
+{estimation}
+
+知识库查询结果:
+{knowledge_results}
+
+请撰写风险评估和说明。
+"""
+
+narrative_prompt = PromptTemplate(
+    template=NARRATIVE_PROMPT_TEMPLATE,
+    input_variables=["message", "estimation", "knowledge_results"]
+)
+
 class EstimatorAgent:
     """成本测算Agent，负责工时模型和报价矩阵计算"""
     
-    def __init__(self, model_name: str = OPENAI_MODEL):
+    def __init__(self, model_name: str = MODEL_PROFILES["estimator"]):
         """初始化成本测算Agent"""
-        self.llm = ChatOpenAI(
-            model=model_name,
-            temperature=0.2,  # 低温度以获得更确定的测算结果
-            streaming=True
-        )
+        self.llm = create_llm(model_name, temperature=0.2, streaming=True)  # 低温度以获得更确定的测算结果
+        # 功能匹配只输出简短JSON，不需要流式输出
+        self.mapping_llm = create_llm(model_name, temperature=0)
+        # 功能匹配结果无法解析时升级到大模型重试
+        self.escalation_llm = create_escalation_llm(model_name, temperature=0)
+        self.history_builder = get_history_builder("estimator")
         log.info(f"成本测算Agent初始化完成，使用模型: {model_name}")
     
-    def estimate(self, requirement: str, history: str,formatted_results:str) -> str:
-        """计算项目成本和报价"""
+    def estimate(self, requirement: str, history: List[Dict[str, Any]],formatted_results:str,
+                 project_requirement: Optional[str] = None) -> str:
+        """计算项目成本和报价
+
+        有报价矩阵时由LLM匹配功能行、成本引擎计算数值；否则退回由LLM直接测算。
+        project_requirement 为用户的原始需求，按它保存和查找历史项目，默认与 requirement 相同
+        （requirement 可能是需求拆解的结果，同一需求的拆解结果不一定相同）。
+        """
+        project_requirement = project_requirement or requirement
+        price_matrix = get_price_matrix()
+        if not price_matrix.empty:
+            selection, unmatched = self.map_features(requirement, history, price_matrix.format_catalog())
+            estimation = price_matrix.estimate(selection, unmatched)
+            if estimation:
+                log.info(f"成本引擎测算完成，匹配功能 {len(estimation.line_items)} 个，未匹配 {len(unmatched)} 个")
+                estimation.similar_projects = self.find_similar(project_requirement, estimation)
+                estimation.risk_assessment = self.write_narrative(requirement, estimation.format_to_markdown(), formatted_results)
+                self.record(project_requirement, estimation)
+                return estimation.format_to_markdown()
+            log.warning("未匹配到报价矩阵功能行，退回LLM测算")
+
+        return self.estimate_with_llm(requirement, history, formatted_results)
+
+    def map_features(self, requirement: str, history: List[Dict[str, Any]], catalog: str) -> Tuple[Dict[str, float], List[str]]:
+        """将需求映射到报价矩阵的功能行，返回 功能ID -> 数量 以及未匹配的功能点"""
+        prompt_input = feature_mapping_prompt.format(
+            message=requirement,
+            history=self.history_builder.build(history),
+            catalog=catalog
+        )
+        messages = [
+            SystemMessage(content=FEATURE_MAPPING_SYSTEM_PROMPT),
+            HumanMessage(content=prompt_input)
+        ]
+
+        response = invoke_llm("estimator", self.mapping_llm, messages,
+                              validate=lambda content: parse_json_object(content) is not None,
+                              escalation_llm=self.escalation_llm)
+        log.debug(f"功能匹配响应: {response.content}")
+
+        result = parse_json_object(response.content)
+        if result is None:
+            log.warning("功能匹配结果解析失败")
+            return {}, []
+
+        selection: Dict[str, float] = {}
+        for item in result.get("features", []):
+            if not isinstance(item, dict) or not item.get("id"):
+                continue
+            try:
+                quantity = float(item.get("quantity", 1) or 1)
+            except (TypeError, ValueError):
+                quantity = 1.0
+            feature_id = str(item["id"]).strip()
+            selection[feature_id] = selection.get(feature_id, 0.0) + quantity
+
+        unmatched = [str(feature) for feature in result.get("unmatched", []) if feature]
+        return selection, unmatched
 
-        # 准备提示
+    def write_narrative(self, requirement: str, estimation: str, formatted_results: str) -> str:
+        """为成本引擎的测算结果撰写风险评估和说明"""
+        prompt_input = narrative_prompt.format(
+            message=requirement,
+            estimation=estimation,
+            knowledge_results=formatted_results
+        )
+        messages = [
+            SystemMessage(content=NARRATIVE_SYSTEM_PROMPT),
+            HumanMessage(content=prompt_input)
+        ]
+
+        response = invoke_llm("estimator", self.llm, messages)
+        return response.content
+
+    def find_similar(self, requirement: str, estimation: CostEstimation) -> List[Dict[str, Any]]:
+        """从历史项目库查找相似项目，失败时不影响本次回答"""
+        try:
+            return project_history.find_similar(estimation_features(estimation), requirement=requirement)
+        except Exception as e:
+            log.warning(f"查找相似历史项目失败: {e}")
+            return []
+
+    def record(self, requirement: str, estimation: CostEstimation):
+        """保存测算结果到历史项目库，失败时不影响本次回答"""
+        try:
+            project_id = project_history.record(requirement, estimation)
+            log.info(f"测算结果已保存到历史项目库: {project_id}")
+        except Exception as e:
+            log.warning(f"保存测算结果失败: {e}")
+
+    def estimate_with_llm(self, requirement: str, history: List[Dict[str, Any]],formatted_results:str) -> str:
+        """没有可用报价矩阵时由LLM直接测算"""
+
+        # 准备提示，历史对话按预算压缩
         prompt_input = estimator_prompt.format(
             message=requirement,
-            history=history,
+            history=self.history_builder.build(history),
             knowledge_results=formatted_results
         )
         
@@ -72,10 +228,20 @@ class EstimatorAgent:
             HumanMessage(content=prompt_input)
         ]
         
-        response = self.llm.invoke(messages)
+        response = invoke_llm("estimator", self.llm, messages)
         log.debug(f"成本测算Agent响应: {response}")
         
         return response.content
 
-# 创建成本测算Agent实例
-estimator_agent = EstimatorAgent()
\ No newline at end of file
+# 共享的成本测算Agent，首次使用时创建
+_estimator_agent: Optional[EstimatorAgent] = None
+_estimator_agent_lock = threading.Lock()
+
+def get_estimator_agent() -> EstimatorAgent:
+    """获取共享的成本测算Agent"""
+    global _estimator_agent
+    if _estimator_agent is None:
+        with _estimator_agent_lock:
+            if _estimator_agent is None:
+                _estimator_agent = EstimatorAgent()
+    return _estimator_agent
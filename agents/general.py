@@ -1,12 +1,14 @@
 """通用对话Agent模块，负责处理一般性对话请求"""
 
-from typing import Dict, List, Any
+import threading
+from typing import Dict, List, Any, Optional
 from langchain.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
 from langchain.schema import HumanMessage, SystemMessage
 
-from config import OPENAI_MODEL
+from config import MODEL_PROFILES
 from utils.logger import get_logger
+from utils.history import get_history_builder
+from utils.llm import create_llm, invoke as invoke_llm
 
 # 获取日志记录器
 log = get_logger("general_agent")
@@ -44,26 +46,15 @@ general_prompt = PromptTemplate(
 class GeneralAgent:
     """通用对话Agent，负责处理一般性对话请求"""
     
-    def __init__(self, model_name: str = OPENAI_MODEL):
+    def __init__(self, model_name: str = MODEL_PROFILES["general"]):
         """初始化通用对话Agent"""
-        self.llm = ChatOpenAI(
-            model=model_name,
-            temperature=0.7  # 较高温度以获得更自然的对话
-        )
+        self.llm = create_llm(model_name, temperature=0.7)  # 较高温度以获得更自然的对话
+        self.history_builder = get_history_builder("general")
         log.info(f"通用对话Agent初始化完成，使用模型: {model_name}")
     
     def format_history(self, history: List[Dict[str, Any]]) -> str:
-        """格式化对话历史"""
-        if not history:
-            return "无历史对话"
-        
-        formatted_history = ""
-        for msg in history:
-            role = "用户" if msg.get("role") == "user" else "系统"
-            content = msg.get("content", "")
-            formatted_history += f"{role}- {content}\n"
-        
-        return formatted_history
+        """按预算格式化对话历史"""
+        return self.history_builder.build(history)
     
     def respond(self, message: str, history: List[Dict[str, Any]]) -> str:
         """生成对话响应"""
@@ -85,7 +76,7 @@ class GeneralAgent:
             HumanMessage(content=prompt_input)
         ]
         
-        response = self.llm.invoke(messages)
+        response = invoke_llm("general", self.llm, messages)
         log.debug(f"通用对话Agent响应: {response.content[:100]}...")
         
         # 确保返回字符串类型
@@ -98,5 +89,15 @@ class GeneralAgent:
             # 其他情况转换为字符串
             return str(response.content)
 
-# 创建通用对话Agent实例
-general_agent = GeneralAgent()
\ No newline at end of file
+# 共享的通用对话Agent，首次使用时创建
+_general_agent: Optional[GeneralAgent] = None
+_general_agent_lock = threading.Lock()
+
+def get_general_agent() -> GeneralAgent:
+    """获取共享的通用对话Agent"""
+    global _general_agent
+    if _general_agent is None:
+        with _general_agent_lock:
+            if _general_agent is None:
+                _general_agent = GeneralAgent()
+    return _general_agent
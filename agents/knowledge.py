@@ -1,14 +1,16 @@
 """企业智库Agent模块，负责公司知识图谱查询"""
 
+import threading
+from typing import Dict, List, Any, Optional
 from langchain.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
 from langchain.schema import HumanMessage, SystemMessage
-import json
 
-from config import OPENAI_MODEL
+from config import MODEL_PROFILES, ESCALATION_MIN_CONFIDENCE
 from utils.logger import get_logger
+from utils.history import get_history_builder
+from utils.llm import create_llm, create_escalation_llm, parse_json_object, invoke as invoke_llm
 from models.schema import KnowledgeResult
-from models.search import SearchHelper
+from models.search import get_search_helper
 
 # 获取日志记录器
 log = get_logger("knowledge_agent")
@@ -30,6 +32,8 @@ KNOWLEDGE_SYSTEM_PROMPT = """
 - confidence: 置信度 (0.0-1.0)
 - related_topics: 相关主题列表（可选）
 
+字段按上述顺序输出，answer放在最前面。
+
 请仅返回JSON格式的查询结果，不要包含其他解释或前缀。
 """
 
@@ -56,19 +60,31 @@ knowledge_prompt = PromptTemplate(
 class KnowledgeAgent:
     """企业智库Agent，负责公司知识图谱查询"""
     
-    def __init__(self, model_name: str = OPENAI_MODEL):
+    def __init__(self, model_name: str = MODEL_PROFILES["knowledge"]):
         """初始化企业智库Agent"""
-        self.llm = ChatOpenAI(
-            model=model_name,
-            temperature=0.3  # 适中温度以平衡准确性和多样性
-        )
+        self.llm = create_llm(model_name, temperature=0.3, streaming=True)  # 适中温度以平衡准确性和多样性
+        # 查询结果无法解析或置信度过低时升级到大模型重试
+        self.escalation_llm = create_escalation_llm(model_name, temperature=0.3, streaming=True)
+        self.history_builder = get_history_builder("knowledge")
     
-    def query(self, query: str,history:str) -> KnowledgeResult:
-        """查询企业知识库"""
-        # 初始化搜索助手
-        search_helper = SearchHelper()
+    @staticmethod
+    def _is_confident(content: str) -> bool:
+        """查询结果可以解析且置信度不低于升级阈值"""
+        result = parse_json_object(content)
+        if result is None:
+            return False
+        try:
+            return float(result.get("confidence", 1.0)) >= ESCALATION_MIN_CONFIDENCE
+        except (TypeError, ValueError):
+            return False
+
+    def query(self, query: str,history: List[Dict[str, Any]], search_results: Optional[List[Dict[str, Any]]] = None) -> KnowledgeResult:
+        """查询企业知识库，search_results为调用方已取得的检索结果（如预取结果）"""
+        # 获取共享的搜索助手
+        search_helper = get_search_helper()
         # 搜索知识库
-        search_results = search_helper.search_knowledge_base(query)
+        if search_results is None:
+            search_results = search_helper.search_knowledge_base(query)
         
         # 如果没有搜索结果
         if not search_results:
@@ -86,7 +102,7 @@ class KnowledgeAgent:
         prompt_input = knowledge_prompt.format(
             query=query,
             search_results=formatted_results,
-            history=history
+            history=self.history_builder.build(history)
         )
         
         # 调用LLM进行查询
@@ -95,33 +111,44 @@ class KnowledgeAgent:
             HumanMessage(content=prompt_input)
         ]
         
-        response = self.llm.invoke(messages)
+        response = invoke_llm("knowledge", self.llm, messages,
+                              validate=self._is_confident,
+                              escalation_llm=self.escalation_llm)
         log.info(f"企业智库Agent响应: {response.content}")
         
-        # 解析JSON响应
-        try:
-            result = json.loads(response.content)
-            
-            # 构建来源列表
-            sources = []
-            for item in search_results:
-                sources.append(item["source"])
-            knowledge_result = KnowledgeResult(
-                answer=result.get("answer", "抱歉，没有找到相关信息"),
-                sources=result.get("sources", sources),
-                confidence=result.get("confidence", 0.7),
-                related_topics=result.get("related_topics")
-            )
-            log.info(f"知识库查询结果: 置信度={knowledge_result.confidence}")
-            return knowledge_result
-        except json.JSONDecodeError as e:
-            log.error(f"解析查询结果失败: {str(e)}")
+        # 解析JSON响应，与升级判断使用同一个解析函数
+        result = parse_json_object(response.content)
+        if result is None:
+            log.error("解析查询结果失败")
             # 返回默认查询结果
             return KnowledgeResult(
                 answer="抱歉，处理您的查询时出现错误",
-                sources=[{"name": "系统错误", "type": "error"}],
+                sources=[],
                 confidence=0.0
             )
 
-# 创建企业智库Agent实例
-knowledge_agent = KnowledgeAgent()
\ No newline at end of file
+        # 构建来源列表
+        sources = []
+        for item in search_results:
+            sources.append(item["source"])
+        knowledge_result = KnowledgeResult(
+            answer=result.get("answer", "抱歉，没有找到相关信息"),
+            sources=result.get("sources", sources),
+            confidence=result.get("confidence", 0.7),
+            related_topics=result.get("related_topics")
+        )
+        log.info(f"知识库查询结果: 置信度={knowledge_result.confidence}")
+        return knowledge_result
+
+# 共享的企业智库Agent，首次使用时创建
+_knowledge_agent: Optional[KnowledgeAgent] = None
+_knowledge_agent_lock = threading.Lock()
+
+def get_knowledge_agent() -> KnowledgeAgent:
+    """获取共享的企业智库Agent"""
+    global _knowledge_agent
+    if _knowledge_agent is None:
+        with _knowledge_agent_lock:
+            if _knowledge_agent is None:
+                _knowledge_agent = KnowledgeAgent()
+    return _knowledge_agent
@@ -0,0 +1,154 @@
+"""应用容器模块，负责在应用启动时一次性创建共享组件、预热并在关闭时释放
+
+启动时依次创建数据库引擎、检索服务、对话记忆、各Agent、检查点存储和编译后的工作流图，随后预热：
+- 模型连接：建立到模型接口的连接池
+- 嵌入模型：完成首次嵌入计算
+- 索引：加载报价矩阵和历史项目索引
+
+各组件的耗时记录在启动报告中，可通过 /api/health 查看。
+"""
+
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from fastapi import Request
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+from langgraph.graph.state import CompiledStateGraph
+from starlette.concurrency import run_in_threadpool
+
+from agents import entry_point, analyzer, estimator, knowledge, general
+from config import WORKFLOW_MODE, APP_WARMUP, CHECKPOINT_ENABLED
+from models.database import db
+from models.async_database import async_db
+from models.search import SearchHelper, get_search_helper
+from models.price_matrix import get_price_matrix
+from models.project_history import project_history
+from workflows import retrieval, checkpoint
+from workflows.memory import ConversationMemory, get_conversation_memory
+from workflows.graph import build_enterprise_bot_graph
+from utils import llm
+from utils.logger import get_logger
+
+# 获取日志记录器
+log = get_logger("container")
+
+class AppContainer:
+    """应用容器，持有编译后的工作流图、各Agent、检索服务、检查点存储和数据库引擎"""
+
+    def __init__(self, mode: str = WORKFLOW_MODE):
+        self.mode = mode
+        self.db = db
+        self.async_db = async_db
+        self.graph: Optional[CompiledStateGraph] = None
+        self.agents: Dict[str, Any] = {}
+        self.search_helper: Optional[SearchHelper] = None
+        self.checkpointer: Optional[AsyncSqliteSaver] = None
+        self.memory: Optional[ConversationMemory] = None
+        self._tasks: List[asyncio.Task] = []  # 后台任务
+        self.timings: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+        self.started = False
+
+    @contextmanager
+    def _timed(self, component: str, required: bool = True):
+        """记录组件耗时，非必需组件失败时只记录错误，不影响启动"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            if required:
+                raise
+            self.errors[component] = str(e)
+            log.warning(f"{component} 初始化失败: {e}")
+        finally:
+            self.timings[component] = round(time.perf_counter() - start, 3)
+
+    async def start(self):
+        """创建共享组件并预热，阻塞的初始化和预热在线程池中执行"""
+        start = time.perf_counter()
+        await run_in_threadpool(self._create_components)
+        # 检查点存储不可用时工作流不做持久化
+        with self._timed("checkpointer", required=False):
+            if CHECKPOINT_ENABLED:
+                self.checkpointer = await checkpoint.open_checkpointer()
+        with self._timed("graph"):
+            self.graph = build_enterprise_bot_graph(self.mode, self.checkpointer)
+        # 后台定期清理过期的对话记忆，批量生成对话摘要
+        self._tasks.append(asyncio.create_task(self.memory.sweep_periodically()))
+        if self.memory.summarizer is not None:
+            self._tasks.append(asyncio.create_task(self.memory.summarizer.run()))
+        if APP_WARMUP:
+            await run_in_threadpool(self.warm_up)
+        self.timings["total"] = round(time.perf_counter() - start, 3)
+        self.started = True
+        log.info(f"应用容器启动完成，各组件耗时(秒): {self.timings}")
+        if self.errors:
+            log.warning(f"应用容器部分组件不可用: {self.errors}")
+
+    def _create_components(self):
+        """创建数据库引擎、检索服务和各Agent"""
+        with self._timed("database"):
+            self.db.initialize()
+            self.async_db.initialize()
+        # 向量库或嵌入服务不可用时仍然启动，检索在首次使用时重试
+        with self._timed("retrieval", required=False):
+            self.search_helper = get_search_helper()
+        with self._timed("memory"):
+            self.memory = get_conversation_memory()
+        with self._timed("agents"):
+            self.agents = {
+                "entry_point": entry_point.get_entry_point_agent(),
+                "analyzer": analyzer.get_analyzer_agent(),
+                "estimator": estimator.get_estimator_agent(),
+                "knowledge": knowledge.get_knowledge_agent(),
+                "general": general.get_general_agent(),
+            }
+
+    def warm_up(self):
+        """预热模型连接、嵌入模型和索引，预热失败不影响启动"""
+        with self._timed("warmup_llm", required=False):
+            # 同一接口地址的模型共享连接池，列出模型即可建立连接，不消耗token
+            client = getattr(self.agents["entry_point"].llm, "root_client", None)
+            if client is not None:
+                client.models.list()
+        with self._timed("warmup_embedding", required=False):
+            if self.search_helper is not None:
+                self.search_helper.vector_store.embeddings.embed_query("预热")
+        with self._timed("warmup_index", required=False):
+            get_price_matrix()
+            project_history.ensure_loaded()
+
+    async def shutdown(self):
+        """停止后台任务，释放线程池、检查点存储和数据库连接"""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        retrieval.shutdown()
+        llm.shutdown()
+        if self.checkpointer is not None:
+            await checkpoint.close_checkpointer(self.checkpointer)
+        await self.async_db.close()
+        self.db.close()
+        self.started = False
+        log.info("应用容器已关闭")
+
+    def report(self) -> Dict[str, Any]:
+        """启动报告"""
+        return {
+            "started": self.started,
+            "workflow_mode": self.mode,
+            "checkpointing": self.checkpointer is not None,
+            "memory": self.memory.snapshot() if self.memory is not None else None,
+            "timings": self.timings,
+            "errors": self.errors,
+        }
+
+def get_container(request: Request) -> AppContainer:
+    """依赖注入：获取应用容器"""
+    return request.app.state.container
+
+def get_graph(request: Request) -> CompiledStateGraph:
+    """依赖注入：获取编译后的工作流图"""
+    return get_container(request).graph
@@ -1,14 +1,29 @@
 """API路由定义模块，提供REST API接口"""
 
-from fastapi import APIRouter, HTTPException, BackgroundTasks, WebSocket, WebSocketDisconnect
+from fastapi import APIRouter, HTTPException, BackgroundTasks, WebSocket, WebSocketDisconnect, Depends
 from datetime import datetime
 import uuid
 import json
+import time
+from typing import Optional
 
-from models.schema import UserInput, SystemResponse
-from models.database import create_conversation, add_message, get_conversation_history
-from workflows.graph import build_enterprise_bot_graph
-from workflows.router import State
+from models.schema import UserInput, SystemResponse, ActualCostUpdate
+from models.database import message_to_dict
+from models.async_database import (
+    create_conversation, add_message, get_conversation_history, save_trace, get_trace,
+    list_projects, update_actual_cost,
+)
+from langgraph.graph.state import CompiledStateGraph
+from langgraph.types import Command
+from workflows.router import State, add_counters, TOOL_NODES
+from workflows import retrieval, budget, checkpoint
+from workflows.memory import get_conversation_memory
+from api.container import AppContainer, get_container, get_graph
+from api.singleflight import Flight, coalescer, request_key
+from utils.helpers import generate_id
+from utils.stream_json import StreamingJSONParser
+from utils import llm, metrics, tracing
+from config import MODEL_PROFILES, ESCALATION_MODEL, LLM_REQUEST_TIMEOUT, TRACE_PERSIST
 from utils.logger import get_logger
 from fastapi.websockets import WebSocketState  # 新增导入
 
@@ -21,11 +36,31 @@ router = APIRouter(prefix="/api", tags=["enterprise-bot"])
 # 存储活跃的WebSocket连接
 active_connections = {}
 
+# 活跃连接数和进行中的执行数在导出指标时读取
+metrics.websocket_connections.set_function(lambda: sum(len(connections) for connections in active_connections.values()))
+metrics.graph_runs_in_flight.set_function(lambda: coalescer.snapshot()["in_flight"])
+
+# 以JSON返回路由结果的节点，只转发其中作为最终回答的output字段
+ANSWER_NODES = ["main", "plan"]
+# 以JSON返回结果的节点中需要流式转发的字段
+STREAM_FIELDS = {"main": "output", "plan": "output", "company": "answer"}
+
+def _is_final_answer(fields: dict):
+    """根据已解析的路由字段判断output是否为最终回答，字段不足以判断时返回None"""
+    if "steps" in fields:
+        # 计划节点：没有需要调用的节点时output为直接回答
+        return not fields["steps"]
+    if "next_node" in fields:
+        return fields["next_node"] == "__end__"
+    if "is_final" in fields:
+        return fields["is_final"] in [True, "True", 1, "true", "TRUE", "1"]
+    return None
+
 # 健康检查端点
 @router.get("/health")
-async def health_check():
-    """健康检查端点"""
-    return {"status": "ok", "timestamp": datetime.now().isoformat()}
+async def health_check(container: AppContainer = Depends(get_container)):
+    """健康检查端点，附带应用容器的启动报告"""
+    return {"status": "ok", "timestamp": datetime.now().isoformat(), "startup": container.report()}
 
 # WebSocket连接端点
 @router.websocket("/ws/{conversation_id}")
@@ -56,20 +91,34 @@ async def websocket_endpoint(websocket: WebSocket, conversation_id: str):
 
 # 对话端点
 @router.post("/chat", response_model=SystemResponse)
-async def chat(user_input: UserInput, background_tasks: BackgroundTasks):
+async def chat(user_input: UserInput, background_tasks: BackgroundTasks,
+               graph: CompiledStateGraph = Depends(get_graph)):
     """处理用户对话请求"""
     log.info(f"收到用户消息: {user_input.message[:50]}...")
+    received_at = time.perf_counter()
     
+    request_id = generate_id("req")
+
     # 创建或获取对话
     conversation_id = user_input.context.get("conversation_id") if user_input.context else None
     if not conversation_id:
-        conversation_id = create_conversation()
-    
-    # 添加用户消息到数据库
-    add_message(conversation_id, "user", user_input.message)
+        conversation_id = await create_conversation()
+    trace = tracing.start_trace(request_id, conversation_id, user_input.message)
     
-    # 获取对话历史
-    history = get_conversation_history(conversation_id)
+    with tracing.activate(trace), tracing.span("prepare", "api"):
+        # 获取对话历史（对话摘要和最近消息），活跃对话直接从对话记忆读取
+        history = await get_conversation_memory().aget_context(conversation_id)
+        # 请求合并的键不包含与当前消息相同的用户消息，保存用户消息前后的计算结果相同
+        key = request_key(user_input.message, history)
+        flight = coalescer.get(key)
+        # 同一对话的重复提交合并到进行中的执行，用户消息已由首次提交保存
+        duplicate = flight is not None and conversation_id in flight.subscribers
+        # 同一消息此前的运行中断时从最后完成的节点继续，用户消息已在上次请求中保存
+        snapshot = None if duplicate else await checkpoint.find_run(graph, conversation_id, user_input.message)
+        if snapshot is None and not duplicate:
+            # 添加用户消息到数据库
+            await record_message(conversation_id, "user", user_input.message)
+            history = await get_conversation_memory().aget_context(conversation_id)
     
     # 立即通过WebSocket发送开始处理通知
     if conversation_id in active_connections:
@@ -81,94 +130,195 @@ async def chat(user_input: UserInput, background_tasks: BackgroundTasks):
         for connection in active_connections[conversation_id]:
             await send_websocket_message(connection, start_data)
 
+    # 相同请求执行期间合并到进行中的执行，不再重复运行工作流
+    flight = coalescer.get(key)
+    if flight is not None:
+        coalescer.attach(flight, conversation_id)
+        await finish_request_trace(trace, coalesced=True, leader_conversation_id=flight.conversation_id)
+        metrics.chat_requests.inc(outcome="coalesced")
+        background_tasks.add_task(follow_flight, flight, conversation_id)
+        return SystemResponse(
+            response_id=f"resp_{uuid.uuid4()}",
+            message="您的请求正在处理中，请稍候...",
+            data={
+                "conversation_id": conversation_id,
+                "status": "processing",
+                "coalesced": True
+            }
+        )
+    flight = coalescer.start(key, conversation_id)
+    metrics.chat_requests.inc(outcome="run")
+
     async def process_message():
-        try:
-            log.info(f"开始处理消息流，conversation_id: {conversation_id}")
-            graph = build_enterprise_bot_graph()
-            init_state = State(
-                message=user_input.message,
-                conversation_id=conversation_id,
-                history=history,
-                current_tool=None,
-                tools_response=[]
-            )
-            json_del = False
-            async for step in graph.astream_events(init_state,version="v2"):
-                # log.info(f"当前event: {step}")
-                if step["event"] == "on_chat_model_stream":
-                    response = step["data"]["chunk"].content
-                    if not json_del:
-                        # 检查是否以 "```json" 开头
-                        if response.startswith("```json") or response.startswith("{"):
-                            json_del = True
-                            continue
-                    if json_del:
-                        # 检查是否以 "```" 结尾
-                        if response.endswith("```") or response.endswith("}"):
-                            json_del = False
-
-                        continue
-                    if conversation_id in active_connections:
-                        response_data = {
-                            "conversation_id": conversation_id,
-                            "status": "streaming",
-                            "message": response,
-                        }
-                        for connection in active_connections[conversation_id]:
-                            await send_websocket_message(connection, response_data)
-                elif step["event"] == "on_chain_end":
-                    output = step["data"]["output"]
-                    if not isinstance(output, dict):
-                        if isinstance(output, str) and output=="__end__":
-                            break
-                        continue
-                    # 实时发送每个状态更新
-                    if output.get("response"):
-                        response = output.get("response")
-                        add_message(conversation_id, "system", response)
+        # 请求追踪随上下文传递到各节点线程和模型调用线程
+        with tracing.activate(trace):
+            # 请求内全部模型调用共享同一个截止时间
+            deadline_token = llm.set_request_deadline(LLM_REQUEST_TIMEOUT)
+            # 请求计数器，由各节点输出的增量累加而来，写入请求追踪
+            request_counters = {}
+            trace_attrs = {}
+            turn_status = "completed"
+            first_token_sent = False
+            try:
+                log.info(f"开始处理消息流，conversation_id: {conversation_id}, request_id: {request_id}")
+                config = checkpoint.run_config(conversation_id, request_id)
+                graph_input = State(
+                    message=user_input.message,
+                    conversation_id=conversation_id,
+                    request_id=request_id,
+                    history=history,
+                    current_tool=None,
+                    next_nodes=[],
+                    tools_response=[],
+                    artifacts={},
+                    data={},
+                    plan=[],
+                    retrieval_memo={},
+                    counters={},
+                    deadline=budget.new_deadline(),
+                    hops=0
+                )
+
+                # 从检查点继续的运行，已完成节点的输出直接复用
+                if snapshot is not None:
+                    snapshot_config = checkpoint.thread_config(conversation_id, snapshot.config["configurable"]["thread_id"])
+                    if not snapshot.next and snapshot.values.get("response"):
+                        # 运行已经结束但回答未能保存，直接返回已生成的回答
+                        log.info(f"复用已完成运行的回答: {snapshot_config['configurable']['thread_id']}")
+                        response = snapshot.values["response"]
+                        await save_response(flight, response)
+                        await publish(flight, {"status": "completed", "message": response})
+                        await checkpoint.delete_run(graph, snapshot_config)
+                        return
+                    if snapshot.next:
+                        config = snapshot_config
+                        log.info(f"从检查点继续运行: {config['configurable']['thread_id']}, 待执行节点: {snapshot.next}")
+                        # 请求ID和截止时间属于本次请求，其余状态沿用检查点
+                        graph_input = Command(update={"request_id": request_id, "deadline": budget.new_deadline()})
+                        request_counters["checkpoint_resumed"] = 1
+                    else:
+                        await checkpoint.delete_run(graph, snapshot_config)
+
+                # 最终回答保存后删除运行的检查点
+                answered = False
+                # 按模型调用维护增量JSON解析器，以及路由结果尚未确定前暂存的回答
+                stream_parsers = {}
+                pending_answers = {}
+                # 各工具节点流式输出的序号
+                tool_sequences = {}
+                # 调用过工具节点后由汇总节点生成最终回答，主路由的output不再转发（继续运行时以检查点中的结果为准）
+                tools_called = bool(snapshot is not None and snapshot.next and snapshot.values.get("tools_response"))
+                with tracing.span("workflow", "api"), checkpoint.running(config):
+                    async for step in graph.astream_events(graph_input, config, version="v2"):
+                        # log.info(f"当前event: {step}")
+                        if step["event"] == "on_chat_model_stream":
+                            run_id = step["run_id"]
+                            # 超时放弃的模型调用迟到的输出不再转发，重试的调用会重新输出
+                            if llm.is_abandoned(run_id):
+                                continue
+                            node = step["metadata"].get("langgraph_node")
+                            if node == "main" and tools_called:
+                                continue
+                            if run_id not in stream_parsers:
+                                # 路由节点只转发JSON中的output字段，企业智库节点只转发answer字段，其他节点转发文本输出、忽略JSON输出
+                                stream_parsers[run_id] = StreamingJSONParser(STREAM_FIELDS.get(node))
+                            parser = stream_parsers[run_id]
+                            response = parser.feed(step["data"]["chunk"].content)
+                            if node in ANSWER_NODES:
+                                # 输出不是JSON时路由由兜底规则决定，原文不作为回答转发，最终回答随节点结束的消息发送
+                                if not parser.is_json:
+                                    continue
+                                is_final_answer = _is_final_answer(parser.fields)
+                                if is_final_answer is None:
+                                    pending_answers[run_id] = pending_answers.get(run_id, "") + response
+                                    continue
+                                if not is_final_answer:
+                                    continue
+                                response = pending_answers.pop(run_id, "") + response
+                            if not response:
+                                continue
+                            # 首个token时间：整个请求的首个转发输出，以及各节点各自的首个输出
+                            tracing.mark("first_token")
+                            tracing.mark(f"first_token:{node}")
+                            if not first_token_sent:
+                                first_token_sent = True
+                                metrics.chat_ttft_seconds.observe(time.perf_counter() - received_at)
+                            if node in TOOL_NODES:
+                                # 工具节点在各自的通道上流式输出，并行节点的输出按工具名和序号区分
+                                tool_sequences[node] = tool_sequences.get(node, 0) + 1
+                                response_data = {
+                                    "status": "tool_stream",
+                                    "message": response,
+                                    "tool_name": node,
+                                    "sequence": tool_sequences[node],
+                                }
+                            else:
+                                response_data = {
+                                    "status": "streaming",
+                                    "message": response,
+                                }
+                            await publish(flight, response_data)
+                        elif step["event"] == "on_chat_model_end":
+                            stream_parsers.pop(step["run_id"], None)
+                            pending_answers.pop(step["run_id"], None)
+                        elif step["event"] == "on_chain_end":
+                            output = step["data"]["output"]
+                            # 只处理图节点的输出；路由函数的结束事件先于节点的结束事件到达，不能据此提前退出
+                            if not isinstance(output, dict) or not (step["tags"] and step["tags"][0].startswith("graph")):
+                                continue
+                            request_counters = add_counters(request_counters, output.get("counters"))
+                            tools_called = tools_called or bool(output.get("tools_response"))
+                            # 实时发送每个状态更新
+                            if output.get("response"):
+                                response = output.get("response")
+                                await save_response(flight, response)
+                                answered = answered or bool(output.get("is_final"))
                         
-                        if conversation_id in active_connections:
-                            response_data = {
-                                "conversation_id": conversation_id,
-                                "status": "completed" if output.get("is_final") else "processing",
-                                "message": response,
-                            }
-                            for connection in active_connections[conversation_id]:
-                                await send_websocket_message(connection, response_data)
+                                response_data = {
+                                    "status": "completed" if output.get("is_final") else "processing",
+                                    "message": response,
+                                }
+                                await publish(flight, response_data)
                     
-                    elif output.get("current_tool") and step["tags"][0].startswith("graph"):
-                        # log.info(f"event:{step}")
-                        tool_response = ""
-                        if output.get('tools_response') not in [None,""]:
-                            for tool in output.get('tools_response'):
-                                log.info(f"当前工具response: {tool}")
-                                if tool.get("node") == output.get('current_tool'):
-                                    if tool.get("result"):
-                                        tool_response += tool.get("result") + "\n"
-                        
-                        if conversation_id in active_connections:
-                            tool_data = {
-                                "conversation_id": conversation_id,
-                                "status": "tool",
-                                "message": tool_response,
-                                "tool_name": output.get('current_tool')
-                            }
-                            for connection in active_connections[conversation_id]:
-                                await send_websocket_message(connection, tool_data)
+                            else:
+                                # 节点输出为增量更新：调度节点返回即将并行执行的工具，工具节点返回各自的结果
+                                tool_frames = [(tool_name, "") for tool_name in output.get("next_nodes") or []]
+                                for tool in output.get("tools_response") or []:
+                                    log.info(f"当前工具response: {tool}")
+                                    artifact = (output.get("artifacts") or {}).get(tool.get("artifact_id"), {})
+                                    tool_frames.append((tool.get("node"), artifact.get("content", "") + "\n"))
+
+                                for tool_name, tool_response in tool_frames:
+                                    tool_data = {
+                                        "status": "tool",
+                                        "message": tool_response,
+                                        "tool_name": tool_name
+                                    }
+                                    await publish(flight, tool_data)
+
+                if answered:
+                    await checkpoint.delete_run(graph, config)
+                log.info(f"请求追踪: {request_id}, 计数器: {request_counters}")
             
-        except Exception as e:
-            error_msg = f"处理消息时出错: {str(e)}"
-            log.error(error_msg)
-            add_message(conversation_id, "system", f"处理请求时出现错误: {str(e)}")
+            except Exception as e:
+                error_msg = f"处理消息时出错: {str(e)}"
+                log.error(error_msg)
+                trace_attrs["error"] = str(e)[:200]
+                turn_status = "error"
+                await save_response(flight, f"处理请求时出现错误: {str(e)}")
             
-            if conversation_id in active_connections:
                 error_data = {
-                    "conversation_id": conversation_id,
                     "status": "error",
                     "message": f"处理请求时出现错误: {str(e)}",
                 }
-                for connection in active_connections[conversation_id]:
-                    await send_websocket_message(connection, error_data)
+                await publish(flight, error_data)
+            finally:
+                coalescer.finish(flight)
+                llm.reset_request_deadline(deadline_token)
+                # 释放请求级的预取检索结果
+                retrieval.release(request_id)
+                await finish_request_trace(trace, counters=request_counters, subscribers=len(flight.subscribers), **trace_attrs)
+                metrics.chat_turn_seconds.observe(time.perf_counter() - received_at, status=turn_status)
     
     background_tasks.add_task(process_message)
     
@@ -181,9 +331,59 @@ async def chat(user_input: UserInput, background_tasks: BackgroundTasks):
         }
     )
 
+async def finish_request_trace(trace: Optional[tracing.Trace], **attrs):
+    """结束请求追踪，开启 TRACE_PERSIST 时同时保存到数据库"""
+    tracing.finish_trace(trace, **attrs)
+    if trace is not None and TRACE_PERSIST:
+        await save_trace(trace.to_dict())
+
+async def record_message(conversation_id: str, role: str, content: str):
+    """消息写入数据库，并追加到对话记忆"""
+    message = await add_message(conversation_id, role, content)
+    get_conversation_memory().append_message(conversation_id, message_to_dict(message))
+
+async def save_response(flight: Flight, response: str):
+    """将回答写入执行的全部订阅对话，补发期间执行已结束的订阅者自行写入"""
+    flight.response = response
+    for subscriber in list(flight.subscribers):
+        await record_message(subscriber, "system", response)
+
+async def broadcast(conversation_id: str, data: dict):
+    """发送消息到对话的全部WebSocket连接"""
+    for connection in list(active_connections.get(conversation_id, [])):
+        await send_websocket_message(connection, {"conversation_id": conversation_id, **data})
+
+async def publish(flight: Flight, data: dict):
+    """发送消息到执行的全部订阅对话，并记录下来补发给后加入的订阅者"""
+    flight.frames.append(data)
+    for subscriber in list(flight.subscribers):
+        await broadcast(subscriber, data)
+
+async def follow_flight(flight: Flight, conversation_id: str):
+    """合并的请求：补发执行已发送的消息后订阅后续输出"""
+    # 同一对话的重复提交已经在接收该执行的输出
+    if conversation_id in flight.subscribers:
+        return
+    sent = 0
+    while sent < len(flight.frames):
+        await broadcast(conversation_id, flight.frames[sent])
+        sent += 1
+    # 补发与订阅之间没有await，不会漏掉消息
+    if not flight.done:
+        coalescer.subscribe(flight, conversation_id)
+        # 订阅前已经保存的回答不会再写入本对话，由订阅者自行写入
+        if flight.response is not None:
+            await record_message(conversation_id, "system", flight.response)
+    elif flight.response is not None:
+        await record_message(conversation_id, "system", flight.response)
+    else:
+        await record_message(conversation_id, "system", "处理请求时出现错误: 合并的执行已中断")
+        await broadcast(conversation_id, {"status": "error", "message": "处理请求时出现错误: 合并的执行已中断"})
+
 # 辅助函数：发送WebSocket消息
 async def send_websocket_message(websocket: WebSocket, data: dict):
     """发送WebSocket消息"""
+    start = time.perf_counter()
     try:
         if websocket.application_state == WebSocketState.CONNECTED:
             log.debug(f"准备发送消息到 {websocket}: {data}")  # 新增调试日志
@@ -202,13 +402,66 @@ async def send_websocket_message(websocket: WebSocket, data: dict):
                 connections.remove(websocket)
                 if not connections:
                     del active_connections[conv_id]
+    finally:
+        # 发送次数多，只累计次数和耗时
+        tracing.add_total("websocket_send", time.perf_counter() - start)
+
+# 模型调用统计端点
+@router.get("/models/metrics")
+async def get_model_metrics():
+    """获取各模型配置的调用次数、升级次数、延迟和token用量"""
+    return {
+        "profiles": MODEL_PROFILES,
+        "escalation_model": ESCALATION_MODEL,
+        "metrics": llm.metrics.snapshot(),
+        "circuit_breakers": llm.breaker_states(),
+    }
+
+# 请求合并统计端点
+@router.get("/chat/coalescing")
+async def get_coalescing_metrics():
+    """请求合并统计：执行次数、被合并（节省）的执行次数和进行中的执行"""
+    return coalescer.snapshot()
+
+# 请求追踪端点
+@router.get("/traces")
+async def list_traces(limit: int = 20, slowest: bool = False):
+    """最近请求的追踪摘要，slowest=true 时按耗时从高到低排序"""
+    traces = tracing.trace_store.recent(limit, slowest)
+    return {"traces": [trace.to_dict(spans=False) for trace in traces]}
+
+@router.get("/traces/{request_id}")
+async def get_request_trace(request_id: str):
+    """单个请求的完整追踪：各节点、模型调用、检索、嵌入和数据库调用的耗时"""
+    trace = tracing.trace_store.get(request_id)
+    if trace is not None:
+        return trace.to_dict()
+    saved = await get_trace(request_id) if TRACE_PERSIST else None
+    if saved is None:
+        raise HTTPException(status_code=404, detail=f"请求追踪不存在: {request_id}")
+    return saved
+
+# 历史项目端点
+@router.get("/projects")
+async def get_projects(limit: int = 20):
+    """最近的报价测算项目，用于查找需要回填实际成本的项目ID"""
+    return {"projects": await list_projects(limit)}
+
+@router.put("/projects/{project_id}/actual-cost")
+async def put_actual_cost(project_id: str, update: ActualCostUpdate):
+    """项目结束后回填实际成本，相似项目查询会返回回填后的实际成本"""
+    try:
+        await update_actual_cost(project_id, update.actual_cost, update.status)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"project_id": project_id, "actual_cost": update.actual_cost, "status": update.status}
 
 # 获取对话历史端点
 @router.get("/conversations/{conversation_id}/history")
 async def get_history(conversation_id: str, limit: int = 10):
     """获取对话历史"""
     try:
-        history = get_conversation_history(conversation_id, limit)
+        history = await get_conversation_history(conversation_id, limit)
         return {"conversation_id": conversation_id, "messages": history}
     except Exception as e:
         log.error(f"获取对话历史时出错: {str(e)}")
@@ -220,7 +473,7 @@ async def get_conversation_status(conversation_id: str):
     """获取对话处理状态"""
     try:
         # 获取最新消息
-        history = get_conversation_history(conversation_id, 1)
+        history = await get_conversation_history(conversation_id, 1)
         if not history:
             return {"status": "not_found"}
         
@@ -2,11 +2,13 @@
 
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 import time
 from datetime import datetime
 
 from api.routes import router
+from api.container import AppContainer
+from utils import metrics
 from utils.logger import get_logger
 from config import validate_config
 
@@ -67,12 +69,25 @@ async def root():
         "timestamp": datetime.now().isoformat()
     }
 
+# 运行指标端点
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """按Prometheus文本格式导出运行指标"""
+    return Response(content=metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
+
 # 启动事件
 @app.on_event("startup")
 async def startup_event():
     log.info("API服务器启动")
+    # 工作流图、Agent、检索服务和数据库引擎只在启动时创建一次
+    container = AppContainer()
+    await container.start()
+    app.state.container = container
 
 # 关闭事件
 @app.on_event("shutdown")
 async def shutdown_event():
-    log.info("API服务器关闭")
\ No newline at end of file
+    log.info("API服务器关闭")
+    container = getattr(app.state, "container", None)
+    if container is not None:
+        await container.shutdown()
\ No newline at end of file
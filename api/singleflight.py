@@ -0,0 +1,99 @@
+"""请求合并模块，相同的对话请求在执行期间只运行一次工作流
+
+以 归一化消息 + 最近历史摘要 作为键：
+- 第一个请求启动工作流执行，成为该执行的发起者
+- 执行期间到达的相同请求不再启动新的执行，补发已发送的消息后订阅同一执行的后续输出
+- 执行结束后最终回答写入每个订阅对话
+
+所有操作都在事件循环中执行，不需要加锁。
+"""
+
+import time
+from typing import Any, Dict, List, Optional
+
+from config import CHAT_COALESCING, HISTORY_RECENT_MESSAGES
+from models.analysis_cache import normalize_text, fingerprint
+from utils.logger import get_logger
+
+# 获取日志记录器
+log = get_logger("singleflight")
+
+def request_key(message: str, history: List[Dict[str, Any]], recent: int = HISTORY_RECENT_MESSAGES) -> str:
+    """请求合并的键：归一化消息 + 最近历史的摘要
+
+    历史中与当前消息相同的用户消息（包括重复提交产生的消息）不计入摘要，
+    重复提交和不同对话中首次提出的相同问题得到相同的键。
+    """
+    message = normalize_text(message)
+    relevant = [
+        f"{item.get('role')}:{normalize_text(item.get('content', ''))}"
+        for item in history
+        if not (item.get("role") == "user" and normalize_text(item.get("content", "")) == message)
+    ]
+    relevant = relevant[-recent:] if recent else []
+    return fingerprint("\n".join([message] + relevant))
+
+class Flight:
+    """一次进行中的工作流执行及其订阅对话"""
+
+    def __init__(self, key: str, conversation_id: str):
+        self.key = key
+        self.conversation_id = conversation_id
+        self.subscribers: List[str] = [conversation_id]
+        self.frames: List[Dict[str, Any]] = []  # 已发送的消息，补发给后加入的订阅者
+        self.response: Optional[str] = None
+        self.done = False
+        self.started_at = time.time()
+
+class RequestCoalescer:
+    """请求合并器，按键记录进行中的执行"""
+
+    def __init__(self, enabled: bool = CHAT_COALESCING):
+        self.enabled = enabled
+        self._flights: Dict[str, Flight] = {}
+        self.stats = {"runs": 0, "coalesced": 0}
+
+    def get(self, key: str) -> Optional[Flight]:
+        """获取进行中的执行，未启用请求合并时始终返回None"""
+        if not self.enabled:
+            return None
+        flight = self._flights.get(key)
+        return flight if flight is not None and not flight.done else None
+
+    def start(self, key: str, conversation_id: str) -> Flight:
+        """登记新的执行"""
+        flight = Flight(key, conversation_id)
+        self._flights[key] = flight
+        self.stats["runs"] += 1
+        return flight
+
+    def attach(self, flight: Flight, conversation_id: str):
+        """登记合并到进行中执行的请求，补发已发送的消息后再调用 subscribe 订阅后续输出"""
+        self.stats["coalesced"] += 1
+        log.info(f"请求合并到进行中的执行: {conversation_id} -> {flight.conversation_id}")
+
+    def subscribe(self, flight: Flight, conversation_id: str):
+        if conversation_id not in flight.subscribers:
+            flight.subscribers.append(conversation_id)
+
+    def finish(self, flight: Flight, response: Optional[str] = None):
+        """执行结束，之后到达的相同请求重新执行；未传入回答时保留已保存的回答"""
+        if response is not None:
+            flight.response = response
+        flight.done = True
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def snapshot(self) -> Dict[str, Any]:
+        """合并统计：执行次数、被合并的请求数（即节省的执行次数）和进行中的执行"""
+        total = self.stats["runs"] + self.stats["coalesced"]
+        return {
+            **self.stats,
+            "saved_runs": self.stats["coalesced"],
+            "coalesce_rate": round(self.stats["coalesced"] / total, 4) if total else 0.0,
+            "in_flight": len(self._flights),
+            "subscribers": sum(len(flight.subscribers) for flight in self._flights.values()),
+        }
+
+# 共享的请求合并器
+coalescer = RequestCoalescer()
@@ -0,0 +1,104 @@
+"""对话接口数据库访问的事件循环阻塞基准测试，对比同步与异步数据库访问
+
+模拟并发对话请求在事件循环中的数据库操作：创建对话、写入用户消息、读取历史、
+流式输出期间让出事件循环，最后写入回答。同时运行一个每毫秒唤醒一次的探测任务，
+唤醒延迟即事件循环被阻塞的时间，阻塞期间其他对话的流式输出和WebSocket心跳都无法发送。
+
+- sync: 在协程中直接调用 models.database 的同步函数（改造前 api/routes.py 的做法）
+- async: 调用 models.async_database 的异步函数
+
+运行方式:
+    python -m benchmarks.db_event_loop
+    python -m benchmarks.db_event_loop --chats 100 --history 200
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+ROOT_DIR = Path(__file__).parent.parent.absolute()
+sys.path.insert(0, str(ROOT_DIR))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# 使用临时数据库，不影响应用数据
+os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="db_event_loop_"), "benchmark.db")
+
+from models import database, async_database
+
+# 探测任务的唤醒间隔（秒）
+PROBE_INTERVAL = 0.001
+# 每个对话流式输出的片段数和片段间隔（秒）
+STREAM_CHUNKS = 20
+STREAM_INTERVAL = 0.005
+
+async def sync_chat(history_size: int):
+    conversation_id = database.create_conversation()
+    for index in range(history_size):
+        database.add_message(conversation_id, "user" if index % 2 == 0 else "system", f"历史消息{index}" * 20)
+    database.add_message(conversation_id, "user", "帮我拆解一下社区信息公示平台的需求并给出报价")
+    database.get_conversation_history(conversation_id, 10)
+    for _ in range(STREAM_CHUNKS):
+        await asyncio.sleep(STREAM_INTERVAL)
+    database.add_message(conversation_id, "system", "汇总回答" * 200)
+
+async def async_chat(history_size: int):
+    conversation_id = await async_database.create_conversation()
+    for index in range(history_size):
+        await async_database.add_message(conversation_id, "user" if index % 2 == 0 else "system", f"历史消息{index}" * 20)
+    await async_database.add_message(conversation_id, "user", "帮我拆解一下社区信息公示平台的需求并给出报价")
+    await async_database.get_conversation_history(conversation_id, 10)
+    for _ in range(STREAM_CHUNKS):
+        await asyncio.sleep(STREAM_INTERVAL)
+    await async_database.add_message(conversation_id, "system", "汇总回答" * 200)
+
+async def probe(lags: List[float], stop: asyncio.Event):
+    """每隔 PROBE_INTERVAL 唤醒一次，记录超出预期的唤醒延迟"""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(max(0.0, time.perf_counter() - start - PROBE_INTERVAL))
+
+async def run_mode(mode: str, chats: int, history_size: int) -> Dict[str, float]:
+    chat = sync_chat if mode == "sync" else async_chat
+    lags: List[float] = []
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(chat(history_size) for _ in range(chats)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe_task
+    # 异步引擎的连接绑定在当前事件循环上，结束前释放
+    await async_database.async_db.close()
+
+    lags.sort()
+    return {
+        "elapsed": elapsed,
+        "max_lag": lags[-1] * 1000 if lags else 0.0,
+        "p99_lag": lags[int(len(lags) * 0.99)] * 1000 if lags else 0.0,
+        "mean_lag": statistics.mean(lags) * 1000 if lags else 0.0,
+        "stalled": sum(lag for lag in lags if lag > 0.01),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=50, help="并发对话数")
+    parser.add_argument("--history", type=int, default=20, help="每个对话预先写入的历史消息数")
+    args = parser.parse_args()
+
+    database.db.initialize()
+    print(f"并发对话: {args.chats}, 每个对话写入消息: {args.history + 2}, 数据库: {database.db.db_path}")
+    print(f"{'模式':<8}{'耗时(秒)':>10}{'最大阻塞(ms)':>14}{'P99阻塞(ms)':>14}{'平均延迟(ms)':>14}{'阻塞>10ms合计(秒)':>20}")
+    for mode in ["sync", "async"]:
+        result = asyncio.run(run_mode(mode, args.chats, args.history))
+        print(f"{mode:<8}{result['elapsed']:>10.3f}{result['max_lag']:>14.1f}{result['p99_lag']:>14.1f}"
+              f"{result['mean_lag']:>14.2f}{result['stalled']:>20.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""SQLite存储基准测试，对比默认参数与调优参数下的消息写入和对话历史读取吞吐量
+
+- default: SQLite默认参数（回滚日志、synchronous=FULL），消息表没有按对话和时间的复合索引
+- tuned: SQLITE_PRAGMAS（WAL、synchronous=NORMAL、mmap等）和 models/migrations.py 中的索引
+
+写入测试每条消息单独提交，与对话接口一致；读取测试随机读取对话最近10条消息。
+每种配置使用新的临时数据库文件，结果受磁盘刷盘性能影响较大，应在部署环境的磁盘上运行。
+
+运行方式:
+    python -m benchmarks.db_storage
+    python -m benchmarks.db_storage --conversations 500 --messages 40 --reads 5000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict
+
+ROOT_DIR = Path(__file__).parent.parent.absolute()
+sys.path.insert(0, str(ROOT_DIR))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from sqlalchemy import text
+
+from models import database
+from models.database import Database
+
+def run_profile(profile: str, conversations: int, messages: int, reads: int) -> Dict[str, float]:
+    path = os.path.join(tempfile.mkdtemp(prefix="db_storage_"), f"{profile}.db")
+    db = Database(path, pragmas={} if profile == "default" else None)
+    db.initialize()
+    if profile == "default":
+        with db.engine.begin() as conn:
+            conn.execute(text("DROP INDEX ix_messages_conversation_timestamp"))
+    # 数据库操作函数使用模块级的 db
+    database.db = db
+    try:
+        conversation_ids = [database.create_conversation() for _ in range(conversations)]
+
+        # 消息交替写入各对话，与多个对话同时进行时的写入顺序一致
+        start = time.perf_counter()
+        for index in range(messages):
+            for conversation_id in conversation_ids:
+                database.add_message(conversation_id, "user" if index % 2 == 0 else "system", f"消息{index}" * 20)
+        insert_seconds = time.perf_counter() - start
+
+        rng = random.Random(0)
+        start = time.perf_counter()
+        for _ in range(reads):
+            database.get_conversation_history(rng.choice(conversation_ids), 10)
+        read_seconds = time.perf_counter() - start
+    finally:
+        db.close()
+
+    return {
+        "inserts_per_second": conversations * messages / insert_seconds,
+        "reads_per_second": reads / read_seconds,
+        "read_ms": read_seconds / reads * 1000,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=200, help="对话数")
+    parser.add_argument("--messages", type=int, default=20, help="每个对话写入的消息数")
+    parser.add_argument("--reads", type=int, default=2000, help="读取对话历史的次数")
+    args = parser.parse_args()
+
+    print(f"对话: {args.conversations}, 每个对话消息: {args.messages}, 历史读取: {args.reads}")
+    print(f"{'配置':<10}{'写入(条/秒)':>14}{'读取(次/秒)':>14}{'单次读取(ms)':>14}")
+    for profile in ["default", "tuned"]:
+        result = run_profile(profile, args.conversations, args.messages, args.reads)
+        print(f"{profile:<10}{result['inserts_per_second']:>14.0f}{result['reads_per_second']:>14.0f}{result['read_ms']:>14.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""工作流模式基准测试，对比react与plan两种模式的LLM调用次数、提示长度和端到端耗时
+
+两种模式都会并行执行互不依赖的工具节点，“公司+需求”场景的耗时接近较慢的单个节点。
+
+使用固定延迟的模拟LLM替换各Agent的模型，延迟由基础延迟、提示长度和输出长度三部分组成，
+以排除网络波动对对比结果的影响。
+
+运行方式:
+    python -m benchmarks.workflow_modes
+    RETRIEVAL_PREFETCH=false python -m benchmarks.workflow_modes  # 关闭检索预取作为对照
+"""
+
+import os
+import sys
+import json
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+ROOT_DIR = Path(__file__).parent.parent.absolute()
+sys.path.insert(0, str(ROOT_DIR))
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from langchain_core.messages import AIMessage
+
+from agents import entry_point, analyzer, estimator, knowledge
+from models import search
+from workflows import router, retrieval
+from workflows.graph import build_enterprise_bot_graph
+
+# 模拟LLM的基础延迟（秒），以及每千字符提示和每千字符输出带来的额外延迟（秒）
+BASE_LATENCY = 0.2
+LATENCY_PER_1K_CHARS = 0.05
+LATENCY_PER_1K_OUTPUT_CHARS = 0.5
+# 模拟检索延迟（秒），命中预取时被路由LLM调用掩盖
+SEARCH_LATENCY = 0.15
+
+# 基准场景：名称 -> (用户消息, 需要调用的节点)
+SCENARIOS = {
+    "需求+报价": ("帮我拆解一下社区信息公示平台的需求并给出报价", ["requirement", "estimation"]),
+    "公司+需求": ("介绍一下你们公司，并分析社区信息公示平台的需求", ["company", "requirement"]),
+    "通用问题": ("你好，你能做什么？", []),
+}
+
+class SimulatedLLM:
+    """模拟LLM，记录调用次数和提示长度"""
+
+    def __init__(self, responder: Callable[[List], str]):
+        self.responder = responder
+        self.calls = 0
+        self.prompt_chars = 0
+
+    def invoke(self, messages, *args, **kwargs) -> AIMessage:
+        prompt_chars = sum(len(message.content) for message in messages)
+        self.calls += 1
+        self.prompt_chars += prompt_chars
+        content = self.responder(messages)
+        time.sleep(BASE_LATENCY + prompt_chars / 1000 * LATENCY_PER_1K_CHARS
+                   + len(content) / 1000 * LATENCY_PER_1K_OUTPUT_CHARS)
+        return AIMessage(content=content)
+
+class SimulatedSearchHelper:
+    """模拟搜索助手"""
+
+    def search_knowledge_base(self, query: str, limit: int = 5) -> List[Dict]:
+        time.sleep(SEARCH_LATENCY)
+        return [{"id": 1, "content": "社区信息公示平台报价矩阵" * 20, "source": "docs/报价.xls", "relevance": 1.0}]
+
+    def format_search_results(self, results: List[Dict]) -> str:
+        return "\n".join(result["content"] for result in results)
+
+def entry_point_responder(nodes: List[str]) -> Callable[[List], str]:
+    """根据场景生成主路由、计划与汇总的模拟响应"""
+    def respond(messages: List) -> str:
+        system_prompt = messages[0].content
+        if system_prompt == entry_point.PLANNER_SYSTEM_PROMPT:
+            steps = [{"node": node, "inputs": "社区信息公示平台"} for node in nodes]
+            return json.dumps({"steps": steps, "output": "" if nodes else "您好"}, ensure_ascii=False)
+        if system_prompt == entry_point.SYNTHESIS_SYSTEM_PROMPT:
+            return "汇总回答" * 50
+        used_tools = messages[1].content.split("已经调用过的节点:")[-1]
+        pending = [node for node in nodes if f'"node": "{node}"' not in used_tools]
+        if pending:
+            return json.dumps({"next_node": pending, "inputs": "社区信息公示平台", "output": "", "is_final": "False"})
+        if nodes:
+            return json.dumps({"next_node": "__end__", "inputs": "", "output": "", "is_final": "False"})
+        return json.dumps({"next_node": "__end__", "inputs": "", "output": "汇总回答" * 50, "is_final": "True"}, ensure_ascii=False)
+    return respond
+
+def run_scenario(mode: str, message: str, nodes: List[str], rounds: int) -> Dict[str, float]:
+    """运行单个场景，返回平均LLM调用次数、提示长度和耗时"""
+    llms = {
+        "entry_point": SimulatedLLM(entry_point_responder(nodes)),
+        "analyzer": SimulatedLLM(lambda messages: "| 模块 | 功能 |\n" * 100),
+        "estimator": SimulatedLLM(lambda messages: "| 角色 | 工作日 |\n" * 60),
+        "knowledge": SimulatedLLM(lambda messages: json.dumps({"answer": "公司介绍" * 50, "sources": [], "confidence": 0.9}, ensure_ascii=False)),
+    }
+    entry_point_agent = entry_point.get_entry_point_agent()
+    analyzer_agent = analyzer.get_analyzer_agent()
+    estimator_agent = estimator.get_estimator_agent()
+    knowledge_agent = knowledge.get_knowledge_agent()
+    entry_point_agent.llm = llms["entry_point"]
+    entry_point_agent.synthesis_llm = llms["entry_point"]
+    analyzer_agent.llm = llms["analyzer"]
+    # 多轮重复相同请求，关闭需求分析缓存以测量真实调用
+    analyzer_agent.cache = None
+    estimator_agent.llm = llms["estimator"]
+    knowledge_agent.llm = llms["knowledge"]
+    # 模拟输出均可解析，不升级到大模型
+    for agent in (entry_point_agent, analyzer_agent, estimator_agent, knowledge_agent):
+        agent.escalation_llm = None
+
+    graph = build_enterprise_bot_graph(mode)
+    searches_avoided = 0
+    start_time = time.perf_counter()
+    for round_index in range(rounds):
+        final_state = graph.invoke(router.State(
+            message=message,
+            conversation_id="benchmark",
+            request_id=f"benchmark_{mode}_{round_index}",
+            history=[],
+            current_tool=None,
+            next_nodes=[],
+            tools_response=[],
+            artifacts={},
+            data={},
+            plan=[],
+            retrieval_memo={},
+            counters={},
+            deadline=None,
+            hops=0
+        ))
+        retrieval.release(final_state["request_id"])
+        searches_avoided += final_state["counters"].get("searches_avoided", 0)
+    elapsed = time.perf_counter() - start_time
+
+    return {
+        "router_calls": llms["entry_point"].calls / rounds,
+        "llm_calls": sum(llm.calls for llm in llms.values()) / rounds,
+        "router_prompt_chars": llms["entry_point"].prompt_chars / rounds,
+        "searches_avoided": searches_avoided / rounds,
+        "latency": elapsed / rounds,
+    }
+
+def main(rounds: int = 3):
+    search._search_helper = SimulatedSearchHelper()
+
+    print(f"{'场景':<10}{'模式':<8}{'路由调用':>8}{'LLM调用':>8}{'路由提示字符':>14}{'避免检索':>8}{'耗时(秒)':>10}")
+    for name, (message, nodes) in SCENARIOS.items():
+        results = {mode: run_scenario(mode, message, nodes, rounds) for mode in ["react", "plan"]}
+        for mode, result in results.items():
+            print(f"{name:<10}{mode:<8}{result['router_calls']:>8.1f}{result['llm_calls']:>8.1f}"
+                  f"{result['router_prompt_chars']:>14.0f}{result['searches_avoided']:>8.1f}{result['latency']:>10.3f}")
+        saved = 1 - results["plan"]["latency"] / results["react"]["latency"]
+        print(f"{'':<10}plan模式端到端耗时降低 {saved:.1%}")
+
+if __name__ == "__main__":
+    main()
@@ -25,17 +25,82 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4-turbo-preview")
 
+# 模型分层配置：路由和摘要使用快速的小模型，其余Agent默认使用OPENAI_MODEL
+SMALL_MODEL = os.getenv("SMALL_MODEL", "gpt-4o-mini")
+MODEL_PROFILES = {
+    "router": os.getenv("MODEL_ROUTER", SMALL_MODEL),
+    "synthesizer": os.getenv("MODEL_SYNTHESIZER", OPENAI_MODEL),
+    "analyzer": os.getenv("MODEL_ANALYZER", OPENAI_MODEL),
+    "estimator": os.getenv("MODEL_ESTIMATOR", OPENAI_MODEL),
+    "knowledge": os.getenv("MODEL_KNOWLEDGE", OPENAI_MODEL),
+    "general": os.getenv("MODEL_GENERAL", OPENAI_MODEL),
+    "summarizer": os.getenv("MODEL_SUMMARIZER", SMALL_MODEL),
+}
+# 小模型输出无法解析或置信度过低时升级到的模型，留空表示不升级
+ESCALATION_MODEL = os.getenv("ESCALATION_MODEL", OPENAI_MODEL)
+ESCALATION_MIN_CONFIDENCE = float(os.getenv("ESCALATION_MIN_CONFIDENCE", 0.5))
+MODEL_METRICS_WINDOW = int(os.getenv("MODEL_METRICS_WINDOW", 500))  # 计算延迟分位数的最近调用数
+
+# 模型调用容错配置
+LLM_CALL_TIMEOUT = float(os.getenv("LLM_CALL_TIMEOUT", 60))  # 单次调用超时（秒）
+LLM_STREAM_IDLE_TIMEOUT = float(os.getenv("LLM_STREAM_IDLE_TIMEOUT", 30))  # 流式调用超过此时间（秒）没有新的输出（包括首个输出）时放弃
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", 180))  # 单个请求内全部模型调用的截止时间上限（秒），工作流节点内的调用还受State中按 REQUEST_SLO 计算的截止时间限制
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 2))  # 瞬时错误的最大重试次数
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", 0.5))  # 退避基础时间（秒），每次重试翻倍并加随机抖动
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", 8))
+LLM_HEDGING = os.getenv("LLM_HEDGING", "false").lower() in ["true", "1", "yes"]  # 非流式调用超过p95延迟时发起对冲请求
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 20))  # 计算对冲阈值所需的最少样本数
+LLM_CALL_WORKERS = int(os.getenv("LLM_CALL_WORKERS", 16))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))  # 连续失败多少次后熔断
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", 30))  # 熔断后多久放行试探调用（秒）
+
 # 数据库配置
 CHROMADB_PATH = os.getenv("CHROMADB_PATH", str(ROOT_DIR / "data" / "chroma"))
 SQLITE_PATH = os.getenv("SQLITE_PATH", str(ROOT_DIR / "data" / "enterprise.db"))
+# SQLite连接参数，每个连接建立时设置：WAL模式下读写互不阻塞，synchronous=NORMAL 在WAL模式下只在检查点时刷盘
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000)),  # 等待其他连接释放写锁的时间（毫秒）
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", -16000)),  # 负数为KB
+    "temp_store": "MEMORY",
+    "foreign_keys": "ON",
+}
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", 8))  # 同步引擎连接池大小，节点线程并发访问数据库
+# 工作流检查点：每一步的状态持久化到SQLite，中断的运行可以从最后完成的节点继续
+CHECKPOINT_ENABLED = os.getenv("CHECKPOINT_ENABLED", "true").lower() in ["true", "1", "yes"]
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", str(ROOT_DIR / "data" / "checkpoints.db"))
+CHECKPOINT_STALE_AFTER = float(os.getenv("CHECKPOINT_STALE_AFTER", 600))  # 超过此时间（秒）没有新检查点的未完成运行视为已中断
 
 # 日志配置
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
 LOG_PATH = os.getenv("LOG_PATH", str(ROOT_DIR / "logs"))
 
+# 对话记忆配置：最近的对话历史缓存在内存中，按对话数和估算字节数淘汰最久未访问的对话
+MEMORY_MAX_HISTORY = int(os.getenv("MEMORY_MAX_HISTORY", 10))  # 每个对话缓存的最近消息数
+MEMORY_MAX_CONVERSATIONS = int(os.getenv("MEMORY_MAX_CONVERSATIONS", 1000))
+MEMORY_MAX_BYTES = int(os.getenv("MEMORY_MAX_BYTES", 64 * 1024 * 1024))
+MEMORY_TTL = int(os.getenv("MEMORY_TTL", 3600))  # 超过此时间（秒）未访问的对话从缓存中清理
+MEMORY_SWEEP_INTERVAL = float(os.getenv("MEMORY_SWEEP_INTERVAL", 60))  # 后台清理间隔（秒）
+
+# 对话摘要配置：滚出记忆窗口的消息由后台任务批量合并到对话摘要，使用 summarizer 模型
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "true").lower() in ["true", "1", "yes"]
+SUMMARY_BATCH_DELAY = float(os.getenv("SUMMARY_BATCH_DELAY", 2))  # 处理待摘要队列的间隔（秒），间隔内同一对话只调用一次模型
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", 4))  # 同时生成摘要的对话数
+SUMMARY_MAX_PENDING = int(os.getenv("SUMMARY_MAX_PENDING", 50))  # 每个对话最多排队的消息数
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", 500))  # 摘要的最大字数
+
+# 请求追踪配置：记录每个请求中节点、模型调用、检索、嵌入和数据库调用的耗时
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "true").lower() in ["true", "1", "yes"]
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", 200))  # 内存中保留的最近请求数
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", 500))  # 单个请求最多记录的span数
+TRACE_PERSIST = os.getenv("TRACE_PERSIST", "false").lower() in ["true", "1", "yes"]  # 追踪记录同时写入SQLite
+
 # 应用配置
 APP_PORT = int(os.getenv("APP_PORT", 8000))
 APP_HOST = os.getenv("APP_HOST", "0.0.0.0")
+APP_WARMUP = os.getenv("APP_WARMUP", "true").lower() in ["true", "1", "yes"]  # 启动时预热模型连接、嵌入模型和索引
 
 # 向量存储配置
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "bge-large:latest")
@@ -46,6 +111,72 @@ MMR_DIVERSITY = float(os.getenv("MMR_DIVERSITY", 0.5))
 SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", 0.6))
 DEFAULT_SEARCH_K = int(os.getenv("DEFAULT_SEARCH_K", 5))
 
+# 检索预取配置：意图识别的同时以用户原始消息预先检索知识库
+RETRIEVAL_PREFETCH = os.getenv("RETRIEVAL_PREFETCH", "true").lower() in ["true", "1", "yes"]
+PREFETCH_MATCH_THRESHOLD = float(os.getenv("PREFETCH_MATCH_THRESHOLD", 0.6))  # 节点查询被预取查询覆盖的比例阈值
+PREFETCH_WAIT_TIMEOUT = float(os.getenv("PREFETCH_WAIT_TIMEOUT", 10))  # 等待进行中的预取结果的最长时间（秒）
+PREFETCH_TTL = int(os.getenv("PREFETCH_TTL", 300))  # 未释放的预取结果的保留时间（秒）
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", 4))
+
+# 工作流配置
+# react: 入口Agent在每个工具节点完成后重新决策下一步
+# plan: 入口Agent一次性输出完整执行计划，按静态DAG执行后仅在最终汇总时再调用LLM
+WORKFLOW_MODES = ["react", "plan"]
+WORKFLOW_MODE = os.getenv("WORKFLOW_MODE", "react")
+# 相同请求（归一化消息+最近历史）执行期间合并到同一次执行，输出同时推送给所有订阅对话
+CHAT_COALESCING = os.getenv("CHAT_COALESCING", "true").lower() in ["true", "1", "yes"]
+
+# 请求时间预算配置：请求在截止时间前按剩余时间逐级降级，保证响应时间在SLO之内
+REQUEST_SLO = float(os.getenv("REQUEST_SLO", 60))  # 单个请求的目标响应时间（秒）
+MAX_HOPS = int(os.getenv("MAX_HOPS", 6))  # 主路由最多决策的次数，超过后直接汇总已有结果
+DEGRADE_REDUCED_K_BELOW = float(os.getenv("DEGRADE_REDUCED_K_BELOW", 30))  # 剩余时间低于此值时降低检索数量
+DEGRADE_SMALL_MODEL_BELOW = float(os.getenv("DEGRADE_SMALL_MODEL_BELOW", 20))  # 剩余时间低于此值时改用小模型
+DEGRADE_SKIP_RETRIEVAL_BELOW = float(os.getenv("DEGRADE_SKIP_RETRIEVAL_BELOW", 10))  # 剩余时间低于此值时跳过检索
+DEGRADE_PARTIAL_BELOW = float(os.getenv("DEGRADE_PARTIAL_BELOW", 5))  # 剩余时间低于此值时不再调用新的工具节点
+DEGRADED_SEARCH_K = int(os.getenv("DEGRADED_SEARCH_K", 2))
+
+# 历史对话预算配置（估算的token数）
+# 最近的消息保留原文，更早的消息替换为摘要，过长的系统输出只保留标题
+HISTORY_BUDGETS = {
+    "router": int(os.getenv("HISTORY_BUDGET_ROUTER", 800)),
+    "general": int(os.getenv("HISTORY_BUDGET_GENERAL", 1500)),
+    "analyzer": int(os.getenv("HISTORY_BUDGET_ANALYZER", 1200)),
+    "estimator": int(os.getenv("HISTORY_BUDGET_ESTIMATOR", 1200)),
+    "knowledge": int(os.getenv("HISTORY_BUDGET_KNOWLEDGE", 800)),
+}
+HISTORY_RECENT_MESSAGES = int(os.getenv("HISTORY_RECENT_MESSAGES", 4))  # 保留原文的最近消息数
+HISTORY_MAX_MESSAGE_TOKENS = int(os.getenv("HISTORY_MAX_MESSAGE_TOKENS", 400))  # 单条系统输出超过此长度时只保留标题
+
+# 报价矩阵与成本测算配置
+# 报价矩阵表格解析为结构化功能行，由本地成本引擎计算工时、总价和报价区间
+PRICE_MATRIX_DIR = os.getenv("PRICE_MATRIX_DIR", str(ROOT_DIR / "docs"))
+HOURS_PER_WORKDAY = float(os.getenv("HOURS_PER_WORKDAY", 8))
+DAILY_RATE = float(os.getenv("DAILY_RATE", 1000))  # 报价矩阵缺少报价时按人天单价折算（元/人天）
+# 设计、测试等阶段的工作日按开发工作日的比例计算
+PHASE_RATIOS = {
+    "需求设计": float(os.getenv("PHASE_RATIO_DESIGN", 0.15)),
+    "测试": float(os.getenv("PHASE_RATIO_TEST", 0.25)),
+    "部署上线": float(os.getenv("PHASE_RATIO_DEPLOY", 0.05)),
+    "项目管理": float(os.getenv("PHASE_RATIO_PM", 0.10)),
+}
+QUOTE_MIN_FACTOR = float(os.getenv("QUOTE_MIN_FACTOR", 0.9))  # 最低报价相对总成本的系数
+QUOTE_RECOMMENDED_FACTOR = float(os.getenv("QUOTE_RECOMMENDED_FACTOR", 1.0))
+QUOTE_MAX_FACTOR = float(os.getenv("QUOTE_MAX_FACTOR", 1.2))
+TARGET_DURATION_DAYS = int(os.getenv("TARGET_DURATION_DAYS", 30))  # 用于推算各端开发人数的目标开发周期（天）
+
+# 历史项目库配置：按功能集合的MinHash签名查找相似历史项目
+MINHASH_PERMUTATIONS = int(os.getenv("MINHASH_PERMUTATIONS", 64))
+MINHASH_BANDS = int(os.getenv("MINHASH_BANDS", 16))  # LSH分桶数，必须能整除排列数
+SIMILAR_PROJECTS_K = int(os.getenv("SIMILAR_PROJECTS_K", 3))
+SIMILAR_PROJECT_MIN_JACCARD = float(os.getenv("SIMILAR_PROJECT_MIN_JACCARD", 0.2))
+
+# 需求分析配置：需求文本超过阈值时拆分为片段并发分析后合并
+ANALYZER_MAP_REDUCE_THRESHOLD = int(os.getenv("ANALYZER_MAP_REDUCE_THRESHOLD", 3000))  # 估算的token数
+ANALYZER_SECTION_TOKENS = int(os.getenv("ANALYZER_SECTION_TOKENS", 1500))  # 每个片段的最大token数
+ANALYZER_MAX_WORKERS = int(os.getenv("ANALYZER_MAX_WORKERS", 4))  # 片段分析的最大并发数
+# 需求分析结果按 需求文本+检索上下文+提示版本 持久化缓存，知识库版本变化时失效
+ANALYSIS_CACHE = os.getenv("ANALYSIS_CACHE", "true").lower() in ["true", "1", "yes"]
+
 # 文档加载配置
 SUPPORTED_EXTENSIONS = ['.txt', '.docx', '.md', '.csv', '.xlsx', '.xls']
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 500))
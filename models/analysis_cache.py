@@ -0,0 +1,68 @@
+"""需求分析缓存，按需求文本、检索上下文和提示版本缓存需求分析结果"""
+
+import hashlib
+import re
+import threading
+import unicodedata
+from typing import Optional
+
+from models.database import get_analysis_cache, save_analysis_cache, purge_analysis_cache
+from utils.logger import get_logger
+
+# 获取日志记录器
+log = get_logger("analysis_cache")
+
+def normalize_text(text: str) -> str:
+    """归一化需求文本：统一全半角并合并空白，格式差异不影响缓存命中"""
+    text = unicodedata.normalize("NFKC", text or "")
+    return re.sub(r"\s+", " ", text).strip()
+
+def fingerprint(text: str) -> str:
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+class AnalysisCache:
+    """持久化的需求分析缓存，知识库版本变化时清除旧版本的缓存"""
+
+    def __init__(self, prompt_version: str):
+        """
+        初始化需求分析缓存
+
+        参数:
+            prompt_version: 提示版本，提示模板或模型变化时缓存自动失效
+        """
+        self.prompt_version = prompt_version
+        self._generation: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def key(self, requirement: str, context: str) -> str:
+        """缓存键：归一化需求文本 + 检索上下文指纹 + 提示版本"""
+        parts = [fingerprint(normalize_text(requirement)), fingerprint(context), self.prompt_version]
+        return fingerprint("|".join(parts))
+
+    def _check_generation(self, generation: str):
+        """知识库版本变化时清除旧版本的缓存
+
+        清除失败不影响读写：缓存按版本读取，旧版本的条目不会命中，下次版本变化时会一并清除。
+        """
+        if generation == self._generation:
+            return
+        with self._lock:
+            if generation != self._generation:
+                try:
+                    purge_analysis_cache(generation)
+                except Exception as e:
+                    log.warning(f"清除旧版本需求分析缓存失败: {e}")
+                self._generation = generation
+
+    def get(self, key: str, generation: str) -> Optional[str]:
+        """读取缓存，未命中返回None"""
+        self._check_generation(generation)
+        try:
+            return get_analysis_cache(key, generation)
+        except Exception as e:
+            log.warning(f"读取需求分析缓存失败: {e}")
+            return None
+
+    def put(self, key: str, generation: str, content: str):
+        """写入缓存"""
+        save_analysis_cache(key, generation, content)
@@ -0,0 +1,181 @@
+"""异步数据库操作模块，供对话接口在事件循环中读写对话和消息
+
+与 models/database.py 使用同一个SQLite文件和同一组表，函数与同步版本同名、返回相同的数据，
+通过aiosqlite在后台线程中执行SQL，等待期间不阻塞事件循环。
+工作流节点在线程池中执行，仍然使用同步版本。
+"""
+
+import json
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import event, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+
+from config import SQLITE_PATH, SQLITE_PRAGMAS
+from models.database import (
+    db, Conversation, ConversationSummary, Message, ProjectRecord, RequestTrace,
+    message_to_dict, pragma_listener, _before_cursor_execute, _after_cursor_execute,
+)
+from utils.logger import get_logger
+
+# 获取日志记录器
+log = get_logger("async_database")
+
+class AsyncDatabase:
+    """异步数据库连接，表结构由同步的 Database 创建"""
+
+    def __init__(self, db_path: str = SQLITE_PATH, pragmas: Optional[Dict[str, Any]] = None):
+        """初始化数据库配置，连接在首次使用或应用启动时创建"""
+        self.db_path = db_path
+        self.pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+        self.engine: Optional[AsyncEngine] = None
+        self.Session: Optional[async_sessionmaker] = None
+        self._lock = threading.Lock()
+
+    def initialize(self):
+        """创建异步引擎，已初始化时直接返回"""
+        with self._lock:
+            if self.engine is None:
+                self._create_engine()
+
+    def _create_engine(self):
+        # 表由同步引擎创建
+        db.initialize()
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.engine = create_async_engine(f"sqlite+aiosqlite:///{self.db_path}")
+        event.listen(self.engine.sync_engine, "connect", pragma_listener(self.pragmas))
+        # 记录每条SQL的耗时到当前请求的追踪中
+        event.listen(self.engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(self.engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+        # 提交后仍可读取对象的字段
+        self.Session = async_sessionmaker(self.engine, expire_on_commit=False)
+        log.info(f"异步数据库初始化完成: {self.db_path}")
+
+    def get_session(self) -> AsyncSession:
+        """获取异步数据库会话"""
+        if self.Session is None:
+            self.initialize()
+        return self.Session()
+
+    async def close(self):
+        """关闭数据库连接"""
+        engine = self.engine
+        with self._lock:
+            self.engine = None
+            self.Session = None
+        if engine is not None:
+            await engine.dispose()
+            log.info("异步数据库连接已关闭")
+
+# 创建全局异步数据库实例
+async_db = AsyncDatabase()
+
+async def create_conversation() -> str:
+    """创建新对话"""
+    from utils.helpers import generate_id
+
+    async with async_db.get_session() as session:
+        conversation_id = generate_id("conv")
+        session.add(Conversation(conversation_id=conversation_id))
+        await session.commit()
+        log.info(f"创建新对话: {conversation_id}")
+        return conversation_id
+
+async def add_message(conversation_id: str, role: str, content: str) -> Message:
+    """添加消息到对话"""
+    from utils.helpers import generate_id
+
+    async with async_db.get_session() as session:
+        # 对话是否存在由外键约束检查，不再单独查询
+        message_id = generate_id("msg")
+        message = Message(
+            message_id=message_id,
+            conversation_id=conversation_id,
+            role=role,
+            content=content,
+        )
+        session.add(message)
+        try:
+            await session.commit()
+        except IntegrityError:
+            await session.rollback()
+            log.error(f"对话不存在: {conversation_id}")
+            raise ValueError(f"对话不存在: {conversation_id}")
+        log.debug(f"添加消息: {message_id} 到对话: {conversation_id}")
+        return message
+
+async def get_conversation_history(conversation_id: str, limit: int = 10) -> List[Dict[str, Any]]:
+    """获取对话历史"""
+    async with async_db.get_session() as session:
+        messages = (await session.scalars(
+            select(Message).filter_by(conversation_id=conversation_id)
+            .order_by(Message.timestamp.desc()).limit(limit)
+        )).all()
+        # 反转顺序，使最早的消息在前
+        return [message_to_dict(msg) for msg in reversed(messages)]
+
+async def load_conversation_state(conversation_id: str, limit: int = 10) -> Dict[str, Any]:
+    """获取对话摘要和尚未合并到摘要的最近消息，见 models.database.load_conversation_state"""
+    async with async_db.get_session() as session:
+        row = await session.scalar(select(ConversationSummary).filter_by(conversation_id=conversation_id))
+        query = select(Message).filter_by(conversation_id=conversation_id)
+        if row:
+            query = query.filter(Message.id > row.through_id)
+        messages = (await session.scalars(query.order_by(Message.timestamp.desc()).limit(limit))).all()
+        return {
+            "summary": row.summary if row else "",
+            "messages": [message_to_dict(msg) for msg in reversed(messages)],
+        }
+
+async def list_projects(limit: int = 20) -> List[Dict[str, Any]]:
+    """最近保存的报价测算项目，最新的在前"""
+    async with async_db.get_session() as session:
+        projects = (await session.scalars(
+            select(ProjectRecord).order_by(ProjectRecord.created_at.desc()).limit(limit)
+        )).all()
+        return [
+            {
+                "project_id": project.project_id,
+                "name": project.name,
+                "estimated_cost": project.estimated_cost,
+                "actual_cost": project.actual_cost,
+                "status": project.status,
+                "created_at": project.created_at.isoformat() if project.created_at else None,
+            }
+            for project in projects
+        ]
+
+async def update_actual_cost(project_id: str, actual_cost: float, status: str = "finished"):
+    """回填项目实际成本，见 models.database.update_actual_cost"""
+    async with async_db.get_session() as session:
+        project = await session.scalar(select(ProjectRecord).filter_by(project_id=project_id))
+        if not project:
+            raise ValueError(f"项目不存在: {project_id}")
+        project.actual_cost = actual_cost
+        project.status = status
+        await session.commit()
+        log.info(f"回填项目实际成本: {project_id} = {actual_cost}")
+
+async def save_trace(trace: Dict[str, Any]):
+    """保存请求追踪记录，保存失败不影响请求"""
+    async with async_db.get_session() as session:
+        try:
+            session.add(RequestTrace(
+                request_id=trace["request_id"],
+                conversation_id=trace.get("conversation_id"),
+                duration_ms=trace.get("duration_ms"),
+                content=json.dumps(trace, ensure_ascii=False, default=str),
+            ))
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            log.error(f"保存请求追踪失败: {str(e)}")
+
+async def get_trace(request_id: str) -> Optional[Dict[str, Any]]:
+    """读取已保存的请求追踪记录"""
+    async with async_db.get_session() as session:
+        content = await session.scalar(select(RequestTrace.content).filter_by(request_id=request_id))
+        return json.loads(content) if content else None
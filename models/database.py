@@ -1,14 +1,19 @@
 """数据库操作模块，提供SQLite数据库的连接和操作"""
 
+import json
 import os
-from typing import Dict, List, Any
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, ForeignKey
+import threading
+import time
+from typing import Dict, List, Any, Optional, Tuple
+from sqlalchemy import create_engine, event, text, Column, Index, Integer, String, Float, DateTime, Text, ForeignKey
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
 
 from loguru import logger
-from config import SQLITE_PATH
+from config import SQLITE_PATH, SQLITE_PRAGMAS, SQLITE_POOL_SIZE
+from utils import tracing
 from utils.logger import get_logger
 
 # 获取日志记录器
@@ -44,6 +49,19 @@ class Message(Base):
     
     # 关系
     conversation = relationship("Conversation", back_populates="messages")
+    
+    # 读取对话历史按对话过滤、按时间排序，已有数据库由 models/migrations.py 创建
+    __table_args__ = (Index("ix_messages_conversation_timestamp", "conversation_id", "timestamp"),)
+
+class ConversationSummary(Base):
+    """对话摘要表，保存对话摘要及其已合并到的最后一条消息，之后的消息为最近的历史"""
+    __tablename__ = "conversation_summaries"
+    
+    id = Column(Integer, primary_key=True)
+    conversation_id = Column(String(50), ForeignKey("conversations.conversation_id"), unique=True, nullable=False)
+    summary = Column(Text, nullable=False)
+    through_id = Column(Integer, nullable=False)  # 已合并到摘要的最后一条消息（messages.id）
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
 class DocumentFingerprint(Base):
     """文档指纹表，用于存储已处理文档的指纹"""
@@ -54,27 +72,137 @@ class DocumentFingerprint(Base):
     doc_metadata = Column(Text, nullable=True)  # JSON格式存储文档元数据
     created_at = Column(DateTime, default=datetime.now)
 
+class ProjectRecord(Base):
+    """项目表，记录每次报价测算对应的项目"""
+    __tablename__ = "projects"
+    
+    id = Column(Integer, primary_key=True)
+    project_id = Column(String(50), unique=True, nullable=False)
+    name = Column(String(200), nullable=False)
+    requirement = Column(Text, nullable=False)
+    estimated_cost = Column(Float, nullable=False)
+    actual_cost = Column(Float, nullable=True)  # 项目结束后回填
+    status = Column(String(20), default="quoted")
+    created_at = Column(DateTime, default=datetime.now)
+    
+    # 关系
+    quotes = relationship("Quote", back_populates="project")
+
+class Quote(Base):
+    """报价表"""
+    __tablename__ = "quotes"
+    
+    id = Column(Integer, primary_key=True)
+    quote_id = Column(String(50), unique=True, nullable=False)
+    project_id = Column(String(50), ForeignKey("projects.project_id"), index=True)
+    total_cost = Column(Float, nullable=False)
+    min_price = Column(Float, nullable=True)
+    recommended_price = Column(Float, nullable=True)
+    max_price = Column(Float, nullable=True)
+    estimated_duration = Column(Integer, nullable=True)
+    minhash = Column(Text, nullable=True)  # 功能集合的MinHash签名，JSON格式存储
+    created_at = Column(DateTime, default=datetime.now)
+    
+    # 关系
+    project = relationship("ProjectRecord", back_populates="quotes")
+    features = relationship("QuoteFeature", back_populates="quote")
+
+class QuoteFeature(Base):
+    """报价功能明细表"""
+    __tablename__ = "quote_features"
+    
+    id = Column(Integer, primary_key=True)
+    quote_id = Column(String(50), ForeignKey("quotes.quote_id"), index=True)
+    feature_key = Column(String(200), nullable=False, index=True)  # 功能模块/功能细分
+    port = Column(String(100), nullable=True)
+    quantity = Column(Float, default=1.0)
+    hours = Column(Float, nullable=True)
+    price = Column(Float, nullable=True)
+    
+    # 关系
+    quote = relationship("Quote", back_populates="features")
+
+class AnalysisCacheEntry(Base):
+    """需求分析结果缓存表"""
+    __tablename__ = "analysis_cache"
+    
+    id = Column(Integer, primary_key=True)
+    cache_key = Column(String(64), unique=True, nullable=False)
+    kb_generation = Column(String(64), nullable=False, index=True)  # 写入时的知识库版本
+    content = Column(Text, nullable=False)
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.now)
+
+class RequestTrace(Base):
+    """请求追踪表，开启 TRACE_PERSIST 时保存每个请求的追踪记录"""
+    __tablename__ = "request_traces"
+    
+    id = Column(Integer, primary_key=True)
+    request_id = Column(String(50), unique=True, nullable=False)
+    conversation_id = Column(String(50), nullable=True, index=True)
+    duration_ms = Column(Float, nullable=True, index=True)
+    content = Column(Text, nullable=False)  # JSON格式存储完整追踪记录
+    created_at = Column(DateTime, default=datetime.now)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("trace_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info["trace_start"].pop()
+    statement = " ".join(statement.split())
+    tracing.record_span("db", "db", start, operation=statement.split(" ", 1)[0].upper(), statement=statement[:120])
+
+def pragma_listener(pragmas: Dict[str, Any]):
+    """连接建立时设置SQLite参数的事件监听函数"""
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+        finally:
+            cursor.close()
+    return set_pragmas
+
 # 数据库连接和会话
 class Database:
     """数据库操作类"""
-    def __init__(self, db_path: str = SQLITE_PATH):
-        """初始化数据库连接"""
+    def __init__(self, db_path: str = SQLITE_PATH, pragmas: Optional[Dict[str, Any]] = None, pool_size: int = SQLITE_POOL_SIZE):
+        """初始化数据库配置，连接在首次使用或应用启动时创建
+
+        参数:
+            db_path: 数据库文件路径
+            pragmas: 每个连接建立时设置的SQLite参数，为None时使用 SQLITE_PRAGMAS
+            pool_size: 连接池大小
+        """
         self.db_path = db_path
+        self.pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+        self.pool_size = pool_size
         self.engine = None
         self.Session = None
-        self.initialize()
+        self._lock = threading.Lock()
     
     def initialize(self):
-        """初始化数据库"""
+        """初始化数据库，已初始化时直接返回"""
+        with self._lock:
+            if self.engine is None:
+                self._create_engine()
+
+    def _create_engine(self):
         # 确保数据库目录存在
         db_dir = os.path.dirname(self.db_path)
         os.makedirs(db_dir, exist_ok=True)
         
-        # 创建数据库引擎
-        self.engine = create_engine(f"sqlite:///{self.db_path}")
+        # 创建数据库引擎，连接在节点线程间复用
+        self.engine = create_engine(f"sqlite:///{self.db_path}", pool_size=self.pool_size)
+        event.listen(self.engine, "connect", pragma_listener(self.pragmas))
+        # 记录每条SQL的耗时到当前请求的追踪中
+        event.listen(self.engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(self.engine, "after_cursor_execute", _after_cursor_execute)
         
-        # 创建表
+        # 创建表，已有数据库执行尚未应用的迁移
         Base.metadata.create_all(self.engine)
+        from models.migrations import migrate
+        migrate(self.engine)
         
         # 创建会话工厂
         self.Session = sessionmaker(bind=self.engine)
@@ -83,13 +211,24 @@ class Database:
     
     def get_session(self):
         """获取数据库会话"""
+        if self.Session is None:
+            self.initialize()
         return self.Session()
     
     def close(self):
         """关闭数据库连接"""
-        if self.engine:
-            self.engine.dispose()
-            log.info("数据库连接已关闭")
+        with self._lock:
+            if self.engine:
+                # 根据本次运行的查询更新统计信息
+                try:
+                    with self.engine.connect() as conn:
+                        conn.execute(text("PRAGMA optimize"))
+                except Exception as e:
+                    log.warning(f"更新数据库统计信息失败: {e}")
+                self.engine.dispose()
+                self.engine = None
+                self.Session = None
+                log.info("数据库连接已关闭")
 
 # 创建全局数据库实例
 db = Database()
@@ -117,13 +256,7 @@ def add_message(conversation_id: str, role: str, content: str) -> Message:
     
     session = db.get_session()
     try:
-        # 检查对话是否存在
-        conversation = session.query(Conversation).filter_by(conversation_id=conversation_id).first()
-        if not conversation:
-            log.error(f"对话不存在: {conversation_id}")
-            raise ValueError(f"对话不存在: {conversation_id}")
-        
-        # 添加消息
+        # 对话是否存在由外键约束检查，不再单独查询
         message_id = generate_id("msg")
         message = Message(
             message_id=message_id,
@@ -132,12 +265,29 @@ def add_message(conversation_id: str, role: str, content: str) -> Message:
             content=content,
         )
         session.add(message)
+        try:
+            session.flush()
+        except IntegrityError:
+            session.rollback()
+            log.error(f"对话不存在: {conversation_id}")
+            raise ValueError(f"对话不存在: {conversation_id}")
+        # 与会话分离，提交后仍可读取消息的字段
+        session.expunge(message)
         session.commit()
         log.debug(f"添加消息: {message_id} 到对话: {conversation_id}")
         return message
     finally:
         session.close()
 
+def message_to_dict(msg: Message) -> Dict[str, Any]:
+    """转换为对话历史中的消息格式"""
+    return {
+        "message_id": msg.message_id,
+        "role": msg.role,
+        "content": msg.content,
+        "timestamp": msg.timestamp
+    }
+
 def get_conversation_history(conversation_id: str, limit: int = 10) -> List[Dict[str, Any]]:
     """获取对话历史"""
     session = db.get_session()
@@ -146,20 +296,71 @@ def get_conversation_history(conversation_id: str, limit: int = 10) -> List[Dict
             .order_by(Message.timestamp.desc()).limit(limit).all()
         
         # 转换为字典列表
-        history = [
-            {
-                "message_id": msg.message_id,
-                "role": msg.role,
-                "content": msg.content,
-                "timestamp": msg.timestamp
-            }
-            for msg in reversed(messages)  # 反转顺序，使最早的消息在前
-        ]
+        history = [message_to_dict(msg) for msg in reversed(messages)]  # 反转顺序，使最早的消息在前
         
         return history
     finally:
         session.close()
 
+def load_conversation_state(conversation_id: str, limit: int = 10) -> Dict[str, Any]:
+    """获取对话摘要和尚未合并到摘要的最近消息
+
+    返回:
+        summary: 对话摘要，没有时为空字符串
+        messages: 摘要之后最多 limit 条消息，最早的消息在前
+    """
+    session = db.get_session()
+    try:
+        row = session.query(ConversationSummary).filter_by(conversation_id=conversation_id).first()
+        query = session.query(Message).filter_by(conversation_id=conversation_id)
+        if row:
+            query = query.filter(Message.id > row.through_id)
+        messages = query.order_by(Message.timestamp.desc()).limit(limit).all()
+        return {
+            "summary": row.summary if row else "",
+            "messages": [message_to_dict(msg) for msg in reversed(messages)],
+        }
+    finally:
+        session.close()
+
+def get_conversation_summary(conversation_id: str) -> str:
+    """获取对话摘要，没有时返回空字符串"""
+    session = db.get_session()
+    try:
+        summary = session.query(ConversationSummary.summary).filter_by(conversation_id=conversation_id).scalar()
+        return summary or ""
+    finally:
+        session.close()
+
+def save_conversation_summary(conversation_id: str, summary: str, message_id: str) -> str:
+    """保存合并到 message_id 为止的对话摘要，返回保存后的摘要
+
+    已保存的摘要合并到更新的消息时（如其他进程先完成了摘要）保留已保存的摘要并返回它。
+    """
+    session = db.get_session()
+    try:
+        through_id = session.query(Message.id).filter_by(message_id=message_id).scalar()
+        if through_id is None:
+            raise ValueError(f"消息不存在: {message_id}")
+        # 条件更新，并发写入时摘要只会前进
+        updated = session.query(ConversationSummary)\
+            .filter(ConversationSummary.conversation_id == conversation_id, ConversationSummary.through_id < through_id)\
+            .update({"summary": summary, "through_id": through_id, "updated_at": datetime.now()}, synchronize_session=False)
+        if not updated:
+            stored = session.query(ConversationSummary.summary).filter_by(conversation_id=conversation_id).scalar()
+            if stored is not None:
+                session.rollback()
+                return stored
+            session.add(ConversationSummary(conversation_id=conversation_id, summary=summary, through_id=through_id))
+        session.commit()
+        return summary
+    except IntegrityError:
+        # 其他进程同时插入了摘要
+        session.rollback()
+        return get_conversation_summary(conversation_id) or summary
+    finally:
+        session.close()
+
 def get_doc_fingerprints() -> List[str]:
     """获取所有文档指纹"""
     session = db.get_session()
@@ -176,8 +377,6 @@ def add_doc_fingerprints(fingerprints: List[str], metadata_list: List[Dict[str,
         fingerprints: 文档指纹列表
         metadata_list: 对应的元数据列表，可选
     """
-    import json
-    
     if not fingerprints:
         return
     
@@ -214,3 +413,169 @@ def clear_doc_fingerprints():
         log.info(f"清除了 {count} 个文档指纹")
     finally:
         session.close()
+
+def save_quote(name: str, requirement: str, estimation: Dict[str, Any], features: List[Dict[str, Any]], minhash: List[int]) -> Tuple[str, str]:
+    """保存一次报价测算，包括项目、报价和功能明细，返回项目ID和报价ID
+    
+    Args:
+        name: 项目名称
+        requirement: 需求描述
+        estimation: 测算结果，包含 total_cost、price_range、estimated_duration
+        features: 功能明细，每个元素包含 feature_key、port、quantity、hours、price
+        minhash: 功能集合的MinHash签名
+    """
+    from utils.helpers import generate_id
+    
+    session = db.get_session()
+    try:
+        project_id = generate_id("proj")
+        quote_id = generate_id("quote")
+        price_range = estimation.get("price_range", {})
+        session.add(ProjectRecord(
+            project_id=project_id,
+            name=name,
+            requirement=requirement,
+            estimated_cost=estimation["total_cost"],
+        ))
+        session.add(Quote(
+            quote_id=quote_id,
+            project_id=project_id,
+            total_cost=estimation["total_cost"],
+            min_price=price_range.get("min"),
+            recommended_price=price_range.get("recommended"),
+            max_price=price_range.get("max"),
+            estimated_duration=estimation.get("estimated_duration"),
+            minhash=json.dumps(minhash),
+        ))
+        for feature in features:
+            session.add(QuoteFeature(quote_id=quote_id, **feature))
+        session.commit()
+        log.debug(f"保存报价: {quote_id} 项目: {project_id}")
+        return project_id, quote_id
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def update_actual_cost(project_id: str, actual_cost: float, status: str = "finished"):
+    """回填项目实际成本"""
+    session = db.get_session()
+    try:
+        project = session.query(ProjectRecord).filter_by(project_id=project_id).first()
+        if not project:
+            raise ValueError(f"项目不存在: {project_id}")
+        project.actual_cost = actual_cost
+        project.status = status
+        session.commit()
+    finally:
+        session.close()
+
+def get_quote_signatures() -> List[Dict[str, Any]]:
+    """获取所有报价的项目信息、功能集合和MinHash签名，用于构建相似项目索引"""
+    session = db.get_session()
+    try:
+        rows = session.query(Quote, ProjectRecord).join(ProjectRecord, Quote.project_id == ProjectRecord.project_id).all()
+        feature_rows = session.query(QuoteFeature.quote_id, QuoteFeature.feature_key).all()
+        features: Dict[str, set] = {}
+        for quote_id, feature_key in feature_rows:
+            features.setdefault(quote_id, set()).add(feature_key)
+        
+        return [
+            {
+                "quote_id": quote.quote_id,
+                "project_id": project.project_id,
+                "name": project.name,
+                "requirement": project.requirement,
+                "estimated_cost": project.estimated_cost,
+                "actual_cost": project.actual_cost,
+                "recommended_price": quote.recommended_price,
+                "features": features.get(quote.quote_id, set()),
+                "minhash": json.loads(quote.minhash) if quote.minhash else None,
+            }
+            for quote, project in rows
+        ]
+    finally:
+        session.close()
+
+def get_project_costs(project_ids: List[str]) -> Dict[str, Any]:
+    """批量获取项目的实际成本（实际成本回填后无需重建索引）"""
+    if not project_ids:
+        return {}
+    session = db.get_session()
+    try:
+        rows = session.query(ProjectRecord.project_id, ProjectRecord.actual_cost)\
+            .filter(ProjectRecord.project_id.in_(project_ids)).all()
+        return {project_id: actual_cost for project_id, actual_cost in rows}
+    finally:
+        session.close()
+
+def get_analysis_cache(cache_key: str, kb_generation: str) -> Optional[str]:
+    """读取需求分析缓存，知识库版本不一致时视为未命中"""
+    session = db.get_session()
+    try:
+        entry = session.query(AnalysisCacheEntry).filter_by(cache_key=cache_key).first()
+        if not entry or entry.kb_generation != kb_generation:
+            return None
+        entry.hits += 1
+        session.commit()
+        return entry.content
+    finally:
+        session.close()
+
+def save_analysis_cache(cache_key: str, kb_generation: str, content: str):
+    """写入需求分析缓存，已存在时覆盖"""
+    session = db.get_session()
+    try:
+        entry = session.query(AnalysisCacheEntry).filter_by(cache_key=cache_key).first()
+        if entry:
+            entry.kb_generation = kb_generation
+            entry.content = content
+            entry.hits = 0
+            entry.created_at = datetime.now()
+        else:
+            session.add(AnalysisCacheEntry(cache_key=cache_key, kb_generation=kb_generation, content=content))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        log.error(f"写入需求分析缓存失败: {str(e)}")
+    finally:
+        session.close()
+
+def purge_analysis_cache(kb_generation: str) -> int:
+    """删除非当前知识库版本的需求分析缓存，返回删除数量"""
+    session = db.get_session()
+    try:
+        count = session.query(AnalysisCacheEntry).filter(AnalysisCacheEntry.kb_generation != kb_generation).delete()
+        session.commit()
+        if count:
+            log.info(f"知识库版本变化，清除了 {count} 条需求分析缓存")
+        return count
+    finally:
+        session.close()
+
+def save_trace(trace: Dict[str, Any]):
+    """保存请求追踪记录，保存失败不影响请求"""
+    session = db.get_session()
+    try:
+        session.add(RequestTrace(
+            request_id=trace["request_id"],
+            conversation_id=trace.get("conversation_id"),
+            duration_ms=trace.get("duration_ms"),
+            content=json.dumps(trace, ensure_ascii=False, default=str),
+        ))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        log.error(f"保存请求追踪失败: {str(e)}")
+    finally:
+        session.close()
+
+def get_trace(request_id: str) -> Optional[Dict[str, Any]]:
+    """读取已保存的请求追踪记录"""
+    session = db.get_session()
+    try:
+        entry = session.query(RequestTrace).filter_by(request_id=request_id).first()
+        return json.loads(entry.content) if entry else None
+    finally:
+        session.close()
@@ -0,0 +1,46 @@
+"""数据库迁移模块，将新增的索引等结构变更应用到已有的SQLite数据库
+
+新建的数据库由 Base.metadata.create_all 创建完整的表和索引，create_all 不会修改已存在的表，
+已有数据库的结构变更按版本号记录在 MIGRATIONS 中。当前版本保存在 PRAGMA user_version，
+启动时依次执行版本号更高的迁移，每个迁移在单独的事务中执行并更新版本号。
+迁移语句需要可以重复执行（如 CREATE INDEX IF NOT EXISTS），新建的数据库同样会执行一遍。
+"""
+
+from typing import List, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from utils.logger import get_logger
+
+# 获取日志记录器
+log = get_logger("migrations")
+
+# (版本号, 说明, SQL语句)，版本号递增
+MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, "消息表按对话和时间的复合索引，用于读取对话历史", [
+        "CREATE INDEX IF NOT EXISTS ix_messages_conversation_timestamp ON messages (conversation_id, timestamp)",
+    ]),
+    (2, "更新查询优化器的统计信息", [
+        "ANALYZE",
+    ]),
+]
+
+def current_version(engine: Engine) -> int:
+    with engine.connect() as conn:
+        return conn.execute(text("PRAGMA user_version")).scalar() or 0
+
+def migrate(engine: Engine) -> int:
+    """执行尚未应用的迁移，返回迁移后的版本号"""
+    version = current_version(engine)
+    for target, description, statements in MIGRATIONS:
+        if target <= version:
+            continue
+        with engine.begin() as conn:
+            for statement in statements:
+                conn.execute(text(statement))
+            # PRAGMA 不支持参数绑定，版本号来自 MIGRATIONS
+            conn.execute(text(f"PRAGMA user_version = {int(target)}"))
+        version = target
+        log.info(f"数据库迁移 {target}: {description}")
+    return version
@@ -0,0 +1,156 @@
+"""报价矩阵与成本引擎，负责将报价表格解析为结构化功能行并在本地完成成本计算"""
+
+import math
+import threading
+from pathlib import Path
+from typing import Dict, List, Any, Optional
+
+import numpy as np
+import pandas as pd
+
+from config import (
+    PRICE_MATRIX_DIR,
+    HOURS_PER_WORKDAY,
+    DAILY_RATE,
+    PHASE_RATIOS,
+    QUOTE_MIN_FACTOR,
+    QUOTE_RECOMMENDED_FACTOR,
+    QUOTE_MAX_FACTOR,
+    TARGET_DURATION_DAYS,
+)
+from models.schema import CostEstimation
+from utils.excel_read import parse_excel_to_rows
+from utils.logger import get_logger
+
+# 获取日志记录器
+log = get_logger("price_matrix")
+
+MATRIX_COLUMNS = ["source", "port", "module", "feature", "description", "hours", "price"]
+
+class PriceMatrix:
+    """报价矩阵，以功能ID为索引保存 项目模块 → 功能模块 → 功能细分 的工时和报价"""
+
+    def __init__(self, rows: Optional[List[Dict[str, Any]]] = None):
+        """根据结构化功能行构建报价矩阵"""
+        df = pd.DataFrame(rows or [], columns=MATRIX_COLUMNS)
+        df["hours"] = pd.to_numeric(df["hours"], errors="coerce")
+        df["price"] = pd.to_numeric(df["price"], errors="coerce")
+        # 只保留可以计价的功能行
+        df = df[df["hours"].notna() | df["price"].notna()].reset_index(drop=True)
+        df.index = [f"F{i + 1}" for i in range(len(df))]
+        df.index.name = "feature_id"
+        self.table = df
+
+    @classmethod
+    def load(cls, directory: str = PRICE_MATRIX_DIR) -> "PriceMatrix":
+        """从目录中的Excel报价表加载报价矩阵"""
+        rows: List[Dict[str, Any]] = []
+        path = Path(directory)
+        files = sorted(list(path.glob("*.xls")) + list(path.glob("*.xlsx"))) if path.exists() else []
+        for file in files:
+            try:
+                file_rows = parse_excel_to_rows(str(file))
+            except Exception as e:
+                log.warning(f"报价矩阵解析失败 {file}: {e}")
+                continue
+            for row in file_rows:
+                row["source"] = file.stem
+            rows.extend(file_rows)
+
+        matrix = cls(rows)
+        log.info(f"报价矩阵加载完成，共 {len(matrix)} 个功能行，来自 {len(files)} 个文件")
+        return matrix
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    @property
+    def empty(self) -> bool:
+        return self.table.empty
+
+    def lookup(self, module: str, feature: str) -> Optional[str]:
+        """按功能模块和功能细分查找功能ID"""
+        matched = self.table[(self.table["module"] == module) & (self.table["feature"] == feature)]
+        return matched.index[0] if not matched.empty else None
+
+    def format_catalog(self) -> str:
+        """格式化为供LLM匹配功能的紧凑目录，不包含功能描述以控制提示长度"""
+        lines = ["功能ID | 项目模块 | 功能模块 | 功能细分 | 工时"]
+        for feature_id, row in self.table.iterrows():
+            hours = "" if pd.isna(row["hours"]) else f"{row['hours']:g}h"
+            lines.append(f"{feature_id} | {row['port']} | {row['module']} | {row['feature']} | {hours}")
+        return "\n".join(lines)
+
+    def estimate(self, selection: Dict[str, float], unmatched: Optional[List[str]] = None) -> Optional[CostEstimation]:
+        """根据选中的功能ID及数量计算成本测算结果，没有有效功能时返回None"""
+        ids = [feature_id for feature_id in selection if feature_id in self.table.index]
+        if not ids:
+            return None
+
+        items = self.table.loc[ids]
+        quantity = np.array([max(float(selection[feature_id]), 0.0) for feature_id in ids])
+        hours = items["hours"].to_numpy(dtype=float)
+        price = items["price"].to_numpy(dtype=float)
+
+        # 缺少工时按报价折算，缺少报价按人天单价折算
+        hourly_rate = DAILY_RATE / HOURS_PER_WORKDAY
+        unit_hours = np.where(np.isnan(hours), price / hourly_rate, hours)
+        unit_price = np.where(np.isnan(price), unit_hours * hourly_rate, price)
+        hours = unit_hours * quantity
+        price = unit_price * quantity
+        dev_days = hours / HOURS_PER_WORKDAY
+
+        # 各阶段工作日按开发工作日比例计算，阶段成本按人天单价计入
+        total_dev_days = float(dev_days.sum())
+        phase_days = {phase: total_dev_days * ratio for phase, ratio in PHASE_RATIOS.items()}
+        workday_breakdown = {"开发": round(total_dev_days, 1)}
+        workday_breakdown.update({phase: round(days, 1) for phase, days in phase_days.items()})
+        total_cost = float(price.sum()) + sum(phase_days.values()) * DAILY_RATE
+
+        # 各端开发人数按目标开发周期推算
+        port_days = pd.Series(dev_days, index=items["port"].replace("", "通用").to_numpy()).groupby(level=0).sum()
+        developers = {port: max(1, math.ceil(days / TARGET_DURATION_DAYS)) for port, days in port_days.items()}
+        dev_duration = max(math.ceil(days / developers[port]) for port, days in port_days.items())
+        other_days = phase_days.get("需求设计", 0.0) + phase_days.get("测试", 0.0) + phase_days.get("部署上线", 0.0)
+
+        resource_allocation: Dict[str, Any] = {"开发团队": {f"{port}开发": count for port, count in developers.items()}}
+        resource_allocation["测试/设计"] = "按阶段工作日安排，与开发并行推进"
+
+        line_items = [
+            {
+                "项目模块": row["port"],
+                "功能模块": row["module"],
+                "功能细分": row["feature"],
+                "数量": f"{qty:g}",
+                "工时": round(float(h), 1),
+                "报价": round(float(p), 2),
+            }
+            for (_, row), qty, h, p in zip(items.iterrows(), quantity, hours, price)
+        ]
+
+        return CostEstimation(
+            total_cost=round(total_cost, 2),
+            workday_breakdown=workday_breakdown,
+            resource_allocation=resource_allocation,
+            price_range={
+                "min": round(total_cost * QUOTE_MIN_FACTOR, 2),
+                "recommended": round(total_cost * QUOTE_RECOMMENDED_FACTOR, 2),
+                "max": round(total_cost * QUOTE_MAX_FACTOR, 2),
+            },
+            estimated_duration=dev_duration + math.ceil(other_days / max(1, len(developers))),
+            line_items=line_items,
+            unmatched_features=list(unmatched or []),
+        )
+
+# 共享的报价矩阵，首次使用时加载
+_price_matrix: Optional[PriceMatrix] = None
+_price_matrix_lock = threading.Lock()
+
+def get_price_matrix() -> PriceMatrix:
+    """获取共享的报价矩阵"""
+    global _price_matrix
+    if _price_matrix is None:
+        with _price_matrix_lock:
+            if _price_matrix is None:
+                _price_matrix = PriceMatrix.load()
+    return _price_matrix
@@ -0,0 +1,178 @@
+"""历史项目库，负责保存每次报价测算并按功能集合查找相似的历史项目"""
+
+import hashlib
+import threading
+from typing import Dict, List, Any, Iterable, Optional, Set
+
+import numpy as np
+
+from config import MINHASH_PERMUTATIONS, MINHASH_BANDS, SIMILAR_PROJECTS_K, SIMILAR_PROJECT_MIN_JACCARD
+from models.analysis_cache import normalize_text, fingerprint
+from models.database import save_quote, get_quote_signatures, get_project_costs
+from models.schema import CostEstimation
+from utils.logger import get_logger
+
+# 获取日志记录器
+log = get_logger("project_history")
+
+# 梅森素数，保证 a*x+b 在uint64内不溢出
+_PRIME = (1 << 31) - 1
+
+def feature_key(module: str, feature: str) -> str:
+    """功能集合中的元素：功能模块/功能细分"""
+    return f"{(module or '').strip()}/{(feature or '').strip()}"
+
+def jaccard(left: Set[str], right: Set[str]) -> float:
+    """两个功能集合的Jaccard相似度"""
+    if not left or not right:
+        return 0.0
+    return len(left & right) / len(left | right)
+
+def requirement_key(requirement: str) -> str:
+    """需求文本的指纹，格式差异不影响，用于识别同一需求的重复测算"""
+    return fingerprint(normalize_text(requirement))
+
+class ProjectHistory:
+    """历史项目库，使用MinHash签名和LSH分桶在内存中索引历史报价的功能集合"""
+
+    def __init__(self, num_perm: int = MINHASH_PERMUTATIONS, bands: int = MINHASH_BANDS):
+        """初始化MinHash参数，固定随机种子保证签名可以持久化复用"""
+        if num_perm % bands != 0:
+            raise ValueError(f"MinHash排列数 {num_perm} 必须能被分桶数 {bands} 整除")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        rng = np.random.default_rng(20240601)
+        self.a = rng.integers(1, _PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, _PRIME, size=num_perm, dtype=np.uint64)
+
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.buckets: Dict[tuple, Set[str]] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def signature(self, features: Iterable[str]) -> np.ndarray:
+        """计算功能集合的MinHash签名"""
+        hashes = np.array(
+            [int.from_bytes(hashlib.md5(f.encode("utf-8")).digest()[:4], "little") & _PRIME for f in set(features)],
+            dtype=np.uint64,
+        )
+        if hashes.size == 0:
+            return np.full(self.num_perm, _PRIME, dtype=np.uint64)
+        return ((self.a[:, None] * hashes[None, :] + self.b[:, None]) % _PRIME).min(axis=1)
+
+    def _band_keys(self, signature: np.ndarray) -> List[tuple]:
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def _add(self, entry: Dict[str, Any], signature: np.ndarray):
+        self.entries[entry["quote_id"]] = entry
+        for key in self._band_keys(signature):
+            self.buckets.setdefault(key, set()).add(entry["quote_id"])
+
+    def ensure_loaded(self):
+        """首次使用时从数据库加载历史报价并构建索引"""
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            for entry in get_quote_signatures():
+                minhash = entry.pop("minhash")
+                entry["requirement_key"] = requirement_key(entry.pop("requirement"))
+                # 参数变化后的旧签名需要重新计算
+                signature = np.array(minhash, dtype=np.uint64) if minhash and len(minhash) == self.num_perm \
+                    else self.signature(entry["features"])
+                self._add(entry, signature)
+            self._loaded = True
+            log.info(f"历史项目索引加载完成，共 {len(self.entries)} 条报价")
+
+    def _find_duplicate(self, key: str, features: Set[str]) -> Optional[Dict[str, Any]]:
+        """同一需求、同一功能集合已经保存过的报价"""
+        for entry in self.entries.values():
+            if entry["requirement_key"] == key and entry["features"] == features:
+                return entry
+        return None
+
+    def find_similar(self, features: Iterable[str], k: int = SIMILAR_PROJECTS_K,
+                     requirement: Optional[str] = None) -> List[Dict[str, Any]]:
+        """按功能集合查找最相似的历史项目，返回项目名称、相似度、测算成本和实际成本
+
+        传入需求描述时排除同一需求此前的测算，避免把自己作为相似项目返回。
+        """
+        self.ensure_loaded()
+        features = set(features)
+        if not features:
+            return []
+        exclude = requirement_key(requirement) if requirement else None
+
+        candidates: Set[str] = set()
+        for key in self._band_keys(self.signature(features)):
+            candidates |= self.buckets.get(key, set())
+
+        # 候选集按精确Jaccard重新排序
+        scored = []
+        for quote_id in candidates:
+            entry = self.entries[quote_id]
+            if entry["requirement_key"] == exclude:
+                continue
+            similarity = jaccard(features, entry["features"])
+            if similarity >= SIMILAR_PROJECT_MIN_JACCARD:
+                scored.append((similarity, entry))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        scored = scored[:k]
+
+        # 实际成本可能在入索引后才回填，返回前从数据库读取
+        actual_costs = get_project_costs([entry["project_id"] for _, entry in scored])
+        return [
+            {
+                "项目": entry["name"],
+                "相似度": round(similarity, 2),
+                "测算成本": entry["estimated_cost"],
+                "实际成本": actual_costs.get(entry["project_id"]),
+            }
+            for similarity, entry in scored
+        ]
+
+    def record(self, requirement: str, estimation: CostEstimation, name: Optional[str] = None) -> str:
+        """保存一次报价测算并加入索引，返回项目ID；同一需求的相同测算不重复保存，返回已有的项目ID"""
+        self.ensure_loaded()
+        features = [
+            {
+                "feature_key": feature_key(item.get("功能模块", ""), item.get("功能细分", "")),
+                "port": item.get("项目模块"),
+                "quantity": float(item.get("数量", 1) or 1),
+                "hours": item.get("工时"),
+                "price": item.get("报价"),
+            }
+            for item in estimation.line_items or []
+        ]
+        feature_set = {feature["feature_key"] for feature in features}
+        key = requirement_key(requirement)
+        with self._lock:
+            duplicate = self._find_duplicate(key, feature_set)
+        if duplicate is not None:
+            log.debug(f"需求已有相同的报价测算，不重复保存: {duplicate['project_id']}")
+            return duplicate["project_id"]
+        signature = self.signature(feature_set)
+        name = name or requirement.strip().split("\n")[0][:50]
+
+        project_id, quote_id = save_quote(name, requirement, estimation.dict(), features, signature.tolist())
+        with self._lock:
+            self._add({
+                "quote_id": quote_id,
+                "project_id": project_id,
+                "name": name,
+                "requirement_key": key,
+                "estimated_cost": estimation.total_cost,
+                "actual_cost": None,
+                "recommended_price": estimation.price_range.get("recommended"),
+                "features": feature_set,
+            }, signature)
+        return project_id
+
+def estimation_features(estimation: CostEstimation) -> Set[str]:
+    """成本测算结果的功能集合"""
+    return {feature_key(item.get("功能模块", ""), item.get("功能细分", "")) for item in estimation.line_items or []}
+
+# 共享的历史项目库
+project_history = ProjectHistory()
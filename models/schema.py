@@ -78,6 +78,9 @@ class CostEstimation(BaseModel):
     price_range: Dict[str, float] = Field(..., description="报价区间：最低/建议/最高")
     estimated_duration: Optional[int] = Field(default=None, description="预估项目周期（天）")
     risk_assessment: Optional[str] = Field(default=None, description="风险评估")
+    line_items: Optional[List[Dict[str, Any]]] = Field(default=None, description="功能明细，每个元素包含项目模块、功能模块、功能细分、数量、工时、报价")
+    unmatched_features: Optional[List[str]] = Field(default=None, description="报价矩阵中未匹配到的需求功能")
+    similar_projects: Optional[List[Dict[str, Any]]] = Field(default=None, description="相似历史项目，每个元素包含项目、相似度、测算成本、实际成本")
     
     def format_to_markdown(self) -> str:
         """将成本测算结果格式化为Markdown格式"""
@@ -99,6 +102,28 @@ class CostEstimation(BaseModel):
         for role, days in self.workday_breakdown.items():
             markdown += f"| {role} | {days} |\n"
         
+        # 功能明细
+        if self.line_items:
+            markdown += "\n### 功能明细\n\n"
+            markdown += "| 项目模块 | 功能模块 | 功能细分 | 数量 | 工时 | 报价 |\n"
+            markdown += "| -------- | -------- | -------- | ---- | ---- | ---- |\n"
+            for item in self.line_items:
+                markdown += f"| {item.get('项目模块', '')} | {item.get('功能模块', '')} | {item.get('功能细分', '')} | {item.get('数量', '')} | {item.get('工时', '')} | {item.get('报价', '')} |\n"
+        
+        if self.unmatched_features:
+            markdown += "\n**报价矩阵未覆盖的功能（需人工评估）**:\n"
+            for feature in self.unmatched_features:
+                markdown += f"- {feature}\n"
+        
+        # 相似历史项目
+        if self.similar_projects:
+            markdown += "\n### 相似历史项目\n\n"
+            markdown += "| 项目 | 相似度 | 测算成本 | 实际成本 |\n"
+            markdown += "| ---- | ------ | -------- | -------- |\n"
+            for project in self.similar_projects:
+                actual_cost = project.get('实际成本')
+                markdown += f"| {project.get('项目', '')} | {project.get('相似度', '')} | {project.get('测算成本', '')} | {actual_cost if actual_cost is not None else '-'} |\n"
+        
         # 资源分配建议
         markdown += "\n### 资源分配建议\n\n"
         
@@ -142,6 +167,12 @@ class ConversationHistory(BaseModel):
     end_time: Optional[datetime] = Field(default=None, description="对话结束时间")
     talk: Optional[Dict[str, Any]] = Field(default=None, description="元数据")
 
+# 项目实际成本回填模型
+class ActualCostUpdate(BaseModel):
+    """项目结束后回填的实际成本"""
+    actual_cost: float = Field(..., ge=0, description="实际成本")
+    status: str = Field(default="finished", description="项目状态")
+
 # 项目记录模型
 class Project(BaseModel):
     """项目记录模型"""
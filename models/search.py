@@ -1,4 +1,5 @@
-from typing import Dict, List, Any
+import threading
+from typing import Dict, List, Any, Optional
 from models.vector_store import VectorStoreManager
 
 class SearchHelper:
@@ -38,6 +39,10 @@ class SearchHelper:
         
         return results
     
+    def knowledge_base_generation(self) -> str:
+        """当前知识库版本"""
+        return self.vector_store.generation
+
     def format_search_results(self, results: List[Dict[str, Any]]) -> str:
         """格式化搜索结果为文本"""
         if not results:
@@ -49,4 +54,17 @@ class SearchHelper:
             formatted_text += f"相关度: {result['relevance']:.2f}\n"
             formatted_text += f"内容: {result['content']}\n\n"
         
-        return formatted_text
\ No newline at end of file
+        return formatted_text
+
+# 共享的搜索助手，避免每次检索都重新加载向量库
+_search_helper: Optional[SearchHelper] = None
+_search_helper_lock = threading.Lock()
+
+def get_search_helper() -> SearchHelper:
+    """获取共享的搜索助手"""
+    global _search_helper
+    if _search_helper is None:
+        with _search_helper_lock:
+            if _search_helper is None:
+                _search_helper = SearchHelper()
+    return _search_helper
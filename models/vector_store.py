@@ -3,6 +3,7 @@ import hashlib
 from typing import List
 from langchain_community.vectorstores import Chroma, chroma
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_ollama import OllamaEmbeddings
 
 from config import (
@@ -11,20 +12,39 @@ from config import (
     MMR_DIVERSITY, SIMILARITY_THRESHOLD
 )
 
+from utils import tracing
 from utils.document_loader import DocumentLoader
 from models.database import get_doc_fingerprints, add_doc_fingerprints, clear_doc_fingerprints
 
+class TracedEmbeddings(Embeddings):
+    """嵌入模型包装，将嵌入计算的耗时记录到当前请求的追踪中"""
+
+    def __init__(self, embeddings: Embeddings):
+        self.embeddings = embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with tracing.span("embedding", "embedding", texts=len(texts)):
+            return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with tracing.span("embedding", "embedding", chars=len(text)):
+            return self.embeddings.embed_query(text)
+
 class VectorStoreManager:
     def __init__(self):
-        self.embeddings = OllamaEmbeddings(
+        self.embeddings = TracedEmbeddings(OllamaEmbeddings(
             model=EMBEDDING_MODEL,
             base_url=EMBEDDING_BASE_URL,
-        )
+        ))
         self.vector_store = None
         self._load_or_create_store()
         # 初始化向量存储
         
         documents = DocumentLoader().load_documents("docs")
+        # 知识库版本：文档内容变化时随之变化，用于使依赖检索结果的缓存失效
+        self.generation = self._calculate_generation(
+            [self._calculate_doc_fingerprint(doc) for doc in documents]
+        )
         if documents:
             if self.vector_store is None:
                 self.vector_store = Chroma.from_documents(
@@ -53,6 +73,11 @@ class VectorStoreManager:
         fingerprint_str = f"{content}{metadata_str}"
         return hashlib.md5(fingerprint_str.encode('utf-8')).hexdigest()
 
+    def _calculate_generation(self, fingerprints: List[str], base: str = "") -> str:
+        """根据文档指纹计算知识库版本"""
+        generation_str = base + "".join(sorted(fingerprints))
+        return hashlib.md5(generation_str.encode('utf-8')).hexdigest()
+
     def _filter_new_documents(self, documents: List[Document]) -> List[Document]:
         """过滤出新文档"""
         # 获取现有指纹
@@ -98,6 +123,10 @@ class VectorStoreManager:
             )
         else:
             self.vector_store.add_documents(new_documents)
+
+        self.generation = self._calculate_generation(
+            [self._calculate_doc_fingerprint(doc) for doc in new_documents], base=self.generation
+        )
         
     def search(self, 
                query: str, 
@@ -124,6 +153,10 @@ class VectorStoreManager:
             print(f"未知的搜索模式: {mode}，使用默认模式: {DEFAULT_SEARCH_MODE}")
             mode = DEFAULT_SEARCH_MODE
         
+        with tracing.span("vector_search", "retrieval", mode=mode, k=k):
+            return self._search(query, mode, k, **kwargs)
+
+    def _search(self, query: str, mode: str, k: int, **kwargs) -> List[Document]:
         try:
             if mode == "similarity":
                 # 标准相似度搜索
@@ -177,6 +210,7 @@ class VectorStoreManager:
             shutil.rmtree(os.path.dirname(CHROMADB_PATH))
         self.vector_store = None
         clear_doc_fingerprints()
+        self.generation = self._calculate_generation([])
 
 if __name__ == "__main__":
     # 测试向量化后存储
@@ -0,0 +1,100 @@
+"""流式JSON解析器测试：代码块标记、跨块转义、嵌套值和非JSON输出"""
+
+import json
+
+import pytest
+
+from utils.stream_json import StreamingJSONParser
+
+def feed_chunks(parser: StreamingJSONParser, chunks):
+    """逐块输入，返回每块转发的文本"""
+    return [parser.feed(chunk) for chunk in chunks]
+
+def split_every(text: str, size: int):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+ROUTE = {"next_node": "__end__", "is_final": "True", "inputs": "", "output": "您好，我们公司成立于2015年。"}
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 1000])
+def test_streams_field_at_any_chunk_size(size):
+    text = json.dumps(ROUTE, ensure_ascii=False)
+    parser = StreamingJSONParser("output")
+    output = "".join(feed_chunks(parser, split_every(text, size)))
+    assert output == ROUTE["output"]
+    assert parser.is_json is True
+    assert parser.done
+    assert parser.fields == ROUTE
+
+def test_only_stream_field_is_forwarded():
+    parser = StreamingJSONParser("output")
+    output = parser.feed('{"inputs": "不转发", "output": "转发"}')
+    assert output == "转发"
+    assert parser.fields["inputs"] == "不转发"
+
+def test_without_stream_field_json_is_not_forwarded():
+    parser = StreamingJSONParser()
+    assert parser.feed('{"output": "内容"}') == ""
+    assert parser.fields == {"output": "内容"}
+
+def test_fields_available_before_object_ends():
+    parser = StreamingJSONParser("output")
+    parser.feed('{"next_node": "company", "is_final": false, "output": "部分')
+    assert parser.fields["next_node"] == "company"
+    assert parser.fields["is_final"] is False
+    assert not parser.done
+
+@pytest.mark.parametrize("fence", ["```json\n", "```\n", "  ```json\n  "])
+def test_code_fence(fence):
+    parser = StreamingJSONParser("output")
+    chunks = feed_chunks(parser, split_every(fence + '{"output": "答案"}\n```', 2))
+    assert "".join(chunks) == "答案"
+    assert parser.is_json is True
+    assert parser.done
+
+@pytest.mark.parametrize("escaped, expected", [
+    ('第一行\\n第二行', "第一行\n第二行"),
+    ('引号\\"和反斜杠\\\\', '引号"和反斜杠\\'),
+    ('\\u4e2d\\u6587', "中文"),
+    ('表情\\ud83d\\ude00', "表情\U0001F600"),
+    ('制表\\t斜杠\\/', "制表\t斜杠/"),
+])
+@pytest.mark.parametrize("size", [1, 2, 5])
+def test_escapes_split_across_chunks(escaped, expected, size):
+    parser = StreamingJSONParser("output")
+    output = "".join(feed_chunks(parser, split_every('{"output": "' + escaped + '"}', size)))
+    assert output == expected
+    assert parser.fields["output"] == expected
+
+def test_nested_values():
+    value = {
+        "steps": [{"node": "requirement", "inputs": "含有 } 和 ] 的\"文本\""}, {"node": "estimation"}],
+        "meta": {"a": [1, 2, {"b": None}]},
+    }
+    text = json.dumps({**value, "output": "结束"}, ensure_ascii=False)
+    parser = StreamingJSONParser("output")
+    output = "".join(feed_chunks(parser, split_every(text, 3)))
+    assert output == "结束"
+    assert parser.fields["steps"] == value["steps"]
+    assert parser.fields["meta"] == value["meta"]
+
+def test_scalar_values():
+    parser = StreamingJSONParser()
+    parser.feed('{"confidence": 0.85, "ok": true, "missing": null, "count": 3}')
+    assert parser.fields == {"confidence": 0.85, "ok": True, "missing": None, "count": 3}
+    assert parser.done
+
+@pytest.mark.parametrize("text", ["您好，我是助手。", "  \n直接回答", "[1, 2]"])
+def test_non_json_passthrough(text):
+    parser = StreamingJSONParser("output")
+    chunks = split_every(text, 2)
+    output = "".join(feed_chunks(parser, chunks))
+    assert output == text
+    assert parser.is_json is False
+    assert parser.fields == {}
+
+def test_undetermined_until_first_significant_char():
+    parser = StreamingJSONParser("output")
+    assert parser.feed("  \n") == ""
+    assert parser.is_json is None
+    assert parser.feed("文本") == "  \n文本"
+    assert parser.is_json is False
@@ -1,4 +1,6 @@
-from numpy import mod
+import re
+from typing import Any, Dict, List, Optional
+
 import pandas as pd
 
 def parse_excel_to_list(file_path):
@@ -60,10 +62,77 @@ def parse_excel_to_list(file_path):
     # 输出结果
     res = file_path.split(".")[0] + "\n" + "\n".join(result)
     # 保存结果到word文件
-    with open(file_path.split(".")[0] + ".md", "wb", encoding="utf-8") as f:
+    with open(file_path.split(".")[0] + ".md", "w", encoding="utf-8") as f:
         f.write(res)
     return res
 
+def _cell_text(value: Any) -> Optional[str]:
+    """读取文本单元格，空单元格返回None"""
+    if value is None or pd.isna(value):
+        return None
+    text = str(value).strip()
+    return text or None
+
+def _cell_number(value: Any) -> Optional[float]:
+    """读取数值单元格，兼容"16小时"、"1,200元"这类文本写法"""
+    if value is None or pd.isna(value):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.search(r"\d+(?:\.\d+)?", str(value).replace(",", ""))
+    return float(match.group()) if match else None
+
+def parse_excel_to_rows(file_path: str) -> List[Dict[str, Any]]:
+    """将报价矩阵解析为结构化的功能行
+
+    每行包含 port(项目模块)、module(功能模块)、feature(功能细分)、description、hours、price，
+    合并单元格留空的项目模块和功能模块沿用上一行的值。
+    """
+    df = pd.read_excel(file_path)
+
+    rows: List[Dict[str, Any]] = []
+    current_port = None
+    current_module = None
+
+    for _, row in df.iterrows():
+        port = _cell_text(row.get("项目模块"))
+        module = _cell_text(row.get("功能模块"))
+        feature = _cell_text(row.get("功能细分"))
+        description = _cell_text(row.get("功能描述"))
+        hours = _cell_number(row.get("工时"))
+        price = _cell_number(row.get("报价"))
+
+        if port:
+            current_port = port
+            current_module = None
+        if module:
+            current_module = module
+
+        # 没有功能细分但带工时的模块行，按模块本身计价
+        if not feature and module and hours is not None:
+            feature = module
+
+        if feature:
+            rows.append({
+                "port": current_port or "",
+                "module": current_module or "",
+                "feature": feature,
+                "description": description or "",
+                "hours": hours,
+                "price": price,
+            })
+        elif rows:
+            # 续行：补充上一个功能的描述、工时和报价
+            last = rows[-1]
+            if description:
+                last["description"] = "\n".join(filter(None, [last["description"], description]))
+            if last["hours"] is None and hours is not None:
+                last["hours"] = hours
+            if last["price"] is None and price is not None:
+                last["price"] = price
+
+    return rows
+
 # 调用函数并打印结果
 if __name__ == "__main__":
     file_path = "docs/社区信息公示项目需求.xls"  # 替换为您的文件路径
@@ -0,0 +1,164 @@
+"""对话历史构建模块，按各Agent的token预算构建提示中的历史对话上下文"""
+
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional
+
+from config import HISTORY_BUDGETS, HISTORY_RECENT_MESSAGES, HISTORY_MAX_MESSAGE_TOKENS
+from utils import metrics
+
+# 中日韩字符，每个字符大约占用一个token
+CJK_PATTERN = re.compile(r"[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]")
+# Markdown标题行
+HEADING_PATTERN = re.compile(r"^\s*#{1,6}\s+\S")
+# 摘要中每条消息保留的最大字符数
+SUMMARY_LINE_CHARS = 60
+# 对话摘要消息的角色，作为历史消息的第一条传入，见 workflows/memory.py
+SUMMARY_ROLE = "summary"
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的token数：中文按字计数，其他字符按每4个字符一个token计数"""
+    if not text:
+        return 0
+    cjk_count = len(CJK_PATTERN.findall(text))
+    return cjk_count + (len(text) - cjk_count + 3) // 4
+
+def extract_headings(content: str) -> List[str]:
+    """提取Markdown内容中的标题行"""
+    return [line.strip() for line in content.splitlines() if HEADING_PATTERN.match(line)]
+
+def condense_output(content: str, max_tokens: int) -> str:
+    """将过长的系统输出截断为标题，没有标题时截断为开头部分"""
+    if estimate_tokens(content) <= max_tokens:
+        return content
+    headings = extract_headings(content)
+    if headings:
+        condensed = "\n".join(headings)
+        if estimate_tokens(condensed) <= max_tokens:
+            return f"{condensed}\n（内容过长，仅保留标题）"
+    # 按估算比例截取开头部分
+    ratio = max_tokens / estimate_tokens(content)
+    return content[:int(len(content) * ratio)] + "…（内容过长，已截断）"
+
+def _role_name(msg: Dict[str, Any]) -> str:
+    return "用户" if msg.get("role") == "user" else "系统"
+
+class HistoryBuilder:
+    """历史对话构建器
+
+    最近的消息保留原文，更早的消息替换为滚动摘要，过长的系统输出只保留标题，
+    使提示中的历史对话长度不随对话增长而增长。
+    """
+
+    # 单条消息摘要缓存，所有构建器共享，键为消息ID或内容
+    _summary_cache: "OrderedDict[str, str]" = OrderedDict()
+    _summary_cache_size = 4096
+    _summary_cache_lock = threading.Lock()
+
+    def __init__(self, budget: int, recent_messages: int = HISTORY_RECENT_MESSAGES, max_message_tokens: int = HISTORY_MAX_MESSAGE_TOKENS):
+        """
+        初始化历史对话构建器
+
+        参数:
+            budget: 历史对话的token预算
+            recent_messages: 保留原文的最近消息数
+            max_message_tokens: 单条系统输出的最大token数，超过时只保留标题
+        """
+        self.budget = budget
+        self.recent_messages = recent_messages
+        self.max_message_tokens = max_message_tokens
+
+    def _format_message(self, msg: Dict[str, Any], max_tokens: int) -> str:
+        """格式化单条原文消息，过长的系统输出只保留标题"""
+        content = msg.get("content", "")
+        if msg.get("role") != "user":
+            content = condense_output(content, max_tokens)
+        return f"{_role_name(msg)}- {content}\n"
+
+    def _summarize_message(self, msg: Dict[str, Any]) -> str:
+        """生成单条消息的摘要行，结果按消息缓存"""
+        content = msg.get("content", "")
+        cache_key = msg.get("message_id") or f"{msg.get('role')}:{content}"
+        with self._summary_cache_lock:
+            if cache_key in self._summary_cache:
+                self._summary_cache.move_to_end(cache_key)
+                metrics.cache_requests.inc(cache="history_summary", result="hit")
+                return self._summary_cache[cache_key]
+        metrics.cache_requests.inc(cache="history_summary", result="miss")
+
+        headings = extract_headings(content) if msg.get("role") != "user" else []
+        if headings:
+            text = " / ".join(heading.lstrip("# ") for heading in headings)
+        else:
+            text = " ".join(content.split())
+        if len(text) > SUMMARY_LINE_CHARS:
+            text = text[:SUMMARY_LINE_CHARS] + "…"
+        line = f"{_role_name(msg)}: {text}"
+
+        with self._summary_cache_lock:
+            self._summary_cache[cache_key] = line
+            if len(self._summary_cache) > self._summary_cache_size:
+                self._summary_cache.popitem(last=False)
+        return line
+
+    def build(self, history: Optional[List[Dict[str, Any]]], summary: Optional[str] = None) -> str:
+        """按预算构建历史对话文本
+
+        参数:
+            history: 按时间顺序排列的历史消息，第一条可以是角色为 summary 的对话摘要
+            summary: 外部提供的更早对话的摘要，放在滚动摘要之前
+        """
+        if history and history[0].get("role") == SUMMARY_ROLE:
+            summary = summary or history[0].get("content", "")
+            history = history[1:]
+        if not history:
+            return summary or "无历史对话"
+
+        # 从最新的消息开始保留原文，直到达到条数或预算上限
+        recent_lines = []
+        used = 0
+        older = list(history)
+        while older and len(recent_lines) < self.recent_messages:
+            line = self._format_message(older[-1], self.max_message_tokens)
+            cost = estimate_tokens(line)
+            if used + cost > self.budget:
+                if recent_lines:
+                    break
+                # 最新一条消息始终保留，超出预算时压缩到预算以内
+                line = self._format_message(older[-1], self.budget)
+                cost = estimate_tokens(line)
+            recent_lines.insert(0, line)
+            used += cost
+            older.pop()
+
+        # 更早的消息替换为滚动摘要，对话摘要优先，其余从新到旧填充剩余预算
+        summary_lines = []
+        remaining = self.budget - used
+        if summary:
+            remaining -= estimate_tokens(summary) + 1
+        if older:
+            for msg in reversed(older):
+                line = self._summarize_message(msg)
+                cost = estimate_tokens(line) + 1
+                if cost > remaining:
+                    break
+                summary_lines.insert(0, line)
+                remaining -= cost
+        if summary:
+            summary_lines.insert(0, summary)
+
+        formatted_history = ""
+        if summary_lines:
+            formatted_history += "较早对话摘要:\n" + "\n".join(summary_lines) + "\n\n最近对话:\n"
+        formatted_history += "".join(recent_lines)
+        return formatted_history
+
+# 各Agent的历史对话构建器
+_builders: Dict[str, HistoryBuilder] = {}
+
+def get_history_builder(agent: str) -> HistoryBuilder:
+    """获取指定Agent的历史对话构建器"""
+    if agent not in _builders:
+        _builders[agent] = HistoryBuilder(HISTORY_BUDGETS.get(agent, HISTORY_BUDGETS["general"]))
+    return _builders[agent]
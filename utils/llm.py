@@ -0,0 +1,525 @@
+"""模型调用模块，负责按Agent配置的模型分层调用LLM，并统计各配置的延迟和token用量
+
+所有Agent的模型调用都经过 invoke：
+- 非流式调用的单次调用超时、流式调用的空闲超时和请求级截止时间，上游挂起时不会拖住整个工作流
+- 瞬时错误（超时、限流、连接错误、服务端错误）按带抖动的指数退避重试
+- 非流式调用可选对冲：超过该配置最近的p95延迟仍未返回时再发起一次相同请求，取先返回的结果
+- 按接口地址和模型熔断，熔断期间直接失败或改用升级模型
+- 请求剩余时间不足时，工作流节点可以在 small_model 上下文内把Agent模型替换为小模型
+"""
+
+import contextvars
+import json
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Any, Optional
+
+import openai
+from langchain_core.messages import AIMessage, message_chunk_to_message
+from langchain_openai import ChatOpenAI
+
+from config import (
+    SMALL_MODEL, ESCALATION_MODEL, MODEL_METRICS_WINDOW,
+    LLM_CALL_TIMEOUT, LLM_STREAM_IDLE_TIMEOUT, LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY, LLM_RETRY_MAX_DELAY,
+    LLM_HEDGING, LLM_HEDGE_MIN_SAMPLES, LLM_CALL_WORKERS,
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT,
+)
+from utils.history import estimate_tokens
+from utils import metrics as run_metrics, tracing
+from utils.logger import get_logger
+
+# 获取日志记录器
+log = get_logger("llm")
+
+def parse_json_object(content: str) -> Optional[Dict[str, Any]]:
+    """解析LLM返回的JSON对象，兼容```json代码块，无法解析时返回None"""
+    content = (content or "").strip()
+    if content.startswith("```"):
+        content = content.strip("`").removeprefix("json").strip()
+    try:
+        result = json.loads(content)
+    except json.JSONDecodeError:
+        return None
+    return result if isinstance(result, dict) else None
+
+class LLMUnavailableError(RuntimeError):
+    """模型暂不可用：重试耗尽、熔断或请求截止时间已到，调用方可以据此降级"""
+
+class LLMDeadlineExceeded(LLMUnavailableError):
+    """请求级截止时间已到"""
+
+class CircuitOpenError(LLMUnavailableError):
+    """接口处于熔断状态"""
+
+class LLMStreamInterrupted(LLMUnavailableError):
+    """流式调用输出部分内容后中断，不再重试"""
+
+class LLMCallTimeout(TimeoutError):
+    """单次调用超时，按瞬时错误重试"""
+
+# 可以重试的瞬时错误
+TRANSIENT_ERRORS = (
+    LLMCallTimeout,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+def create_llm(model_name: str, temperature: float, streaming: bool = False) -> ChatOpenAI:
+    """创建模型，重试由 invoke 统一处理，客户端不再自行重试"""
+    return ChatOpenAI(
+        model=model_name,
+        temperature=temperature,
+        streaming=streaming,
+        timeout=LLM_CALL_TIMEOUT,
+        max_retries=0
+    )
+
+def create_escalation_llm(model_name: str, temperature: float, streaming: bool = False) -> Optional[ChatOpenAI]:
+    """创建升级用的大模型，Agent本身已使用该模型时返回None"""
+    if not ESCALATION_MODEL or ESCALATION_MODEL == model_name:
+        return None
+    return create_llm(ESCALATION_MODEL, temperature, streaming)
+
+# 请求级截止时间（time.monotonic()），由API层在处理请求前设置，随上下文传递到各节点线程
+_request_deadline: ContextVar[Optional[float]] = ContextVar("llm_request_deadline", default=None)
+
+def set_request_deadline(seconds: Optional[float]) -> contextvars.Token:
+    """设置当前请求的截止时间，返回用于恢复的token"""
+    return _request_deadline.set(time.monotonic() + seconds if seconds else None)
+
+def reset_request_deadline(token: contextvars.Token):
+    _request_deadline.reset(token)
+
+@contextmanager
+def request_deadline(seconds: Optional[float]):
+    """上下文内的模型调用在 seconds 秒内结束，已有更早的截止时间或seconds为None时不做任何改变"""
+    current = _request_deadline.get()
+    deadline = None if seconds is None else time.monotonic() + seconds
+    if deadline is None or (current is not None and current <= deadline):
+        yield
+        return
+    token = _request_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _request_deadline.reset(token)
+
+def remaining_time() -> Optional[float]:
+    """当前请求剩余的时间（秒），未设置截止时间时返回None"""
+    deadline = _request_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+# 降级到小模型的开关，由工作流节点在请求剩余时间不足时开启
+_prefer_small_model: ContextVar[bool] = ContextVar("llm_prefer_small_model", default=False)
+_small_llms: Dict[tuple, ChatOpenAI] = {}
+_small_llms_lock = threading.Lock()
+
+@contextmanager
+def small_model(enabled: bool = True):
+    """上下文内的模型调用改用小模型且不再升级，enabled为False时不做任何改变"""
+    token = _prefer_small_model.set(enabled)
+    try:
+        yield
+    finally:
+        _prefer_small_model.reset(token)
+
+def prefers_small_model() -> bool:
+    """当前上下文内的模型调用是否改用小模型"""
+    return _prefer_small_model.get()
+
+def _small_llm_for(llm: Any) -> Optional[ChatOpenAI]:
+    """返回与Agent模型参数相同的小模型，Agent本身已使用小模型时返回None"""
+    if not isinstance(llm, ChatOpenAI) or llm.model_name == SMALL_MODEL:
+        return None
+    key = (llm.temperature, llm.streaming)
+    with _small_llms_lock:
+        if key not in _small_llms:
+            _small_llms[key] = create_llm(SMALL_MODEL, llm.temperature, llm.streaming)
+        return _small_llms[key]
+
+class CircuitBreaker:
+    """熔断器：连续失败达到阈值后熔断，冷却后放行一次试探调用"""
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        """是否放行本次调用，半开状态只放行一次试探"""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def release(self):
+        """释放试探名额，不改变熔断状态"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    log.warning(f"模型接口熔断: {self.name}，连续失败 {self.failures} 次")
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(llm: Any) -> CircuitBreaker:
+    """按接口地址和模型获取熔断器"""
+    endpoint = f"{getattr(llm, 'openai_api_base', None) or 'default'}|{_model_name(llm)}"
+    with _breakers_lock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = CircuitBreaker(endpoint)
+        return _breakers[endpoint]
+
+def breaker_states() -> Dict[str, str]:
+    """各接口的熔断状态"""
+    with _breakers_lock:
+        return {name: breaker.state for name, breaker in _breakers.items()}
+
+class ProfileMetrics:
+    """各模型配置的调用统计：调用次数、升级次数、错误次数、延迟分位数和token用量"""
+
+    def __init__(self, window: int = MODEL_METRICS_WINDOW):
+        self.window = window
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def _profile_stats(self, profile: str) -> Dict[str, Any]:
+        return self._stats.setdefault(profile, {
+                "calls": 0,
+                "escalations": 0,
+                "errors": 0,
+                "retries": 0,
+                "hedges": 0,
+                "timeouts": 0,
+                "downgrades": 0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "models": {},
+                "latencies": deque(maxlen=self.window),
+            })
+
+    def record(self, profile: str, model: str, latency: float, prompt_tokens: int = 0,
+               completion_tokens: int = 0, escalated: bool = False, error: bool = False):
+        """记录一次模型调用"""
+        with self._lock:
+            stats = self._profile_stats(profile)
+            stats["calls"] += 1
+            stats["escalations"] += int(escalated)
+            stats["errors"] += int(error)
+            stats["prompt_tokens"] += prompt_tokens
+            stats["completion_tokens"] += completion_tokens
+            stats["models"][model] = stats["models"].get(model, 0) + 1
+            if not error:
+                # 只统计成功调用的延迟，失败的快速返回会拉低对冲阈值
+                stats["latencies"].append(latency)
+
+    def count(self, profile: str, key: str):
+        """累加重试、对冲、超时等事件计数"""
+        with self._lock:
+            self._profile_stats(profile)[key] += 1
+
+    def latency_percentile(self, profile: str, q: float, min_samples: int = 1) -> Optional[float]:
+        """最近窗口内的延迟分位数，样本不足时返回None"""
+        with self._lock:
+            latencies = sorted(self._stats.get(profile, {}).get("latencies", []))
+        if len(latencies) < max(min_samples, 1):
+            return None
+        return _percentile(latencies, q)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """返回各配置的统计快照，延迟为最近窗口内的分位数（秒）"""
+        with self._lock:
+            result = {}
+            for profile, stats in self._stats.items():
+                latencies = sorted(stats["latencies"])
+                result[profile] = {
+                    key: (dict(value) if isinstance(value, dict) else value)
+                    for key, value in stats.items() if key != "latencies"
+                }
+                result[profile].update({
+                    "latency_avg": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+                    "latency_p50": round(_percentile(latencies, 0.5), 3),
+                    "latency_p95": round(_percentile(latencies, 0.95), 3),
+                })
+            return result
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+# 全局调用统计
+metrics = ProfileMetrics()
+
+def _usage(messages: List, response: Any) -> tuple:
+    """读取响应的token用量，模型未返回用量时按文本估算"""
+    usage = getattr(response, "usage_metadata", None) or {}
+    prompt_tokens = usage.get("input_tokens") or sum(estimate_tokens(str(message.content)) for message in messages)
+    completion_tokens = usage.get("output_tokens") or estimate_tokens(str(getattr(response, "content", "")))
+    return prompt_tokens, completion_tokens
+
+def _model_name(llm: Any) -> str:
+    return getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__
+
+# 执行模型调用的线程池，用于超时等待和对冲请求
+_executor = ThreadPoolExecutor(max_workers=LLM_CALL_WORKERS, thread_name_prefix="llm")
+
+# 超时后放弃的流式调用的运行ID，API层不再转发这些运行迟到的输出
+_abandoned_runs: deque = deque(maxlen=256)
+
+def is_abandoned(run_id: str) -> bool:
+    """流式调用是否已超时放弃"""
+    return run_id in _abandoned_runs
+
+class _Progress:
+    """一次调用的执行进度：开始执行的时间、最近一次收到流式输出的时间，调用方放弃后不再读取流式输出"""
+
+    def __init__(self):
+        self.started: Optional[float] = None
+        self.last_output: Optional[float] = None
+        self.emitted = False
+        self.abandoned = threading.Event()
+
+def _run(llm: Any, messages: List, progress: _Progress) -> Any:
+    progress.started = time.perf_counter()
+    return llm.invoke(messages)
+
+def _stream(llm: Any, messages: List, progress: _Progress, run_id: uuid.UUID) -> Any:
+    """逐块读取流式输出并记录进度，调用方放弃后关闭流"""
+    progress.started = progress.last_output = time.perf_counter()
+    response = None
+    stream = llm.stream(messages, config={"run_id": run_id})
+    try:
+        for chunk in stream:
+            if progress.abandoned.is_set():
+                break
+            progress.last_output = time.perf_counter()
+            progress.emitted = progress.emitted or bool(chunk.content)
+            response = chunk if response is None else response + chunk
+    finally:
+        stream.close()
+    return AIMessage(content="") if response is None else message_chunk_to_message(response)
+
+def _submit(fn: Callable, *args) -> Future:
+    # 复制上下文，使流式回调和请求截止时间在线程中仍然有效
+    context = contextvars.copy_context()
+    return _executor.submit(context.run, fn, *args)
+
+def shutdown():
+    """应用关闭时释放模型调用线程池，等待中的调用不再执行"""
+    _executor.shutdown(wait=False, cancel_futures=True)
+
+def _record_response(profile: str, llm: Any, messages: List, response: Any, latency: float, escalated: bool):
+    prompt_tokens, completion_tokens = _usage(messages, response)
+    metrics.record(profile, _model_name(llm), latency, prompt_tokens, completion_tokens, escalated)
+    tracing.annotate(model=_model_name(llm))
+    tracing.accumulate(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+    run_metrics.llm_tokens.inc(prompt_tokens, profile=profile, direction="prompt")
+    run_metrics.llm_tokens.inc(completion_tokens, profile=profile, direction="completion")
+
+def _attempt(profile: str, llm: Any, messages: List, remaining: Optional[float], escalated: bool) -> Any:
+    """执行一次调用，流式调用按空闲时间判断超时，非流式调用按单次调用超时"""
+    if getattr(llm, "streaming", False) and hasattr(llm, "stream"):
+        return _attempt_stream(profile, llm, messages, remaining, escalated)
+    timeout = LLM_CALL_TIMEOUT if remaining is None else min(LLM_CALL_TIMEOUT, remaining)
+    start = time.perf_counter()
+    progresses = [_Progress()]
+    futures = [_submit(_run, llm, messages, progresses[0])]
+
+    hedge_delay = None
+    if LLM_HEDGING:
+        hedge_delay = metrics.latency_percentile(profile, 0.95, LLM_HEDGE_MIN_SAMPLES)
+    if hedge_delay is not None and hedge_delay < timeout:
+        done, _ = wait(futures, timeout=hedge_delay)
+        if not done and progresses[0].started is not None:
+            log.info(f"{profile} 调用超过p95延迟 {hedge_delay:.2f}s，发起对冲请求")
+            metrics.count(profile, "hedges")
+            tracing.accumulate(hedges=1)
+            progresses.append(_Progress())
+            futures.append(_submit(_run, llm, messages, progresses[-1]))
+
+    error: Optional[BaseException] = None
+    deadline = None if remaining is None else start + remaining
+    while futures:
+        # 在线程池中排队的时间不计入单次调用超时，只受请求截止时间限制
+        started = progresses[0].started
+        call_deadline = (started if started is not None else time.perf_counter()) + LLM_CALL_TIMEOUT
+        wait_until = call_deadline if deadline is None else min(call_deadline, deadline)
+        done, pending = wait(futures, timeout=max(wait_until - time.perf_counter(), 0), return_when=FIRST_COMPLETED)
+        if not done:
+            if started is None and (deadline is None or time.perf_counter() < deadline):
+                continue
+            break
+        for future in done:
+            if future.exception() is None:
+                response = future.result()
+                _record_response(profile, llm, messages, response, time.perf_counter() - start, escalated)
+                return response
+            error = future.exception()
+        futures = list(pending)
+
+    for future in futures:
+        future.cancel()
+    metrics.record(profile, _model_name(llm), time.perf_counter() - start, escalated=escalated, error=True)
+    if error is not None and not futures:
+        raise error
+    metrics.count(profile, "timeouts")
+    raise LLMCallTimeout(f"{profile} 模型调用超过 {timeout:.1f}s 未返回")
+
+def _attempt_stream(profile: str, llm: Any, messages: List, remaining: Optional[float], escalated: bool) -> Any:
+    """执行一次流式调用
+
+    超过 LLM_STREAM_IDLE_TIMEOUT 没有新的输出（包括首个输出）或请求截止时间已到时放弃本次调用：
+    关闭流、记录运行ID使迟到的输出不再转发。已经输出token后中断的调用不再重试，避免客户端收到重复的输出。
+    """
+    start = time.perf_counter()
+    deadline = None if remaining is None else start + remaining
+    progress = _Progress()
+    run_id = uuid.uuid4()
+    future = _submit(_stream, llm, messages, progress, run_id)
+
+    while True:
+        now = time.perf_counter()
+        # 在线程池中排队的时间不计入空闲时间
+        idle_deadline = now + LLM_STREAM_IDLE_TIMEOUT if progress.last_output is None \
+            else progress.last_output + LLM_STREAM_IDLE_TIMEOUT
+        wait_until = idle_deadline if deadline is None else min(idle_deadline, deadline)
+        done, _ = wait([future], timeout=max(wait_until - now, 0))
+        if done:
+            break
+        now = time.perf_counter()
+        if deadline is not None and now >= deadline:
+            reason = "请求截止时间已到"
+            break
+        if progress.last_output is not None and now - progress.last_output >= LLM_STREAM_IDLE_TIMEOUT:
+            reason = f"超过 {LLM_STREAM_IDLE_TIMEOUT:.1f}s 没有新的输出"
+            break
+
+    if not done:
+        progress.abandoned.set()
+        future.cancel()
+        _abandoned_runs.append(str(run_id))
+        metrics.record(profile, _model_name(llm), time.perf_counter() - start, escalated=escalated, error=True)
+        metrics.count(profile, "timeouts")
+        if progress.emitted:
+            raise LLMStreamInterrupted(f"{profile} 流式输出中断: {reason}")
+        raise LLMCallTimeout(f"{profile} 模型调用{reason}")
+
+    error = future.exception()
+    if error is not None:
+        metrics.record(profile, _model_name(llm), time.perf_counter() - start, escalated=escalated, error=True)
+        if progress.emitted:
+            raise LLMStreamInterrupted(f"{profile} 流式输出中断: {error}") from error
+        raise error
+    response = future.result()
+    _record_response(profile, llm, messages, response, time.perf_counter() - start, escalated)
+    return response
+
+def _call(profile: str, llm: Any, messages: List, escalated: bool = False, fallback_llm: Any = None) -> Any:
+    """带截止时间、重试和熔断的模型调用"""
+    breaker = get_breaker(llm)
+    if not breaker.allow():
+        if fallback_llm is not None and get_breaker(fallback_llm).state != "open":
+            log.warning(f"{breaker.name} 处于熔断状态，改用 {_model_name(fallback_llm)}")
+            return _call(profile, fallback_llm, messages, escalated=True)
+        raise CircuitOpenError(f"模型接口熔断中: {breaker.name}")
+
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            raise LLMDeadlineExceeded(f"{profile} 请求已超过截止时间")
+        try:
+            response = _attempt(profile, llm, messages, remaining, escalated)
+        except LLMStreamInterrupted:
+            # 已经输出的内容无法撤回，不再重试
+            breaker.record_failure()
+            raise
+        except TRANSIENT_ERRORS as e:
+            breaker.record_failure()
+            remaining = remaining_time()
+            if remaining is not None and remaining <= 0:
+                raise LLMDeadlineExceeded(f"{profile} 请求已超过截止时间") from e
+            if attempt == LLM_MAX_RETRIES:
+                raise LLMUnavailableError(f"{profile} 模型调用重试 {LLM_MAX_RETRIES} 次后仍失败: {e}") from e
+            if not breaker.allow():
+                raise CircuitOpenError(f"模型接口熔断中: {breaker.name}") from e
+            # 带抖动的指数退避，不超过请求剩余时间
+            delay = random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt))
+            if remaining is not None:
+                delay = min(delay, max(remaining, 0))
+            log.warning(f"{profile} 模型调用失败，{delay:.2f}s 后第 {attempt + 1} 次重试: {e}")
+            metrics.count(profile, "retries")
+            tracing.accumulate(retries=1)
+            time.sleep(delay)
+            continue
+        except Exception:
+            # 参数错误、鉴权失败等非瞬时错误不重试，也不能说明接口已经恢复，只释放试探名额
+            breaker.release()
+            raise
+        breaker.record_success()
+        return response
+
+def invoke(profile: str, llm: Any, messages: List, validate: Optional[Callable[[str], bool]] = None,
+           escalation_llm: Any = None) -> Any:
+    """
+    按模型配置调用LLM
+
+    参数:
+        profile: 模型配置名称，用于统计
+        llm: Agent配置的模型
+        messages: 消息列表
+        validate: 校验输出是否可用（如JSON可解析、置信度足够），不通过时升级到大模型重试一次
+        escalation_llm: 升级用的大模型，为None时不升级；Agent模型熔断时也改用该模型
+
+    异常:
+        LLMUnavailableError: 重试耗尽、熔断或请求截止时间已到
+    """
+    with tracing.span(f"llm:{profile}", "llm", profile=profile):
+        if prefers_small_model():
+            small_llm = _small_llm_for(llm)
+            if small_llm is not None:
+                metrics.count(profile, "downgrades")
+                tracing.annotate(downgraded=True)
+                llm, escalation_llm = small_llm, None
+        response = _call(profile, llm, messages, fallback_llm=escalation_llm)
+        if validate is None or escalation_llm is None or validate(response.content):
+            return response
+
+        log.warning(f"{profile} 模型输出未通过校验，升级到 {_model_name(escalation_llm)} 重试")
+        tracing.annotate(escalated=True)
+        return _call(profile, escalation_llm, messages, escalated=True)
@@ -0,0 +1,230 @@
+"""运行指标模块，以进程内计数器汇总对话服务的延迟、token用量和缓存命中，按Prometheus文本格式导出
+
+- Counter：只增不减的计数，如token用量、缓存命中/未命中次数
+- Gauge：当前值，可以由回调函数在导出时读取，如活跃WebSocket连接数
+- Histogram：按固定分桶统计耗时分布，如端到端延迟、首个token时间
+
+每次记录只在对应标签组合上做加法，不保存原始样本，开销与标签组合数有关，与请求量无关。
+工作流节点、模型调用、检索、嵌入和数据库调用的耗时由请求追踪的span在结束时汇总，见 utils/tracing.py。
+"""
+
+import bisect
+import math
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# 默认耗时分桶（秒），覆盖数据库查询到完整对话轮次
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+# 数据库查询耗时分桶（秒）
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Metric:
+    """指标基类，按标签值组合分别计数"""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...], extra: Sequence[Tuple[str, str]] = ()) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"] + self.samples()
+
+class Counter(Metric):
+    """计数器"""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{self._labels(key)} {_format_value(value)}" for key, value in values]
+
+class Gauge(Metric):
+    """当前值，设置了回调函数时导出时读取回调的返回值"""
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float]):
+        """导出时调用function读取当前值，只用于没有标签的指标"""
+        self._function = function
+
+    def samples(self) -> List[str]:
+        if self._function is not None:
+            return [f"{self.name} {_format_value(self._function())}"]
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{self._labels(key)} {_format_value(value)}" for key, value in values]
+
+class Histogram(Metric):
+    """直方图，按分桶上界计数并累计总和"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # 标签值组合 -> [各分桶计数（非累计）, 总和]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return sum(entry[0]) if entry else 0
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._labels(key, [('le', _format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+class Registry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"指标已注册: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """按Prometheus文本格式导出全部指标"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+# 全局指标注册表
+registry = Registry()
+
+# Prometheus文本格式的Content-Type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 对话轮次
+chat_requests = registry.register(Counter(
+    "chat_requests_total", "对话请求数，coalesced为合并到进行中执行的请求", ["outcome"]))
+chat_turn_seconds = registry.register(Histogram(
+    "chat_turn_duration_seconds", "对话轮次端到端耗时：从收到请求到最终回答发送完成", ["status"]))
+chat_ttft_seconds = registry.register(Histogram(
+    "chat_time_to_first_token_seconds", "从收到请求到首个流式输出发送的耗时"))
+graph_runs_in_flight = registry.register(Gauge(
+    "graph_runs_in_flight", "进行中的工作流执行数"))
+websocket_connections = registry.register(Gauge(
+    "websocket_connections", "活跃的WebSocket连接数"))
+
+conversation_memory_conversations = registry.register(Gauge(
+    "conversation_memory_conversations", "对话记忆中缓存的对话数"))
+conversation_memory_bytes = registry.register(Gauge(
+    "conversation_memory_bytes", "对话记忆中缓存消息的估算字节数"))
+
+# 工作流节点、模型调用、检索和数据库
+node_seconds = registry.register(Histogram(
+    "workflow_node_duration_seconds", "工作流节点耗时", ["node"]))
+llm_seconds = registry.register(Histogram(
+    "llm_call_duration_seconds", "各模型配置的调用耗时，包括重试、对冲和升级", ["profile"]))
+llm_tokens = registry.register(Counter(
+    "llm_tokens_total", "各模型配置的token用量", ["profile", "direction"]))
+retrieval_seconds = registry.register(Histogram(
+    "retrieval_duration_seconds", "检索耗时：retrieval为节点检索（含备忘和预取命中），prefetch为预取检索，vector_search为向量库查询", ["operation"]))
+embedding_seconds = registry.register(Histogram(
+    "embedding_duration_seconds", "嵌入计算耗时"))
+db_query_seconds = registry.register(Histogram(
+    "db_query_duration_seconds", "SQL语句耗时", ["operation"], buckets=DB_BUCKETS))
+
+# 缓存命中：命中率 = hit / (hit + miss)
+cache_requests = registry.register(Counter(
+    "cache_requests_total", "缓存查询次数，retrieval缓存的命中分为memo和prefetch", ["cache", "result"]))
+
+# span类型 -> 汇总耗时的方式
+_SPAN_OBSERVERS: Dict[str, Callable[[str, dict, float], None]] = {
+    "node": lambda name, attrs, seconds: node_seconds.observe(seconds, node=name),
+    "llm": lambda name, attrs, seconds: llm_seconds.observe(seconds, profile=attrs.get("profile", name)),
+    "retrieval": lambda name, attrs, seconds: retrieval_seconds.observe(seconds, operation=name.split(":")[-1]),
+    "embedding": lambda name, attrs, seconds: embedding_seconds.observe(seconds),
+    "db": lambda name, attrs, seconds: db_query_seconds.observe(seconds, operation=attrs.get("operation", "")),
+}
+
+def observe_span(kind: str, name: str, attrs: dict, seconds: float):
+    """span结束时按类型汇总耗时"""
+    observer = _SPAN_OBSERVERS.get(kind)
+    if observer is not None:
+        observer(name, attrs, seconds)
@@ -0,0 +1,193 @@
+"""流式JSON解析模块，增量解析LLM流式输出的JSON对象
+
+LLM以JSON格式返回结构化结果时，需要等完整输出生成后才能解析。本模块逐块解析输出：
+- 顶层标量/数组字段（如 next_node、is_final）在其值结束时即可读取
+- 指定的字符串字段（如 output）在生成过程中即被增量解码，可以直接转发给客户端
+- 输出不是JSON时原样返回，兼容模型直接输出文本的情况
+"""
+
+import json
+from typing import Dict, Any, Optional
+
+# JSON字符串转义字符
+ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+class StreamingJSONParser:
+    """增量JSON解析器，只解析顶层对象"""
+
+    def __init__(self, stream_field: Optional[str] = None):
+        """
+        初始化增量JSON解析器
+
+        参数:
+            stream_field: 需要增量解码输出的字符串字段名，为None时JSON内容不输出
+        """
+        self.stream_field = stream_field
+        self.is_json: Optional[bool] = None  # 尚未确定时为None
+        self.fields: Dict[str, Any] = {}  # 已解析完成的顶层字段
+        self._state = "start"
+        self._held = ""  # 确定输出格式前暂存的字符（空白、代码块标记）
+        self._key = ""
+        self._buffer = ""
+        self._escape = False
+        self._unicode = None  # 正在收集的\u转义十六进制字符
+        self._high_surrogate = None
+        self._depth = 0
+        self._raw_in_string = False
+        self._raw_escape = False
+
+    @property
+    def done(self) -> bool:
+        """顶层JSON对象是否已解析完毕"""
+        return self._state == "done"
+
+    def feed(self, chunk: str) -> str:
+        """输入一块流式输出，返回可以转发的文本
+
+        JSON输出时返回stream_field字段本次新解码的内容，非JSON输出时原样返回。
+        """
+        if self.is_json is False:
+            return chunk
+        output = []
+        for index, char in enumerate(chunk):
+            if self._state in ("start", "fence"):
+                if not self._feed_start(char):
+                    # 不是JSON，暂存内容与剩余部分原样返回
+                    self.is_json = False
+                    return self._held + chunk[index:]
+                continue
+            decoded = self._feed_char(char)
+            if decoded and self._key == self.stream_field:
+                output.append(decoded)
+        return "".join(output)
+
+    def _feed_start(self, char: str) -> bool:
+        """识别JSON对象的开始，跳过空白和```json代码块标记，不是JSON时返回False"""
+        if self._state == "fence":
+            self._held += char
+            if char == "\n":
+                self._state = "start"
+            return True
+        if char.isspace():
+            self._held += char
+            return True
+        if char == "`":
+            self._held += char
+            self._state = "fence"
+            return True
+        if char == "{":
+            self.is_json = True
+            self._state = "key_or_end"
+            return True
+        return False
+
+    def _feed_char(self, char: str) -> str:
+        """处理JSON对象内部的一个字符，返回字符串值中新解码的内容"""
+        state = self._state
+        if state == "key_or_end":
+            if char == '"':
+                self._state, self._key, self._buffer = "key", "", ""
+            elif char == "}":
+                self._state = "done"
+        elif state == "key":
+            if self._escape:
+                self._buffer += ESCAPES.get(char, char)
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._key, self._buffer = self._buffer, ""
+                self._state = "colon"
+            else:
+                self._buffer += char
+        elif state == "colon":
+            if char == ":":
+                self._state = "value"
+        elif state == "value":
+            if char.isspace():
+                return ""
+            if char == '"':
+                self._state, self._buffer = "string", ""
+            else:
+                self._state, self._buffer = "raw", char
+                self._depth = 1 if char in "[{" else 0
+                self._raw_in_string = self._raw_escape = False
+        elif state == "string":
+            return self._feed_string(char)
+        elif state == "raw":
+            self._feed_raw(char)
+        elif state == "after_value":
+            if char == ",":
+                self._state = "key_or_end"
+            elif char == "}":
+                self._state = "done"
+        return ""
+
+    def _feed_string(self, char: str) -> str:
+        """处理字符串值中的一个字符，返回新解码的内容"""
+        decoded = ""
+        if self._unicode is not None:
+            self._unicode += char
+            if len(self._unicode) < 4:
+                return ""
+            code = int(self._unicode, 16)
+            self._unicode = None
+            if 0xD800 <= code <= 0xDBFF:
+                # 代理对的高位，等待低位
+                self._high_surrogate = code
+                return ""
+            if 0xDC00 <= code <= 0xDFFF and self._high_surrogate is not None:
+                code = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+            self._high_surrogate = None
+            decoded = chr(code)
+        elif self._escape:
+            self._escape = False
+            if char == "u":
+                self._unicode = ""
+                return ""
+            decoded = ESCAPES.get(char, char)
+        elif char == "\\":
+            self._escape = True
+            return ""
+        elif char == '"':
+            self.fields[self._key] = self._buffer
+            self._state = "after_value"
+            return ""
+        else:
+            decoded = char
+        self._buffer += decoded
+        return decoded
+
+    def _feed_raw(self, char: str) -> None:
+        """处理数字、布尔值、null、数组和对象等非字符串值"""
+        if self._raw_in_string:
+            self._buffer += char
+            if self._raw_escape:
+                self._raw_escape = False
+            elif char == "\\":
+                self._raw_escape = True
+            elif char == '"':
+                self._raw_in_string = False
+            return
+        if self._depth == 0 and char in ",}":
+            self._complete_raw()
+            self._state = "key_or_end" if char == "," else "done"
+            return
+        self._buffer += char
+        if char == '"':
+            self._raw_in_string = True
+        elif char in "[{":
+            self._depth += 1
+        elif char in "]}":
+            self._depth -= 1
+            if self._depth == 0:
+                self._complete_raw()
+                self._state = "after_value"
+
+    def _complete_raw(self) -> None:
+        """非字符串值结束，解析为Python对象"""
+        raw = self._buffer.strip()
+        try:
+            self.fields[self._key] = json.loads(raw)
+        except json.JSONDecodeError:
+            self.fields[self._key] = raw
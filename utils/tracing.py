@@ -0,0 +1,255 @@
+"""请求追踪模块，按请求记录工作流节点、模型调用、检索、嵌入和数据库调用的耗时
+
+- 每个请求一条追踪记录，由API层创建并通过上下文传递到各节点线程
+- span 记录一段操作的开始时间、耗时、父span和属性（模型、token数、缓存命中等）
+- 高频操作（如WebSocket发送）只累计次数和耗时，不逐条记录
+- 最近的追踪记录保存在环形缓冲区中，供API查询最慢的请求
+
+span结束时同时将耗时汇总到运行指标（utils/metrics.py），没有追踪记录或未启用追踪时仍然汇总；
+其他记录操作在当前上下文没有追踪记录时直接返回，开销可以忽略。
+"""
+
+import itertools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from config import TRACE_ENABLED, TRACE_BUFFER_SIZE, TRACE_MAX_SPANS
+from utils import metrics
+
+class Span:
+    """一段计时的操作"""
+
+    __slots__ = ("id", "name", "kind", "parent", "start", "duration", "attrs", "error")
+
+    def __init__(self, span_id: Optional[int], name: str, kind: str, parent: Optional[int], start: float, attrs: Dict[str, Any]):
+        self.id = span_id
+        self.name = name
+        self.kind = kind
+        self.parent = parent
+        self.start = start
+        self.duration: Optional[float] = None
+        self.attrs = attrs
+        self.error: Optional[str] = None
+
+def _has_ancestor_kind(span: Span, kinds: Dict[int, str], parents: Dict[int, Optional[int]]) -> bool:
+    parent = span.parent
+    while parent is not None:
+        if kinds.get(parent) == span.kind:
+            return True
+        parent = parents.get(parent)
+    return False
+
+class Trace:
+    """单个请求的追踪记录"""
+
+    def __init__(self, request_id: str, conversation_id: str = "", message: str = ""):
+        self.request_id = request_id
+        self.conversation_id = conversation_id
+        self.message = message[:100]
+        self.started_at = datetime.now()
+        self.start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.spans: List[Span] = []
+        self.totals: Dict[str, Dict[str, float]] = {}  # 高频操作的累计次数和耗时
+        self.marks: Dict[str, float] = {}  # 关键时间点（相对请求开始的秒数），如首个token
+        self.attrs: Dict[str, Any] = {}
+        self.dropped_spans = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, kind: str, parent: Optional[int], start: float, attrs: Dict[str, Any]) -> Optional[Span]:
+        with self._lock:
+            # 请求结束后到达的span（如结束后保存追踪记录的数据库调用）不再记录
+            if self.duration is not None:
+                return None
+            if len(self.spans) >= TRACE_MAX_SPANS:
+                self.dropped_spans += 1
+                return None
+            span = Span(next(self._ids), name, kind, parent, start, attrs)
+            self.spans.append(span)
+            return span
+
+    def add_total(self, name: str, seconds: float):
+        with self._lock:
+            total = self.totals.setdefault(name, {"count": 0, "seconds": 0.0})
+            total["count"] += 1
+            total["seconds"] += seconds
+
+    def mark(self, name: str):
+        """记录关键时间点，同名时间点只记录第一次"""
+        self.marks.setdefault(name, time.perf_counter() - self.start)
+
+    def to_dict(self, spans: bool = True) -> Dict[str, Any]:
+        """转换为可序列化的字典，耗时单位为毫秒，spans为False时只返回span数量"""
+        def ms(seconds: Optional[float]) -> Optional[float]:
+            return None if seconds is None else round(seconds * 1000, 1)
+
+        with self._lock:
+            ordered = sorted(self.spans, key=lambda span: span.start)
+            # 各类操作的累计耗时：同类span嵌套时只计外层，并行的span分别计入
+            kinds = {span.id: span.kind for span in ordered}
+            parents = {span.id: span.parent for span in ordered}
+            by_kind: Dict[str, float] = {}
+            for span in ordered:
+                if span.duration is None or _has_ancestor_kind(span, kinds, parents):
+                    continue
+                by_kind[span.kind] = by_kind.get(span.kind, 0.0) + span.duration
+            return {
+                "request_id": self.request_id,
+                "conversation_id": self.conversation_id,
+                "message": self.message,
+                "started_at": self.started_at.isoformat(),
+                "duration_ms": ms(self.duration if self.duration is not None else time.perf_counter() - self.start),
+                "finished": self.duration is not None,
+                "marks_ms": {name: ms(offset) for name, offset in self.marks.items()},
+                "by_kind_ms": {kind: ms(seconds) for kind, seconds in by_kind.items()},
+                "totals": {name: {"count": total["count"], "ms": ms(total["seconds"])} for name, total in self.totals.items()},
+                "attrs": dict(self.attrs),
+                "spans": len(ordered) if not spans else [
+                    {
+                        "id": span.id,
+                        "parent": span.parent,
+                        "name": span.name,
+                        "kind": span.kind,
+                        "start_ms": ms(span.start - self.start),
+                        "duration_ms": ms(span.duration),
+                        "attrs": span.attrs,
+                        **({"error": span.error} if span.error else {}),
+                    }
+                    for span in ordered
+                ],
+                "dropped_spans": self.dropped_spans,
+            }
+
+class TraceStore:
+    """最近请求追踪的环形缓冲区"""
+
+    def __init__(self, size: int = TRACE_BUFFER_SIZE):
+        self._traces: deque = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, trace: Trace):
+        with self._lock:
+            self._traces.append(trace)
+
+    def get(self, request_id: str) -> Optional[Trace]:
+        with self._lock:
+            return next((trace for trace in reversed(self._traces) if trace.request_id == request_id), None)
+
+    def recent(self, limit: int = 20, slowest: bool = False) -> List[Trace]:
+        """最近的追踪记录，slowest为True时按耗时从高到低排序"""
+        with self._lock:
+            traces = list(self._traces)
+        if slowest:
+            traces.sort(key=lambda trace: trace.duration or 0.0, reverse=True)
+        else:
+            traces.reverse()
+        return traces[:limit]
+
+# 全局追踪缓冲区
+trace_store = TraceStore()
+
+# 当前请求的追踪记录和当前span，随上下文传递到节点线程和模型调用线程
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+def start_trace(request_id: str, conversation_id: str = "", message: str = "") -> Optional[Trace]:
+    """创建请求的追踪记录，未启用追踪时返回None"""
+    if not TRACE_ENABLED:
+        return None
+    return Trace(request_id, conversation_id, message)
+
+@contextmanager
+def activate(trace: Optional[Trace]) -> Iterator[Optional[Trace]]:
+    """在上下文内将追踪记录设为当前请求的追踪记录"""
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+def finish_trace(trace: Optional[Trace], **attrs):
+    """结束追踪并保存到环形缓冲区"""
+    if trace is None or trace.duration is not None:
+        return
+    trace.attrs.update(attrs)
+    trace.duration = time.perf_counter() - trace.start
+    trace_store.add(trace)
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+@contextmanager
+def span(name: str, kind: str, **attrs) -> Iterator[Span]:
+    """记录一段操作的耗时，没有追踪记录或超过span上限时只汇总到运行指标"""
+    trace = _current_trace.get()
+    parent = _current_span.get()
+    parent_id = parent.id if parent else None
+    start = time.perf_counter()
+    current = trace.add_span(name, kind, parent_id, start, attrs) if trace is not None else None
+    if current is None:
+        # 不属于追踪记录的span，仍然收集属性供指标使用
+        current = Span(None, name, kind, parent_id, start, attrs)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"[:200]
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.start
+        _current_span.reset(token)
+        metrics.observe_span(kind, name, current.attrs, current.duration)
+
+def traced(name: str, kind: str) -> Callable:
+    """装饰器：将函数调用记录为span"""
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, kind):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_span(name: str, kind: str, start: float, **attrs):
+    """记录已经结束的操作，start为time.perf_counter()的开始时间"""
+    duration = time.perf_counter() - start
+    metrics.observe_span(kind, name, attrs, duration)
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    parent = _current_span.get()
+    recorded = trace.add_span(name, kind, parent.id if parent else None, start, attrs)
+    if recorded is not None:
+        recorded.duration = duration
+
+def annotate(**attrs):
+    """设置当前span的属性"""
+    current = _current_span.get()
+    if current is not None:
+        current.attrs.update(attrs)
+
+def accumulate(**counts):
+    """累加当前span的数值属性，如一次模型调用中重试和升级产生的token数"""
+    current = _current_span.get()
+    if current is not None:
+        for key, value in counts.items():
+            current.attrs[key] = current.attrs.get(key, 0) + value
+
+def add_total(name: str, seconds: float):
+    """累计高频操作的次数和耗时"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_total(name, seconds)
+
+def mark(name: str):
+    """记录当前请求的关键时间点"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.mark(name)
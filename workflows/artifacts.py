@@ -0,0 +1,55 @@
+"""请求级工具产出模块，工具节点的完整输出存放在请求级的产出存储中，路由提示只引用紧凑的描述"""
+
+from typing import Dict, List, Any, Optional
+
+from utils.history import estimate_tokens, extract_headings
+
+# 描述中内容摘要的最大字符数
+DIGEST_CHARS = 80
+
+def artifact_id(node: str) -> str:
+    """工具产出ID，同一请求中每个工具节点只执行一次"""
+    return f"artifact:{node}"
+
+def digest(content: str) -> str:
+    """生成内容摘要：优先使用Markdown标题，否则使用内容开头"""
+    headings = extract_headings(content)
+    if headings:
+        text = " / ".join(heading.lstrip("# ") for heading in headings)
+    else:
+        text = " ".join(content.split())
+    if len(text) > DIGEST_CHARS:
+        text = text[:DIGEST_CHARS] + "…"
+    return text
+
+def store(node: str, content: str) -> Dict[str, Any]:
+    """保存工具节点的完整输出，返回需要合并到State中的增量
+
+    tools_response中只追加紧凑描述（节点、状态、摘要、token长度），完整内容写入artifacts。
+    """
+    content = content or ""
+    descriptor = {
+        "node": node,
+        "status": "ok" if content.strip() else "empty",
+        "artifact_id": artifact_id(node),
+        "digest": digest(content),
+        "tokens": estimate_tokens(content),
+    }
+    return {
+        "tools_response": [descriptor],
+        "artifacts": {artifact_id(node): {"node": node, "content": content}},
+    }
+
+def get_content(state: Dict[str, Any], node: str) -> Optional[str]:
+    """获取指定工具节点的完整输出"""
+    artifact = (state.get("artifacts") or {}).get(artifact_id(node))
+    return artifact["content"] if artifact else None
+
+def collect(state: Dict[str, Any]) -> List[Dict[str, str]]:
+    """按执行顺序取出所有工具节点的完整输出，供最终汇总使用"""
+    results = []
+    for descriptor in state.get("tools_response") or []:
+        content = get_content(state, descriptor["node"])
+        if content is not None:
+            results.append({"node": descriptor["node"], "result": content})
+    return results
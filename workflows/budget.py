@@ -0,0 +1,74 @@
+"""请求时间预算模块，根据请求剩余时间决定各节点的降级策略
+
+请求开始时在State中写入截止时间，各节点执行前查询降级策略，剩余时间越少降级越多：
+- 降低检索数量
+- 改用小模型
+- 跳过检索
+- 不再调用新的工具节点，根据已有结果给出部分回答并附带提示
+"""
+
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, NamedTuple, Optional
+
+from config import (
+    REQUEST_SLO,
+    MAX_HOPS,
+    DEFAULT_SEARCH_K,
+    DEGRADED_SEARCH_K,
+    DEGRADE_REDUCED_K_BELOW,
+    DEGRADE_SMALL_MODEL_BELOW,
+    DEGRADE_SKIP_RETRIEVAL_BELOW,
+    DEGRADE_PARTIAL_BELOW,
+)
+from utils.llm import request_deadline
+
+# 部分回答时附加的提示
+PARTIAL_NOTICE = "\n\n（受响应时间限制，部分处理步骤已省略，以上回答基于已完成的结果，如需完整结果请稍后重试。）"
+
+class Degradation(NamedTuple):
+    """节点降级策略"""
+    search_k: int = DEFAULT_SEARCH_K  # 检索数量
+    skip_retrieval: bool = False      # 跳过检索
+    small_model: bool = False         # 改用小模型
+    partial: bool = False             # 不再调用新的工具节点，返回部分结果
+
+def new_deadline(slo: float = REQUEST_SLO) -> float:
+    """计算请求截止时间（时间戳）"""
+    return time.time() + slo
+
+def remaining(state: Dict[str, Any]) -> Optional[float]:
+    """请求剩余时间（秒），State中没有截止时间时返回None"""
+    deadline = state.get("deadline")
+    return None if not deadline else deadline - time.time()
+
+@contextmanager
+def llm_deadline(state: Dict[str, Any]) -> Iterator[None]:
+    """节点内的模型调用（包括重试）不超过State中的请求截止时间"""
+    with request_deadline(remaining(state)):
+        yield
+
+def hop_limit_reached(state: Dict[str, Any]) -> bool:
+    """主路由决策次数是否已达上限"""
+    return (state.get("hops") or 0) >= MAX_HOPS
+
+def degradation(state: Dict[str, Any]) -> Degradation:
+    """根据剩余时间返回降级策略"""
+    left = remaining(state)
+    if left is None or left >= DEGRADE_REDUCED_K_BELOW:
+        return Degradation()
+    return Degradation(
+        search_k=DEGRADED_SEARCH_K,
+        small_model=left < DEGRADE_SMALL_MODEL_BELOW,
+        skip_retrieval=left < DEGRADE_SKIP_RETRIEVAL_BELOW,
+        partial=left < DEGRADE_PARTIAL_BELOW,
+    )
+
+def counters(policy: Degradation) -> Dict[str, int]:
+    """节点应用的降级策略，累加到请求计数器"""
+    applied = {}
+    if policy.search_k < DEFAULT_SEARCH_K:
+        applied["degraded_search_k"] = 1
+    if policy.small_model:
+        applied["degraded_small_model"] = 1
+    return applied
@@ -0,0 +1,112 @@
+"""工作流检查点模块，将工作流每一步的状态持久化到SQLite，中断的运行可以从最后完成的节点继续
+
+检查点按 对话ID:运行ID 区分线程：
+- 运行中断（进程重启、后台任务异常）时保留检查点，用户重新发送同一消息时从最后完成的节点继续，已完成节点的输出直接复用
+- 运行已经结束但回答未能保存时，重试直接返回已生成的回答
+- 回答保存后删除该运行的检查点；同一对话发送新消息时删除已结束或长时间没有进展的旧运行，正在执行的运行不删除
+
+检查点的元数据中记录对话ID，按对话查找运行时使用检查点存储的 alist 接口。
+"""
+
+import os
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+import aiosqlite
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+from langgraph.graph.state import CompiledStateGraph
+from langgraph.types import StateSnapshot
+
+from config import CHECKPOINT_PATH, CHECKPOINT_STALE_AFTER, SQLITE_PRAGMAS
+from models.analysis_cache import normalize_text
+from utils.logger import get_logger
+
+# 获取日志记录器
+log = get_logger("checkpoint")
+
+# 本进程中正在执行的运行（线程ID），所有操作都在事件循环中执行，不需要加锁
+_running: Set[str] = set()
+
+async def open_checkpointer(path: str = CHECKPOINT_PATH) -> AsyncSqliteSaver:
+    """打开SQLite检查点存储"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = await aiosqlite.connect(path)
+    # 每一步都会写入检查点，与业务数据库使用相同的WAL等参数
+    for name, value in SQLITE_PRAGMAS.items():
+        await conn.execute(f"PRAGMA {name} = {value}")
+    saver = AsyncSqliteSaver(conn)
+    await saver.setup()
+    log.info(f"检查点存储初始化完成: {path}")
+    return saver
+
+async def close_checkpointer(saver: AsyncSqliteSaver):
+    """关闭检查点存储的连接"""
+    await saver.conn.close()
+
+def thread_id(conversation_id: str, run_id: str) -> str:
+    return f"{conversation_id}:{run_id}"
+
+def thread_config(conversation_id: str, thread: str) -> Dict[str, Any]:
+    """线程的运行配置，元数据中的对话ID写入每个检查点，用于按对话查找运行"""
+    return {"configurable": {"thread_id": thread}, "metadata": {"conversation_id": conversation_id}}
+
+def run_config(conversation_id: str, run_id: str) -> Dict[str, Any]:
+    """运行配置，检查点按对话和运行区分"""
+    return thread_config(conversation_id, thread_id(conversation_id, run_id))
+
+@contextmanager
+def running(config: Dict[str, Any]) -> Iterator[None]:
+    """标记运行正在本进程中执行，执行期间同一对话的其他请求不会删除它的检查点"""
+    thread = config["configurable"]["thread_id"]
+    _running.add(thread)
+    try:
+        yield
+    finally:
+        _running.discard(thread)
+
+async def _conversation_threads(saver: AsyncSqliteSaver, conversation_id: str) -> List[str]:
+    """对话中保留检查点的运行，最近的在前"""
+    threads = []
+    # 检查点按ID（时间顺序）倒序返回
+    async for checkpoint_tuple in saver.alist(None, filter={"conversation_id": conversation_id}):
+        thread = checkpoint_tuple.config["configurable"]["thread_id"]
+        if thread not in threads:
+            threads.append(thread)
+    return threads
+
+def _is_stale(snapshot: StateSnapshot) -> bool:
+    """最后一个检查点超过 CHECKPOINT_STALE_AFTER 秒，运行已经中断（包括其他工作进程中的运行）"""
+    if not snapshot.created_at:
+        return True
+    created_at = datetime.fromisoformat(snapshot.created_at)
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - created_at).total_seconds() > CHECKPOINT_STALE_AFTER
+
+async def find_run(graph: CompiledStateGraph, conversation_id: str, message: str) -> Optional[StateSnapshot]:
+    """查找对话中同一消息可以继续或复用的运行
+
+    正在本进程中执行的运行跳过；消息不同的旧运行只在已经结束或长时间没有进展时删除。
+    """
+    saver = graph.checkpointer
+    if saver is None:
+        return None
+    found = None
+    for thread in await _conversation_threads(saver, conversation_id):
+        if thread in _running:
+            continue
+        snapshot = await graph.aget_state({"configurable": {"thread_id": thread}})
+        if found is None and normalize_text(snapshot.values.get("message", "")) == normalize_text(message):
+            found = snapshot
+            continue
+        if snapshot.next and not _is_stale(snapshot):
+            continue
+        log.info(f"删除旧运行: {thread}")
+        await saver.adelete_thread(thread)
+    return found
+
+async def delete_run(graph: CompiledStateGraph, config: Dict[str, Any]):
+    """回答保存后删除运行的检查点"""
+    if graph.checkpointer is not None:
+        await graph.checkpointer.adelete_thread(config["configurable"]["thread_id"])
@@ -1,19 +1,39 @@
 """工作流图定义模块，负责构建和执行LangGraph工作流"""
 
+from typing import Optional
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph import StateGraph, END
 from langgraph.graph.state import CompiledStateGraph
 from langchain_core.runnables.graph import CurveStyle, MermaidDrawMethod, NodeStyles
+from config import WORKFLOW_MODE, WORKFLOW_MODES
+from utils.logger import get_logger
 from workflows.router import (
     main_node,
     route_to_tool,
+    plan_node,
+    dispatch_node,
+    synthesize_node,
     company_node,
     requirement_node,
     estimation_node,
     State
 )
 
+# 获取日志记录器
+log = get_logger("graph")
+
 # 构建工作流图
-def build_enterprise_bot_graph() -> CompiledStateGraph:
+def build_enterprise_bot_graph(mode: str = WORKFLOW_MODE, checkpointer: Optional[BaseCheckpointSaver] = None) -> CompiledStateGraph:
+    """构建工作流图，传入检查点存储时每一步的状态都会持久化"""
+    if mode not in WORKFLOW_MODES:
+        log.warning(f"未知的工作流模式: {mode}，使用默认模式: react")
+        mode = "react"
+    if mode == "plan":
+        return build_plan_graph(checkpointer)
+    return build_react_graph(checkpointer)
+
+# 构建逐步决策工作流图
+def build_react_graph(checkpointer: Optional[BaseCheckpointSaver] = None) -> CompiledStateGraph:
     workflow = StateGraph(State)
     
     # 添加节点
@@ -21,25 +41,60 @@ def build_enterprise_bot_graph() -> CompiledStateGraph:
     workflow.add_node("company", company_node)
     workflow.add_node("requirement", requirement_node)
     workflow.add_node("estimation", estimation_node)
+    workflow.add_node("synthesize", synthesize_node)
     
     # 设置入口节点
     workflow.set_entry_point("main")
     
-    # 添加条件边
-    workflow.add_conditional_edges(
-        "main",
-        route_to_tool,
-        {
-            "company": "company",
-            "requirement": "requirement",
-            "estimation": "estimation",
-            END: END
-        }
-    )
+    # 添加条件边，主节点可同时调度多个互不依赖的工具节点并行执行，
+    # 工具节点全部完成后由汇总节点读取完整输出生成最终回答
+    path_map = {
+        "company": "company",
+        "requirement": "requirement",
+        "estimation": "estimation",
+        "synthesize": "synthesize",
+        END: END
+    }
+    workflow.add_conditional_edges("main", route_to_tool, path_map)
+    workflow.add_edge("synthesize", END)
     
-    # 工具节点返回主节点
+    # 工具节点返回主节点，同一批并行节点全部完成后主节点才会再次执行
     workflow.add_edge("company", "main")
     workflow.add_edge("requirement", "main")
     workflow.add_edge("estimation", "main")
     
-    return workflow.compile()
+    return workflow.compile(checkpointer=checkpointer)
+
+# 构建一次性计划工作流图
+def build_plan_graph(checkpointer: Optional[BaseCheckpointSaver] = None) -> CompiledStateGraph:
+    workflow = StateGraph(State)
+
+    # 添加节点
+    workflow.add_node("plan", plan_node)
+    workflow.add_node("company", company_node)
+    workflow.add_node("requirement", requirement_node)
+    workflow.add_node("estimation", estimation_node)
+    workflow.add_node("dispatch", dispatch_node)
+    workflow.add_node("synthesize", synthesize_node)
+
+    # 设置入口节点
+    workflow.set_entry_point("plan")
+
+    # 计划节点与调度节点按计划路由到下一批节点，不再经过主路由
+    path_map = {
+        "company": "company",
+        "requirement": "requirement",
+        "estimation": "estimation",
+        "synthesize": "synthesize",
+        END: END
+    }
+    for node in ["plan", "dispatch"]:
+        workflow.add_conditional_edges(node, route_to_tool, path_map)
+    workflow.add_edge("synthesize", END)
+
+    # 工具节点汇入调度节点，同一批并行节点全部完成后再调度下一批
+    workflow.add_edge("company", "dispatch")
+    workflow.add_edge("requirement", "dispatch")
+    workflow.add_edge("estimation", "dispatch")
+
+    return workflow.compile(checkpointer=checkpointer)
@@ -1,131 +1,308 @@
-"""对话记忆管理模块，负责管理对话历史和上下文"""
+"""对话记忆管理模块，负责管理对话历史和上下文
 
-from typing import Dict, List, Any, Optional
+对话历史的内存缓存，作为 /api/chat 的历史来源：
+- 每个对话保留最近 max_history 条消息和对话摘要，未命中时从数据库加载
+- 滚出窗口的消息由后台摘要任务批量合并到对话摘要，请求不等待摘要生成
+- 对话摘要和已合并到的消息写入数据库，重启后或其他工作进程中不需要重新生成摘要
+- 按对话数和估算字节数限制总量，超出时淘汰最久未访问的对话
+- 超过 ttl 未访问的对话由后台任务定期清理
+"""
+
+import asyncio
+import threading
 import time
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional
+
 from utils.logger import get_logger
-from langchain.memory import ConversationSummaryMemory
-from langchain.llms.base import BaseLLM
-from langchain_openai import ChatOpenAI
-from config import OPENAI_MODEL
+from utils import metrics
+from utils.history import SUMMARY_ROLE
+from config import (
+    MEMORY_MAX_HISTORY, MEMORY_MAX_CONVERSATIONS,
+    MEMORY_MAX_BYTES, MEMORY_TTL, MEMORY_SWEEP_INTERVAL, SUMMARY_ENABLED,
+)
+from models.database import load_conversation_state, get_conversation_summary, save_conversation_summary
+from models import async_database
+from workflows.summarizer import ConversationSummarizer
 # 获取日志记录器
 log = get_logger("memory")
 
+# 每条消息除内容以外的估算开销（字典、时间戳、消息ID等，字节）
+MESSAGE_OVERHEAD = 256
+
+def estimate_bytes(message: Dict[str, Any]) -> int:
+    """估算单条消息占用的内存"""
+    return len(str(message.get("content", "")).encode("utf-8")) + MESSAGE_OVERHEAD
+
+class MemoryEntry:
+    """单个对话的记忆：最近的原始消息、更早对话的摘要和最后访问时间"""
+
+    __slots__ = ("history", "summary", "size", "last_access")
+
+    def __init__(self, history: List[Dict[str, Any]], summary: str = ""):
+        self.history = history
+        self.summary = summary
+        self.size = sum(estimate_bytes(message) for message in history) + len(summary.encode("utf-8"))
+        self.last_access = time.time()
+
 class ConversationMemory:
     """对话记忆管理器，负责存储和检索对话历史"""
-    
-    def __init__(self, max_history: int = 10, ttl: int = 3600, llm: Optional[BaseLLM] = None):
+
+    def __init__(self, max_history: int = MEMORY_MAX_HISTORY, ttl: int = MEMORY_TTL, llm: Any = None,
+                 max_conversations: int = MEMORY_MAX_CONVERSATIONS, max_bytes: int = MEMORY_MAX_BYTES,
+                 summarize: bool = SUMMARY_ENABLED):
         """
         初始化对话记忆管理器
-        
+
         参数:
             max_history: 每个对话保留的最大历史消息数量
-            ttl: 记忆的生存时间（秒），超过此时间的记忆将被清理
-            llm: 用于总结对话的语言模型，如果为None则使用默认模型
+            ttl: 记忆的生存时间（秒），超过此时间未访问的记忆将被清理
+            llm: 用于总结对话的语言模型，如果为None则使用 summarizer 配置的模型
+            max_conversations: 最多缓存的对话数
+            max_bytes: 缓存消息的估算总字节数上限
+            summarize: 是否为滚出窗口的消息生成摘要
         """
-        self.memories = {}  # 存储所有对话的记忆对象
-        self.raw_histories = {}  # 存储原始对话历史
-        self.timestamps = {}  # 存储每个对话的最后访问时间
+        self.entries: "OrderedDict[str, MemoryEntry]" = OrderedDict()  # 按访问顺序排列，最久未访问的在前
         self.max_history = max_history
         self.ttl = ttl
-        self.llm = llm or ChatOpenAI(model=OPENAI_MODEL,temperature=0)
-        log.info(f"对话记忆管理器初始化完成，最大历史记录数: {max_history}, TTL: {ttl}秒")
-    
-    def _create_memory(self, conversation_id: str) -> ConversationSummaryMemory:
-        """为指定对话创建一个新的记忆对象"""
-        memory = ConversationSummaryMemory(llm=self.llm)
-        self.memories[conversation_id] = memory
-        self.raw_histories[conversation_id] = []
-        return memory
-    
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+        self._lock = threading.RLock()
+        self.summarizer = ConversationSummarizer(self.get_summary, self.set_summary, llm) if summarize else None
+        log.info(f"对话记忆管理器初始化完成，最大历史记录数: {max_history}, TTL: {ttl}秒, "
+                 f"最多缓存对话数: {max_conversations}, 内存上限: {max_bytes}字节")
+
+    def _touch(self, conversation_id: str) -> Optional[MemoryEntry]:
+        """获取对话记忆并标记为最近访问"""
+        entry = self.entries.get(conversation_id)
+        if entry is not None:
+            self.entries.move_to_end(conversation_id)
+            entry.last_access = time.time()
+        return entry
+
+    def _put(self, conversation_id: str, history: List[Dict[str, Any]], summary: str = "") -> MemoryEntry:
+        """写入对话记忆并按对话数和字节数淘汰最久未访问的对话"""
+        self._remove(conversation_id)
+        entry = MemoryEntry(history[-self.max_history:] if self.max_history else [], summary)
+        self.entries[conversation_id] = entry
+        self.total_bytes += entry.size
+        self._evict()
+        return entry
+
+    def _remove(self, conversation_id: str) -> bool:
+        entry = self.entries.pop(conversation_id, None)
+        if entry is None:
+            return False
+        self.total_bytes -= entry.size
+        return True
+
+    def _evict(self):
+        """超出对话数或字节数上限时淘汰最久未访问的对话，最近访问的对话始终保留"""
+        while len(self.entries) > 1 and (len(self.entries) > self.max_conversations or self.total_bytes > self.max_bytes):
+            conversation_id = next(iter(self.entries))
+            self._remove(conversation_id)
+            self.stats["evictions"] += 1
+            log.debug(f"淘汰对话记忆: {conversation_id}")
+
+    def _trim(self, conversation_id: str, entry: MemoryEntry):
+        """只保留最近 max_history 条消息，滚出窗口的消息交给后台摘要"""
+        overflow = len(entry.history) - self.max_history
+        if overflow <= 0:
+            return
+        removed = entry.history[:overflow]
+        del entry.history[:overflow]
+        size = sum(estimate_bytes(message) for message in removed)
+        entry.size -= size
+        self.total_bytes -= size
+        if self.summarizer is not None:
+            self.summarizer.enqueue(conversation_id, removed)
+
     def get_memory(self, conversation_id: str) -> List[Dict[str, Any]]:
-        """获取指定对话的记忆"""
-        # 更新访问时间
-        self.timestamps[conversation_id] = time.time()
-        
-        # 返回原始历史记录（如果存在）
-        return self.raw_histories.get(conversation_id, [])
-    
+        """获取指定对话最近的历史消息，未命中时从数据库加载对话摘要和摘要之后的消息
+
+        摘要之后、窗口以外的消息（如上次摘要完成前进程退出）交给后台摘要。
+        """
+        history = self._lookup(conversation_id)
+        if history is not None:
+            return history
+        # 数据库查询在锁外执行，并发加载同一对话时以后完成的为准
+        return self._load(conversation_id, load_conversation_state(conversation_id, self._load_limit()))
+
+    async def aget_memory(self, conversation_id: str) -> List[Dict[str, Any]]:
+        """get_memory 的异步版本，未命中时通过异步数据库加载，不阻塞事件循环"""
+        history = self._lookup(conversation_id)
+        if history is not None:
+            return history
+        state = await async_database.load_conversation_state(conversation_id, self._load_limit())
+        return self._load(conversation_id, state)
+
+    def _lookup(self, conversation_id: str) -> Optional[List[Dict[str, Any]]]:
+        """读取缓存的历史消息，未命中时返回None"""
+        with self._lock:
+            entry = self._touch(conversation_id)
+            if entry is not None:
+                self.stats["hits"] += 1
+                metrics.cache_requests.inc(cache="conversation_memory", result="hit")
+                return list(entry.history)
+        self.stats["misses"] += 1
+        metrics.cache_requests.inc(cache="conversation_memory", result="miss")
+        return None
+
+    def _load_limit(self) -> int:
+        """未命中时加载的消息数：窗口和最多排队摘要的消息"""
+        return self.max_history + (self.summarizer.max_pending if self.summarizer is not None else 0)
+
+    def _load(self, conversation_id: str, state: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """写入从数据库加载的对话摘要和消息"""
+        history = state["messages"]
+        with self._lock:
+            entry = self._put(conversation_id, history, state["summary"])
+            if self.summarizer is not None:
+                self.summarizer.enqueue(conversation_id, history[:len(history) - len(entry.history)])
+            return list(entry.history)
+
+    def append_message(self, conversation_id: str, message: Dict[str, Any]) -> None:
+        """消息写入数据库后同步追加到对话记忆，未缓存的对话在下次访问时从数据库加载"""
+        with self._lock:
+            entry = self._touch(conversation_id)
+            if entry is None:
+                return
+            entry.history.append(message)
+            size = estimate_bytes(message)
+            entry.size += size
+            self.total_bytes += size
+            self._trim(conversation_id, entry)
+            self._evict()
+
+    def get_context(self, conversation_id: str) -> List[Dict[str, Any]]:
+        """获取构建提示用的对话历史：对话摘要、尚未合并到摘要的消息和最近的历史消息
+
+        摘要作为 role 为 summary 的第一条消息，由 HistoryBuilder 识别。
+        """
+        return self._context(conversation_id, self.get_memory(conversation_id))
+
+    async def aget_context(self, conversation_id: str) -> List[Dict[str, Any]]:
+        """get_context 的异步版本"""
+        return self._context(conversation_id, await self.aget_memory(conversation_id))
+
+    def _context(self, conversation_id: str, history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        older = self.summarizer.pending_messages(conversation_id) if self.summarizer is not None else []
+        with self._lock:
+            entry = self.entries.get(conversation_id)
+            summary = entry.summary if entry is not None else ""
+        context = [{"role": SUMMARY_ROLE, "content": summary}] if summary else []
+        return context + older + history
+
+    def get_summary(self, conversation_id: str) -> str:
+        """对话摘要，尚未生成时返回空字符串，对话不在记忆中时从数据库读取"""
+        with self._lock:
+            entry = self.entries.get(conversation_id)
+            if entry is not None:
+                return entry.summary
+        return get_conversation_summary(conversation_id)
+
+    def set_summary(self, conversation_id: str, summary: str, messages: Optional[List[Dict[str, Any]]] = None) -> None:
+        """整体替换对话摘要，messages 为本次合并的消息，提供时同时写入数据库"""
+        message_id = messages[-1].get("message_id") if messages else None
+        if message_id:
+            try:
+                summary = save_conversation_summary(conversation_id, summary, message_id)
+            except Exception as e:
+                # 保存失败时只保留在内存中，下次合并时一起写入
+                log.error(f"保存对话摘要失败: {conversation_id}, {e}")
+        with self._lock:
+            entry = self.entries.get(conversation_id)
+            if entry is None:
+                return
+            size = len(summary.encode("utf-8")) - len(entry.summary.encode("utf-8"))
+            entry.summary = summary
+            entry.size += size
+            self.total_bytes += size
+
     def get_memory_variables(self, conversation_id: str) -> Dict[str, Any]:
         """获取指定对话的记忆变量，包括总结"""
-        # 更新访问时间
-        self.timestamps[conversation_id] = time.time()
-        
-        # 如果记忆对象不存在，创建一个新的
-        if conversation_id not in self.memories:
-            self._create_memory(conversation_id)
-        
-        # 返回记忆变量
-        return self.memories[conversation_id].load_memory_variables({})
-    
+        return {"history": self.get_summary(conversation_id)}
+
     def initialize_memory(self, conversation_id: str, history: List[Dict[str, Any]]) -> None:
-        """使用现有历史初始化对话记忆"""
-        if conversation_id not in self.memories:
-            # 创建新的记忆对象
-            memory = self._create_memory(conversation_id)
-            
-            # 限制历史记录数量
-            limited_history = history[-self.max_history:] if history else []
-            self.raw_histories[conversation_id] = limited_history
-            
-            # 将历史记录添加到记忆中
-            for i in range(0, len(limited_history), 2):
-                if i+1 < len(limited_history):
-                    user_message = limited_history[i].get("content", "")
-                    ai_message = limited_history[i+1].get("content", "")
-                    memory.save_context({"input": user_message}, {"output": ai_message})
-            
-            self.timestamps[conversation_id] = time.time()
-            log.info(f"初始化对话记忆: {conversation_id}, 历史记录数: {len(limited_history)}")
-    
+        """使用现有历史初始化对话记忆，窗口以外的消息交给后台摘要"""
+        with self._lock:
+            if conversation_id in self.entries:
+                return
+            history = list(history or [])
+            older = history[:-self.max_history] if self.max_history else history
+            entry = self._put(conversation_id, history)
+            if self.summarizer is not None:
+                self.summarizer.enqueue(conversation_id, older)
+        log.info(f"初始化对话记忆: {conversation_id}, 历史记录数: {len(entry.history)}, 待摘要: {len(older)}")
+
     def add_exchange(self, conversation_id: str, user_message: Dict[str, Any], system_message: Dict[str, Any]) -> None:
-        """添加一轮对话交流到记忆中"""
-        # 如果记忆对象不存在，创建一个新的
-        if conversation_id not in self.memories:
-            self._create_memory(conversation_id)
-        
-        # 添加用户消息和系统响应到原始历史记录
-        if conversation_id not in self.raw_histories:
-            self.raw_histories[conversation_id] = []
-        
-        self.raw_histories[conversation_id].append(user_message)
-        self.raw_histories[conversation_id].append(system_message)
-        
-        # 限制原始历史记录数量
-        if len(self.raw_histories[conversation_id]) > self.max_history:
-            self.raw_histories[conversation_id] = self.raw_histories[conversation_id][-self.max_history:]
-        
-        # 添加到记忆总结中
-        user_content = user_message.get("content", "")
-        system_content = system_message.get("content", "")
-        self.memories[conversation_id].save_context({"input": user_content}, {"output": system_content})
-        
-        # 更新访问时间
-        self.timestamps[conversation_id] = time.time()
-        log.debug(f"添加对话交流到记忆: {conversation_id}, 当前历史记录数: {len(self.raw_histories[conversation_id])}")
-    
+        """添加一轮对话交流到记忆中，摘要在后台生成"""
+        with self._lock:
+            if conversation_id not in self.entries:
+                self._put(conversation_id, [])
+            self.append_message(conversation_id, user_message)
+            self.append_message(conversation_id, system_message)
+        log.debug(f"添加对话交流到记忆: {conversation_id}")
+
     def clear_memory(self, conversation_id: str) -> None:
         """清除指定对话的记忆"""
-        if conversation_id in self.memories:
-            del self.memories[conversation_id]
-        if conversation_id in self.raw_histories:
-            del self.raw_histories[conversation_id]
-        if conversation_id in self.timestamps:
-            del self.timestamps[conversation_id]
-        log.info(f"清除对话记忆: {conversation_id}")
-    
+        with self._lock:
+            removed = self._remove(conversation_id)
+            if self.summarizer is not None:
+                self.summarizer.discard(conversation_id)
+        if removed:
+            log.info(f"清除对话记忆: {conversation_id}")
+
     def cleanup_old_memories(self) -> int:
         """清理过期的记忆，返回清理的记忆数量"""
         current_time = time.time()
-        expired_ids = [
-            conv_id for conv_id, timestamp in self.timestamps.items()
-            if current_time - timestamp > self.ttl
-        ]
-        
-        # 清除过期记忆
-        for conv_id in expired_ids:
-            self.clear_memory(conv_id)
-        
+        with self._lock:
+            # 按访问顺序排列，遇到未过期的对话即可停止
+            expired_ids = []
+            for conv_id, entry in self.entries.items():
+                if current_time - entry.last_access <= self.ttl:
+                    break
+                expired_ids.append(conv_id)
+            for conv_id in expired_ids:
+                self._remove(conv_id)
+            self.stats["expired"] += len(expired_ids)
+
         if expired_ids:
             log.info(f"清理过期记忆，共清理 {len(expired_ids)} 个对话")
-        
+
         return len(expired_ids)
+
+    async def sweep_periodically(self, interval: float = MEMORY_SWEEP_INTERVAL):
+        """后台任务：定期清理过期的记忆，直到任务被取消"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.cleanup_old_memories()
+            except Exception as e:
+                log.error(f"清理过期记忆失败: {e}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """缓存统计：命中、未命中、淘汰和过期清理次数，以及当前对话数和估算字节数"""
+        with self._lock:
+            snapshot = {**self.stats, "conversations": len(self.entries), "bytes": self.total_bytes}
+        if self.summarizer is not None:
+            snapshot["summarizer"] = self.summarizer.snapshot()
+        return snapshot
+
+# 全局对话记忆，首次使用时创建
+_conversation_memory: Optional[ConversationMemory] = None
+_conversation_memory_lock = threading.Lock()
+
+def get_conversation_memory() -> ConversationMemory:
+    """获取共享的对话记忆管理器"""
+    global _conversation_memory
+    if _conversation_memory is None:
+        with _conversation_memory_lock:
+            if _conversation_memory is None:
+                memory = ConversationMemory()
+                metrics.conversation_memory_conversations.set_function(lambda: len(memory.entries))
+                metrics.conversation_memory_bytes.set_function(lambda: memory.total_bytes)
+                _conversation_memory = memory
+    return _conversation_memory
@@ -0,0 +1,137 @@
+"""请求级检索模块，负责在意图识别的同时预取知识库检索结果，并通过请求级检索备忘在节点间复用检索结果"""
+
+import contextvars
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, List, Any, Optional, Tuple
+
+from config import (
+    RETRIEVAL_PREFETCH, PREFETCH_MATCH_THRESHOLD,
+    PREFETCH_WAIT_TIMEOUT, PREFETCH_TTL, PREFETCH_WORKERS
+)
+from models.search import get_search_helper
+from utils import metrics, tracing
+from utils.logger import get_logger
+
+# 获取日志记录器
+log = get_logger("retrieval")
+
+# 预取线程池
+_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+
+class RetrievalSlot:
+    """单个请求的预取检索槽位"""
+
+    def __init__(self, query: str, future: Future):
+        self.query = query
+        self.future = future
+        self.created_at = time.time()
+
+# 请求ID -> 预取检索槽位
+_slots: Dict[str, RetrievalSlot] = {}
+_slots_lock = threading.Lock()
+
+def _normalize(text: str) -> str:
+    """归一化查询文本"""
+    return "".join(text.lower().split())
+
+def query_overlap(prefetch_query: str, query: str) -> float:
+    """节点查询的字符二元组被预取查询覆盖的比例
+
+    节点查询通常是路由Agent从原始消息中提取的关键信息，被原始消息覆盖的比例越高，
+    原始消息的检索结果越能代表节点查询的检索结果。
+    """
+    prefetch_query, query = _normalize(prefetch_query), _normalize(query)
+    if prefetch_query == query:
+        return 1.0
+    prefetch_grams = {prefetch_query[i:i + 2] for i in range(len(prefetch_query) - 1)} or {prefetch_query}
+    query_grams = {query[i:i + 2] for i in range(len(query) - 1)} or {query}
+    return len(prefetch_grams & query_grams) / len(query_grams)
+
+def start_prefetch(request_id: str, query: str) -> None:
+    """以用户原始消息开始预取检索，与意图识别的LLM调用并行执行"""
+    if not RETRIEVAL_PREFETCH or not request_id:
+        return
+    with _slots_lock:
+        # 清理未被释放的过期槽位
+        expired = [rid for rid, slot in _slots.items() if time.time() - slot.created_at > PREFETCH_TTL]
+        for rid in expired:
+            del _slots[rid]
+        if request_id in _slots:
+            return
+        # 复制上下文，预取检索的耗时记录到当前请求的追踪中
+        context = contextvars.copy_context()
+        future = _executor.submit(context.run, _prefetch, query)
+        _slots[request_id] = RetrievalSlot(query, future)
+    log.debug(f"开始预取检索: {request_id}, 查询: {query[:50]}")
+
+def _prefetch(query: str) -> List[Dict[str, Any]]:
+    with tracing.span("retrieval:prefetch", "retrieval"):
+        return get_search_helper().search_knowledge_base(query)
+
+def consume_prefetch(request_id: str, query: str) -> Optional[List[Dict[str, Any]]]:
+    """查询被预取查询充分覆盖时返回预取结果，否则返回None"""
+    with _slots_lock:
+        slot = _slots.get(request_id)
+    if slot is None:
+        return None
+    overlap = query_overlap(slot.query, query)
+    if overlap < PREFETCH_MATCH_THRESHOLD:
+        log.debug(f"预取查询不匹配: {request_id}, 覆盖率: {overlap:.2f}")
+        return None
+    try:
+        results = slot.future.result(timeout=PREFETCH_WAIT_TIMEOUT)
+    except Exception as e:
+        log.warning(f"预取检索失败，回退到实时检索: {str(e)}")
+        return None
+    log.info(f"命中预取检索结果: {request_id}, 覆盖率: {overlap:.2f}")
+    return results
+
+def release(request_id: str) -> None:
+    """请求结束后释放预取槽位"""
+    with _slots_lock:
+        _slots.pop(request_id, None)
+
+def shutdown() -> None:
+    """应用关闭时取消未开始的预取并释放全部槽位"""
+    _executor.shutdown(wait=False, cancel_futures=True)
+    with _slots_lock:
+        _slots.clear()
+
+# 默认检索范围：企业知识库
+DEFAULT_SCOPE = "knowledge_base"
+
+def memo_key(query: str, scope: str = DEFAULT_SCOPE, limit: int = 5) -> str:
+    """检索备忘的键，由检索范围、返回数量和归一化的查询组成"""
+    return f"{scope}:{limit}:{_normalize(query)}"
+
+def search(state: Dict[str, Any], query: str, scope: str = DEFAULT_SCOPE, limit: int = 5) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """检索知识库，依次查询请求级检索备忘、预取结果，都未命中时才实际检索
+
+    返回:
+        检索结果，以及需要合并到State中的增量（检索备忘和请求计数器）
+    """
+    key = memo_key(query, scope, limit)
+    memo = state.get("retrieval_memo") or {}
+    with tracing.span("retrieval", "retrieval", scope=scope, limit=limit):
+        if key in memo:
+            log.debug(f"命中检索备忘: {key[:80]}")
+            tracing.annotate(source="memo", results=len(memo[key]))
+            metrics.cache_requests.inc(cache="retrieval", result="memo")
+            return memo[key], {"counters": {"retrieval_memo_hits": 1, "searches_avoided": 1}}
+
+        results = consume_prefetch(state.get("request_id"), query)
+        if results is not None:
+            # 降级时检索数量可能小于预取数量
+            results = results[:limit]
+            counters = {"retrieval_prefetch_hits": 1, "searches_avoided": 1}
+            tracing.annotate(source="prefetch")
+            metrics.cache_requests.inc(cache="retrieval", result="prefetch")
+        else:
+            results = get_search_helper().search_knowledge_base(query, limit)
+            counters = {"searches": 1}
+            tracing.annotate(source="search")
+            metrics.cache_requests.inc(cache="retrieval", result="miss")
+        tracing.annotate(results=len(results))
+    return results, {"retrieval_memo": {key: results}, "counters": counters}
@@ -1,138 +1,265 @@
-from typing import Dict, List, Any, TypedDict, Optional
+import operator
+from functools import wraps
+from typing import Annotated, Callable, Dict, List, Any, Tuple, TypedDict, Optional
 from langgraph.graph import END
-from agents.entry_point import EntryPointAgent
-from config import OPENAI_MODEL
 from agents import (
+    entry_point,
     analyzer,
     estimator,
     knowledge,
 )
 from utils.logger import get_logger
-from models.search import SearchHelper
+from utils.llm import small_model, LLMUnavailableError
+from utils import tracing
+from models.search import get_search_helper
+from workflows import retrieval, artifacts, budget
 
 # 获取日志记录器
 log = get_logger("router")
+
+def merge_data(left: Optional[Dict[str, Any]], right: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """合并附加数据，避免并行分支互相覆盖"""
+    merged = dict(left or {})
+    merged.update(right or {})
+    return merged
+
+def add_counters(left: Optional[Dict[str, int]], right: Optional[Dict[str, int]]) -> Dict[str, int]:
+    """累加请求计数器"""
+    merged = dict(left or {})
+    for key, value in (right or {}).items():
+        merged[key] = merged.get(key, 0) + value
+    return merged
+
 # 定义状态类型
 class State(TypedDict):
     message: str                 # 用户消息
     conversation_id: str        # 对话ID
+    request_id: str             # 请求ID，用于关联请求级的预取检索等数据
     history: List[Dict[str, Any]] # 对话历史
     current_tool: Optional[str] # 当前使用的工具s
+    next_nodes: List[str]       # 下一步并行执行的工具节点
     last_input: str           # 上一个节点的输入
-    tools_response: List[Dict] # 工具响应
+    tools_response: Annotated[List[Dict], operator.add] # 工具响应的紧凑描述，并行分支的结果依次追加
+    artifacts: Annotated[Dict[str, Dict[str, str]], merge_data]  # 请求级产出存储：产出ID -> 工具节点的完整输出
     response: Optional[str]      # 系统响应
     is_final: bool              # 是否为最终响应
-    data: Optional[Dict[str, Any]]  # 附加数据
+    data: Annotated[Dict[str, Any], merge_data]  # 附加数据，并行分支的结果合并
+    plan: List[Dict[str, str]]  # 计划模式下的节点调用计划
+    retrieval_memo: Annotated[Dict[str, List[Dict[str, Any]]], merge_data]  # 请求级检索备忘：(检索范围, 查询) -> 检索结果
+    counters: Annotated[Dict[str, int], add_counters]  # 请求计数器，写入请求追踪
+    deadline: Optional[float]   # 请求截止时间（时间戳），各节点据此选择降级策略
+    hops: int                   # 主路由已决策的次数
+
+# 工具节点列表
+TOOL_NODES = ["company", "requirement", "estimation"]
+# 节点依赖关系：报价测算依赖需求拆解结果
+NODE_DEPENDENCIES = {"estimation": ["requirement"]}
+
+def ready_nodes(requested: List[str], done: List[str]) -> List[str]:
+    """返回已请求且依赖已满足的节点，这些节点之间互不依赖，可以并行执行"""
+    ready = []
+    for node in requested:
+        if node in done or node in ready:
+            continue
+        dependencies = [dep for dep in NODE_DEPENDENCIES.get(node, []) if dep in requested]
+        if all(dep in done for dep in dependencies):
+            ready.append(node)
+    return ready
+
+def done_nodes(state: State) -> List[str]:
+    """返回已经执行完毕的工具节点"""
+    return [tool["node"] for tool in state.get("tools_response") or []]
+
+def finish_partial(state: State, reason: str) -> Dict[str, Any]:
+    """不再调用新的工具节点：调用过工具节点时汇总已有结果并附带提示，否则直接返回兜底回答"""
+    log.warning(f"请求 {state.get('request_id')} {reason}，不再调用新的工具节点")
+    update = {"next_nodes": [], "counters": {f"degraded_{reason}": 1}}
+    if state.get("tools_response"):
+        update["data"] = {"partial": True}
+        return update
+    update.update({"response": entry_point.FALLBACK_ANSWER, "current_tool": END, "is_final": True})
+    return update
+
+def partial_on_unavailable(node: str) -> Callable:
+    """装饰器：工具节点的模型不可用（截止时间已到、熔断或重试耗尽）时记录空产出并标记部分结果，
+    其他节点的结果仍然汇总，最终回答附带部分结果提示"""
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(state: State) -> Dict[str, Any]:
+            try:
+                return func(state)
+            except LLMUnavailableError as e:
+                log.warning(f"请求 {state.get('request_id')} 的 {node} 节点模型不可用，返回部分结果: {e}")
+                update = artifacts.store(node, "")
+                update["tools_response"][0]["status"] = "unavailable"
+                update["data"] = {"partial": True}
+                update["counters"] = {f"degraded_{node}_unavailable": 1}
+                return update
+        return wrapper
+    return decorator
 
-# 工具列表
-tools = []
 # 主节点逻辑
-def main_node(state: State) -> State:
-    entry_pinot_agent = EntryPointAgent(OPENAI_MODEL)
-    result = entry_pinot_agent.classify(state["message"],state["history"],state["tools_response"])
-    if result["is_final"] in [True, "True", 1, "true", "TRUE", "1"]:
-        state["response"] = result["output"]
-        state["current_tool"] = END  # 明确设置为 NONE
-        state["is_final"] = True
-    else:
-        state["last_input"] = result["inputs"]
-        state["current_tool"] = result["next_node"]
+@tracing.traced("main", "node")
+def main_node(state: State) -> Dict[str, Any]:
+    # 决策次数或时间预算耗尽时不再路由
+    if budget.hop_limit_reached(state):
+        return finish_partial(state, "hop_limit")
+    policy = budget.degradation(state)
+    if policy.partial:
+        return finish_partial(state, "deadline")
+    hops = (state.get("hops") or 0) + 1
+
+    # 首次路由时以原始消息预取检索结果，检索与路由LLM调用并行
+    if not state["tools_response"] and not policy.skip_retrieval:
+        retrieval.start_prefetch(state.get("request_id"), state["message"])
+    # 路由提示中只包含已调用节点的紧凑描述
+    with budget.llm_deadline(state):
+        result = entry_point.get_entry_point_agent().classify(state["message"],state["history"],state["tools_response"])
     log.info(f"主路由Agent返回结果: {result}")
-    return state
+    is_final = result.get("is_final") in [True, "True", 1, "true", "TRUE", "1"]
+
+    # 下一个节点可以是单个节点，也可以是互不依赖的多个节点
+    next_node = result.get("next_node")
+    requested = next_node if isinstance(next_node, list) else [next_node]
+    next_nodes = [] if is_final else ready_nodes([node for node in requested if node in TOOL_NODES], done_nodes(state))
+    if next_nodes:
+        return {"last_input": result.get("inputs") or state["message"], "next_nodes": next_nodes, "hops": hops}
+
+    # 调用过工具节点时，由汇总节点根据完整输出生成最终回答
+    if state["tools_response"]:
+        return {"next_nodes": [], "hops": hops}
+    if not is_final:
+        log.warning(f"主路由Agent未返回可执行的节点: {next_node}")
+    return {"response": result.get("output", ""), "current_tool": END, "is_final": True, "next_nodes": [], "hops": hops}
 
 # 路由函数
-def route_to_tool(state: State) -> str:
-    # 确保总是返回一个有效的 ToolType 值
-    return state.get("current_tool") or END
+def route_to_tool(state: State) -> List[str] | str:
+    """返回下一批需要并行执行的节点，工具节点全部执行完毕后进入汇总节点"""
+    if state.get("is_final"):
+        return END
+    return state.get("next_nodes") or "synthesize"
 
-def requirement_node(state: State) -> State:
+# 计划节点逻辑
+@tracing.traced("plan", "node")
+def plan_node(state: State) -> Dict[str, Any]:
+    """一次性规划全部节点调用，后续按计划执行，不再经过主路由"""
+    policy = budget.degradation(state)
+    if not policy.skip_retrieval:
+        retrieval.start_prefetch(state.get("request_id"), state["message"])
+    with small_model(policy.small_model), budget.llm_deadline(state):
+        result = entry_point.get_entry_point_agent().plan(state["message"], state["history"])
+    log.info(f"计划Agent返回结果: {result}")
+    if not result["steps"]:
+        return {"plan": [], "response": result["output"], "current_tool": END, "is_final": True, "next_nodes": []}
+    plan = result["steps"]
+    return {"plan": plan, "next_nodes": ready_nodes([step["node"] for step in plan], [])}
 
-    search_helper = SearchHelper()
-    # 搜索知识库
-    search_results = search_helper.search_knowledge_base(state["last_input"])
-    
-    formatted_results = ""
+# 计划调度节点逻辑
+@tracing.traced("dispatch", "node")
+def dispatch_node(state: State) -> Dict[str, Any]:
+    """等待同一批并行节点全部完成后，按计划调度下一批依赖已满足的节点"""
+    plan_nodes = [step["node"] for step in state.get("plan") or []]
+    next_nodes = ready_nodes(plan_nodes, done_nodes(state))
+    if next_nodes and budget.degradation(state).partial:
+        return finish_partial(state, "deadline")
+    return {"next_nodes": next_nodes}
+
+# 汇总节点逻辑
+@tracing.traced("synthesize", "node")
+def synthesize_node(state: State) -> Dict[str, Any]:
+    """汇总各工具节点的完整输出生成最终回答，完整输出只在此处读取一次
+
+    汇总调用同样受请求截止时间限制，时间已经用完时直接返回各节点的结果。
+    """
+    policy = budget.degradation(state)
+    left = budget.remaining(state)
+    partial = bool((state.get("data") or {}).get("partial"))
+    if left is not None and left <= 0:
+        log.warning(f"请求 {state.get('request_id')} 已超过截止时间，不再调用汇总模型")
+        response = entry_point.format_tool_results(artifacts.collect(state))
+        partial = True
+        policy_counters = {"degraded_synthesis_skipped": 1}
+    else:
+        with small_model(policy.small_model), budget.llm_deadline(state):
+            response = entry_point.get_entry_point_agent().synthesize(
+                state["message"], state["history"], artifacts.collect(state)
+            )
+        policy_counters = budget.counters(policy)
+    # 部分结果附带提示，告知用户部分处理已省略
+    if partial:
+        response += budget.PARTIAL_NOTICE
+    return {"response": response, "current_tool": END, "is_final": True, "next_nodes": [],
+            "counters": policy_counters}
+
+def node_input(state: State, node: str) -> str:
+    """获取节点输入，计划模式下使用计划中该节点的输入"""
+    for step in state.get("plan") or []:
+        if step["node"] == node:
+            return step["inputs"]
+    return state.get("last_input") or state["message"]
+
+def search_with_budget(state: State, query: str, policy: budget.Degradation) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """按降级策略检索知识库，剩余时间不足时跳过检索"""
+    if policy.skip_retrieval:
+        log.warning(f"请求剩余时间不足，跳过检索: {query[:50]}")
+        return [], {"counters": {"retrieval_skipped": 1}}
+    return retrieval.search(state, query, limit=policy.search_k)
+
+def search_knowledge(state: State, query: str, policy: budget.Degradation) -> Tuple[str, Dict[str, Any]]:
+    """搜索知识库并格式化搜索结果，返回格式化结果和检索产生的状态增量"""
+    search_results, update = search_with_budget(state, query, policy)
     # 如果没有搜索结果
     if not search_results:
-        log.warning(f"知识库查询无结果: {state["last_input"]}")
-    else:
-        # 格式化搜索结果
-        formatted_results = search_helper.format_search_results(search_results)
-        # 更新状态
-        state["data"] = state.get("data", {})
-        # 确保data字段存在且是字典类型
-        if "data" not in state or not isinstance(state["data"], dict):
-            state["data"] = {}
-        #尝试解析JSON响应
-        state["data"]["knowledge_result"] = formatted_results
+        log.warning(f"知识库查询无结果: {query}")
+        return "", update
+    return get_search_helper().format_search_results(search_results), update
+
+@tracing.traced("requirement", "node")
+@partial_on_unavailable("requirement")
+def requirement_node(state: State) -> Dict[str, Any]:
+    policy = budget.degradation(state)
+    # 搜索知识库
+    formatted_results, update = search_knowledge(state, node_input(state, "requirement"), policy)
 
     # 调用需求分析Agent进行需求拆解
-    analysis = analyzer.analyzer_agent.analyze(state["message"], state["history"],formatted_results)
+    with small_model(policy.small_model), budget.llm_deadline(state):
+        analysis = analyzer.get_analyzer_agent().analyze(state["message"], state["history"],formatted_results)
 
     # markdown_response = analysis.format_to_markdown()
-    
-    state["tools_response"].append({"node":"requirement","result": analysis})
 
-    return state
+    update.update(artifacts.store("requirement", analysis))
+    update["counters"] = add_counters(update.get("counters"), budget.counters(policy))
+    return update
 
-def estimation_node(state: State) -> State:
+@tracing.traced("estimation", "node")
+@partial_on_unavailable("estimation")
+def estimation_node(state: State) -> Dict[str, Any]:
     """处理报价测算意图"""
-    # 更新状态
-    formatted_results = ""
-    state["data"] = state.get("data", {})
-    # 确保data字段存在且是字典类型
-    if "data" not in state or not isinstance(state["data"], dict):
-        state["data"] = {}
-        state["data"]["knowledge_result"] = state["data"].get("knowledge_result", {})
-        #尝试解析JSON响应
-        if "knowledge_result" not in state["data"] or not isinstance(state["data"]["knowledge_result"], str):
-            search_helper = SearchHelper()
-            # 搜索知识库
-            search_results = search_helper.search_knowledge_base(state["last_input"])
-            
-            # 如果没有搜索结果
-            if not search_results:
-                log.warning(f"知识库查询无结果: {state["last_input"]}")
-            else:
-                # 格式化搜索结果
-                formatted_results = search_helper.format_search_results(search_results)
-        else:
-            formatted_results = state["data"]["knowledge_result"]
-    else:
-        search_helper = SearchHelper()
-        # 搜索知识库
-        search_results = search_helper.search_knowledge_base(state["last_input"])
-        
-        # 如果没有搜索结果
-        if not search_results:
-            log.warning(f"知识库查询无结果: {state["last_input"]}")
-        else:
-            # 格式化搜索结果
-            formatted_results = search_helper.format_search_results(search_results)
-
-    message = state["message"]
-    tools_response = state["tools_response"]
-    for tool in tools_response:
-        if tool["node"] == "requirement":
-            message = tool["result"]
-            break
+    policy = budget.degradation(state)
+    # 搜索知识库，与需求节点查询相同时直接复用检索备忘
+    formatted_results, update = search_knowledge(state, node_input(state, "estimation"), policy)
+
+    # 有需求拆解结果时基于拆解结果测算
+    message = artifacts.get_content(state, "requirement") or state["message"]
 
     # 调用成本测算Agent进行报价计算
-    estimation = estimator.estimator_agent.estimate(message, state["history"],formatted_results)
-    
-    state["tools_response"].append({"node":"estimation","result": estimation})
+    with small_model(policy.small_model), budget.llm_deadline(state):
+        estimation = estimator.get_estimator_agent().estimate(message, state["history"], formatted_results,
+                                                              project_requirement=state["message"])
 
-    return state
+    update.update(artifacts.store("estimation", estimation))
+    update["counters"] = add_counters(update.get("counters"), budget.counters(policy))
+    return update
 
-def company_node(state: State) -> State:
-     # 调用企业智库Agent进行知识检索
-    response = ""
-    knowledge_result = knowledge.knowledge_agent.query(state["message"], state["history"])
-    # 更新状态
-    state["data"] = state.get("data", {})
-    if "data" not in state or not isinstance(state["data"], dict):
-        state["data"] = {}
-    state["data"]["knowledge_result"] = knowledge_result.dict()
+@tracing.traced("company", "node")
+@partial_on_unavailable("company")
+def company_node(state: State) -> Dict[str, Any]:
+    # 调用企业智库Agent进行知识检索
+    policy = budget.degradation(state)
+    search_results, update = search_with_budget(state, state["message"], policy)
+    with small_model(policy.small_model), budget.llm_deadline(state):
+        knowledge_result = knowledge.get_knowledge_agent().query(state["message"], state["history"], search_results)
+    response = knowledge_result.answer
 
     # 如果有信息来源，添加到响应中
     if knowledge_result.sources and len(knowledge_result.sources) > 0:
@@ -145,7 +272,9 @@ def company_node(state: State) -> State:
         response += "\n\n您可能还想了解:"
         for topic in knowledge_result.related_topics[:3]:  # 最多显示3个相关主题
             response += f"\n- {topic}"
-    
-    state["tools_response"].append({"node":"company","result": response})
 
-    return state
+    # 与需求节点并行时使用独立的键，避免覆盖其他节点的附加数据
+    update.update(artifacts.store("company", response))
+    update["data"] = {"company_result": knowledge_result.dict()}
+    update["counters"] = add_counters(update.get("counters"), budget.counters(policy))
+    return update
@@ -0,0 +1,175 @@
+"""对话摘要模块，在后台批量生成对话摘要，用户请求不等待摘要生成
+
+- 对话记忆窗口滚出的消息加入待摘要队列
+- 后台任务每隔 SUMMARY_BATCH_DELAY 秒处理一次队列，同一对话积累的多轮消息只调用一次模型，合并到已有摘要
+- 使用 summarizer 模型配置（默认小模型）
+- 摘要生成后通过回调整体替换对话摘要并持久化，读取方不会看到生成到一半的摘要
+"""
+
+import asyncio
+import threading
+from typing import Any, Callable, Dict, List
+
+from langchain.schema import HumanMessage, SystemMessage
+from starlette.concurrency import run_in_threadpool
+
+from config import MODEL_PROFILES, SUMMARY_BATCH_DELAY, SUMMARY_CONCURRENCY, SUMMARY_MAX_PENDING, SUMMARY_MAX_CHARS
+from utils.llm import create_llm, invoke as invoke_llm
+from utils.logger import get_logger
+
+# 获取日志记录器
+log = get_logger("summarizer")
+
+SUMMARY_SYSTEM_PROMPT = f"""
+你负责维护企业智能助手与用户对话的摘要。
+根据已有摘要和新增的对话内容，输出更新后的完整摘要：
+1. 保留用户的需求、约束、已确认的结论和待办事项
+2. 报价、工期等数字按原文保留
+3. 省略寒暄和重复内容
+4. 不超过{SUMMARY_MAX_CHARS}字，只输出摘要正文
+"""
+
+SUMMARY_PROMPT_TEMPLATE = """
+已有摘要:
+{summary}
+
+新增对话:
+{messages}
+"""
+
+def _format_messages(messages: List[Dict[str, Any]]) -> str:
+    return "\n".join(
+        f"{'用户' if message.get('role') == 'user' else '系统'}: {message.get('content', '')}"
+        for message in messages
+    )
+
+class ConversationSummarizer:
+    """后台对话摘要生成器"""
+
+    def __init__(self, current: Callable[[str], str], publish: Callable[[str, str, List[Dict[str, Any]]], None], llm: Any = None,
+                 batch_delay: float = SUMMARY_BATCH_DELAY, concurrency: int = SUMMARY_CONCURRENCY,
+                 max_pending: int = SUMMARY_MAX_PENDING):
+        """
+        初始化对话摘要生成器
+
+        参数:
+            current: 读取对话当前摘要
+            publish: 发布对话更新后的摘要，参数为对话ID、摘要和本次合并的消息
+            llm: 生成摘要的模型，为None时首次使用时按 summarizer 配置创建
+            batch_delay: 处理队列的间隔（秒），间隔内同一对话的消息合并为一次调用
+            concurrency: 同时生成摘要的对话数
+            max_pending: 每个对话最多排队的消息数，超过时丢弃最早的消息
+        """
+        self.current = current
+        self.publish = publish
+        self._llm = llm
+        self.batch_delay = batch_delay
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.pending: Dict[str, List[Dict[str, Any]]] = {}
+        self.in_progress: Dict[str, List[Dict[str, Any]]] = {}  # 正在生成摘要的消息
+        self.stats = {"enqueued": 0, "calls": 0, "summarized": 0, "dropped": 0, "errors": 0}
+        self._lock = threading.Lock()
+
+    @property
+    def llm(self) -> Any:
+        if self._llm is None:
+            self._llm = create_llm(MODEL_PROFILES["summarizer"], temperature=0)
+        return self._llm
+
+    def enqueue(self, conversation_id: str, messages: List[Dict[str, Any]]):
+        """消息加入待摘要队列，已在队列中或正在生成摘要的消息不重复加入，立即返回"""
+        with self._lock:
+            queued = {
+                message.get("message_id")
+                for message in self.in_progress.get(conversation_id, []) + self.pending.get(conversation_id, [])
+            }
+            messages = [message for message in messages if not message.get("message_id") or message["message_id"] not in queued]
+            if not messages:
+                return
+            queue = self.pending.setdefault(conversation_id, [])
+            queue.extend(messages)
+            self.stats["enqueued"] += len(messages)
+            self._limit(conversation_id, queue)
+
+    def _limit(self, conversation_id: str, queue: List[Dict[str, Any]]):
+        overflow = len(queue) - self.max_pending
+        if overflow > 0:
+            del queue[:overflow]
+            self.stats["dropped"] += overflow
+            log.warning(f"对话 {conversation_id} 待摘要消息过多，丢弃最早的 {overflow} 条")
+
+    def pending_messages(self, conversation_id: str) -> List[Dict[str, Any]]:
+        """已滚出对话记忆窗口、尚未合并到摘要的消息"""
+        with self._lock:
+            return self.in_progress.get(conversation_id, []) + self.pending.get(conversation_id, [])
+
+    def discard(self, conversation_id: str):
+        """对话记忆清除时丢弃待摘要的消息"""
+        with self._lock:
+            self.pending.pop(conversation_id, None)
+
+    def summarize(self, conversation_id: str, messages: List[Dict[str, Any]]) -> str:
+        """将消息合并到对话已有摘要，返回更新后的摘要"""
+        prompt_input = SUMMARY_PROMPT_TEMPLATE.format(
+            summary=self.current(conversation_id) or "无",
+            messages=_format_messages(messages),
+        )
+        response = invoke_llm("summarizer", self.llm, [
+            SystemMessage(content=SUMMARY_SYSTEM_PROMPT),
+            HumanMessage(content=prompt_input),
+        ])
+        return response.content.strip()
+
+    def _update(self, conversation_id: str, messages: List[Dict[str, Any]]):
+        """生成并发布摘要，在线程池中执行"""
+        summary = self.summarize(conversation_id, messages)
+        self.publish(conversation_id, summary, messages)
+
+    async def _summarize_batch(self, conversation_id: str, messages: List[Dict[str, Any]], semaphore: asyncio.Semaphore):
+        async with semaphore:
+            try:
+                # 先发布摘要再移出进行中的消息，读取方始终能看到这些消息或包含它们的摘要
+                await run_in_threadpool(self._update, conversation_id, messages)
+            except Exception as e:
+                # 放回队列，下一批重试
+                log.warning(f"对话 {conversation_id} 摘要生成失败，稍后重试: {e}")
+                with self._lock:
+                    del self.in_progress[conversation_id]
+                    queue = self.pending.setdefault(conversation_id, [])
+                    queue[:0] = messages
+                    self.stats["errors"] += 1
+                    self._limit(conversation_id, queue)
+                return
+            with self._lock:
+                del self.in_progress[conversation_id]
+                self.stats["calls"] += 1
+                self.stats["summarized"] += len(messages)
+        log.debug(f"对话 {conversation_id} 摘要已更新，合并 {len(messages)} 条消息")
+
+    async def flush(self):
+        """处理当前队列中全部对话的待摘要消息"""
+        with self._lock:
+            batch, self.pending = self.pending, {}
+            self.in_progress.update(batch)
+        if not batch:
+            return
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*(
+            self._summarize_batch(conversation_id, messages, semaphore)
+            for conversation_id, messages in batch.items()
+        ))
+
+    async def run(self):
+        """后台任务：定期处理待摘要队列，直到任务被取消"""
+        while True:
+            await asyncio.sleep(self.batch_delay)
+            try:
+                await self.flush()
+            except Exception as e:
+                log.error(f"处理待摘要队列失败: {e}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.stats, "pending_conversations": len(self.pending),
+                    "pending_messages": sum(len(queue) for queue in self.pending.values())}